@@ -1,7 +1,19 @@
 import pandas as pd
+import numpy as np
+import io
+import os
+import re
+import zlib
 import csv
+import json
+import heapq
+import shutil
+import tempfile
 import itertools
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.feature_extraction.text import TfidfVectorizer
+from linkage_rules import BODY_CLASSES, DRIVE_CLASSES, MILEAGE_MAX_DIFF
 
 def generate_candidate_pairs_B1(
     file_a,
@@ -72,6 +84,296 @@ def generate_candidate_pairs_B1(
     print(f"📁 File output: {output_file}")
     print(f"✔ Totale candidate pairs generate: {total_pairs}")
 
+# ==========================================================
+# ID INTERI DEI RECORD E FILE COMPATTO DELLE CANDIDATE PAIRS
+# ==========================================================
+#
+# Formato compatto (prefisso P):
+# - P_records_a.csv / P_records_b.csv : tabella attributi con colonna 'id' (= posizione della riga nel file sorgente)
+# - P_pairs.bin                        : coppie (a_id, b_id) come uint32 consecutivi, 8 byte per coppia
+# - P_meta.json                        : chiavi che possono differire tra A e B (b_key_columns), lette
+#                                        da read_candidate_pairs; assente = chiavi uguali (blocking B1)
+
+PAIR_DTYPE = np.uint32
+
+
+def compact_pair_paths(output_prefix):
+    """Percorsi dei file che compongono un output compatto."""
+    return {
+        "pairs": f"{output_prefix}_pairs.bin",
+        "records_a": f"{output_prefix}_records_a.csv",
+        "records_b": f"{output_prefix}_records_b.csv",
+        "meta": f"{output_prefix}_meta.json",
+    }
+
+
+# Chiavi condivise del formato B1: per gli schemi che non le fissano entrambe
+# (token, LSH, finestre, kNN, ...) il lato B va scritto anche come <chiave>_b
+PAIR_KEY_COLUMNS = ("manufacturer", "year")
+
+
+def write_compact_meta(output_prefix, b_key_columns=()):
+    """Scrive P_meta.json: chiavi di PAIR_KEY_COLUMNS per cui A e B di una coppia possono differire."""
+    with open(compact_pair_paths(output_prefix)["meta"], "w", encoding="utf-8") as f:
+        json.dump({"key_columns": list(PAIR_KEY_COLUMNS), "b_key_columns": list(b_key_columns)}, f)
+
+
+def load_compact_meta(output_prefix):
+    """Metadati di un output compatto (default: nessuna chiave diversa tra A e B)."""
+    path = compact_pair_paths(output_prefix)["meta"]
+    if not os.path.exists(path):
+        return {"key_columns": list(PAIR_KEY_COLUMNS), "b_key_columns": []}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def is_compact_pairs(path):
+    return str(path).endswith("_pairs.bin")
+
+
+def assign_record_ids(input_csv, output_csv, chunk_size=200_000):
+    """
+    Copia input_csv in output_csv aggiungendo come prima colonna un 'id' intero
+    stabile: la posizione (da 0) della riga nel file sorgente.
+    """
+    offset = 0
+    for i, chunk in enumerate(pd.read_csv(input_csv, chunksize=chunk_size, dtype=str)):
+        chunk.insert(0, "id", np.arange(offset, offset + len(chunk)))
+        chunk.to_csv(
+            output_csv,
+            mode="w" if i == 0 else "a",
+            index=False,
+            header=(i == 0)
+        )
+        offset += len(chunk)
+
+    print(f"✔ {offset} record con id scritti in {output_csv}")
+    return offset
+
+
+def write_pair_ids(f_out, a_ids, b_ids):
+    """Accoda a un file binario aperto le coppie (a_id, b_id) come uint32."""
+    pairs = np.empty((len(a_ids), 2), dtype=PAIR_DTYPE)
+    pairs[:, 0] = a_ids
+    pairs[:, 1] = b_ids
+    pairs.tofile(f_out)
+
+
+def load_pair_ids(pairs_file):
+    """Array (n, 2) di uint32 mappato in memoria: colonna 0 = a_id, colonna 1 = b_id."""
+    if os.path.getsize(pairs_file) == 0:
+        return np.empty((0, 2), dtype=PAIR_DTYPE)
+    return np.memmap(pairs_file, dtype=PAIR_DTYPE, mode="r").reshape(-1, 2)
+
+
+def pairs_to_frame(df_a, df_b, a_ids, b_ids, key_columns=("manufacturer", "year"), b_key_columns=()):
+    """
+    Ricostruisce le righe nel formato del blocking B1 (chiavi condivise,
+    colonne di A con suffisso _a, colonne di B con suffisso _b) a partire
+    dalle posizioni dei record nelle due tabelle.
+    b_key_columns: chiavi che possono differire tra A e B, scritte anche come <chiave>_b
+    (es. year_b), lette da record_linkage al posto della chiave condivisa.
+    """
+    key_columns = list(key_columns)
+    cols_a = [c for c in df_a.columns if c not in key_columns and c != "id"]
+    cols_b = [c for c in df_b.columns if c not in key_columns and c != "id"]
+
+    left = df_a.iloc[np.asarray(a_ids, dtype=np.int64)].reset_index(drop=True)
+    right = df_b.iloc[np.asarray(b_ids, dtype=np.int64)].reset_index(drop=True)
+
+    return pd.concat(
+        [left[key_columns], left[cols_a].add_suffix("_a"), right[cols_b].add_suffix("_b"),
+         right[list(b_key_columns)].add_suffix("_b")],
+        axis=1
+    )
+
+
+def read_candidate_pairs(path, chunk_size=500_000):
+    """
+    Legge un file di candidate pairs a chunk e restituisce DataFrame nel formato B1.
+    Accetta il CSV completo, il formato compatto (..._pairs.bin), di cui unisce
+    gli attributi dalle tabelle dei record solo al momento della lettura,
+    e il manifest JSON del blocking parallelo (legge gli shard in sequenza).
+    """
+    if is_manifest(path):
+        for shard in load_manifest(path):
+            if shard["pairs"] > 0:
+                yield from read_candidate_pairs(shard["path"], chunk_size)
+        return
+
+    if not is_compact_pairs(path):
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype=str)
+        return
+
+    df_a, df_b, meta = load_compact_tables(compact_prefix(path))
+    pairs = load_pair_ids(path)
+
+    for start in range(0, len(pairs), chunk_size):
+        block = pairs[start:start + chunk_size]
+        yield pairs_to_frame(df_a, df_b, block[:, 0], block[:, 1],
+                             key_columns=meta["key_columns"], b_key_columns=meta["b_key_columns"])
+
+
+def compact_prefix(pairs_file):
+    """Prefisso di un output compatto dal percorso di <prefix>_pairs.bin."""
+    return str(pairs_file)[:-len("_pairs.bin")]
+
+
+def load_compact_tables(prefix):
+    """Tabelle dei record di A e B (con id) e metadati di un output compatto."""
+    paths = compact_pair_paths(prefix)
+    df_a = pd.read_csv(paths["records_a"], dtype=str)
+    df_b = pd.read_csv(paths["records_b"], dtype=str)
+    return df_a, df_b, load_compact_meta(prefix)
+
+
+# ----------------------------------------------------------
+# Lettura parallela: intervalli di byte letti dai worker
+# ----------------------------------------------------------
+CANDIDATE_RANGE_BYTES = 64 * 1024 ** 2
+
+
+def csv_byte_ranges(path, range_bytes=CANDIDATE_RANGE_BYTES):
+    """
+    Divide un CSV (esclusa l'intestazione) in intervalli di byte [inizio, fine) di circa
+    range_bytes, allineati a fine riga. Richiede un record per riga (nessun a capo dentro
+    i campi tra virgolette): read_csv_range lo verifica e altrimenti solleva ValueError.
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as f:
+        f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(max(start, min(start + range_bytes, size) - 1))
+            f.readline()
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def read_csv_range(path, start, end, chunk_size=500_000):
+    """Legge a chunk (dtype=str, con l'intestazione del file) le righe di un intervallo di byte."""
+    with open(path, "rb") as f:
+        header = f.readline()
+        f.seek(start)
+        data = f.read(end - start)
+    if b'"' in data:
+        # un numero dispari di virgolette su una riga = campo tra virgolette che continua a capo:
+        # il record sarebbe diviso tra due intervalli
+        for line_number, line in enumerate(data.split(b"\n")):
+            if line.count(b'"') % 2:
+                raise ValueError(
+                    f"{path}: campo tra virgolette con a capo (byte {start}, riga {line_number + 1} "
+                    f"dell'intervallo); gli intervalli di byte richiedono un record per riga, "
+                    f"usare read_candidate_pairs"
+                )
+    yield from pd.read_csv(io.BytesIO(header + data), dtype=str, chunksize=chunk_size)
+
+
+def candidate_tasks(path, chunk_size=500_000, range_bytes=CANDIDATE_RANGE_BYTES):
+    """
+    Unità di lavoro per i worker su un file di candidate pairs, sempre (percorso, inizio, fine):
+    - CSV (anche gli shard di un manifest): intervallo di byte, il worker legge l'intervallo da sé
+    - formato compatto: intervallo di coppie [inizio, fine) di chunk_size, il worker unisce da sé
+      gli id alle tabelle dei record (il processo principale non legge né invia i record)
+    """
+    if is_manifest(path):
+        for shard in load_manifest(path):
+            if shard["pairs"] > 0:
+                yield from candidate_tasks(shard["path"], chunk_size, range_bytes)
+    elif is_compact_pairs(path):
+        total = len(load_pair_ids(path))
+        for start in range(0, total, chunk_size):
+            yield (str(path), start, min(start + chunk_size, total))
+    else:
+        for start, end in csv_byte_ranges(path, range_bytes):
+            yield (str(path), start, end)
+
+
+# Nei worker: tabelle dei record dei file compatti, lette una volta per processo
+_compact_tables = {}
+
+
+def worker_compact_tables(prefix):
+    """load_compact_tables con cache per processo (rilette se le tabelle sono state riscritte)."""
+    paths = compact_pair_paths(prefix)
+    version = tuple(os.stat(paths[name]).st_mtime_ns for name in ("records_a", "records_b"))
+    cached = _compact_tables.get(prefix)
+    if cached is None or cached[0] != version:
+        cached = _compact_tables[prefix] = (version, load_compact_tables(prefix))
+    return cached[1]
+
+
+def load_candidate_task(task, chunk_size=500_000):
+    """DataFrame (formato B1) di un'unità di lavoro di candidate_tasks."""
+    path, start, end = task
+    if not is_compact_pairs(path):
+        yield from read_csv_range(path, start, end, chunk_size=chunk_size)
+        return
+
+    df_a, df_b, meta = worker_compact_tables(compact_prefix(path))
+    pairs = load_pair_ids(path)
+    for block_start in range(start, end, chunk_size):
+        block = pairs[block_start:min(block_start + chunk_size, end)]
+        yield pairs_to_frame(df_a, df_b, block[:, 0], block[:, 1],
+                             key_columns=meta["key_columns"], b_key_columns=meta["b_key_columns"])
+
+
+def generate_candidate_pairs_B1_compact(
+    file_a,
+    file_b,
+    output_prefix,
+    chunk_size=200_000
+):
+    """
+    Blocking B1 (stesso manufacturer e stesso year) in formato compatto:
+    scrive solo le coppie (a_id, b_id) come uint32 più le tabelle dei record con id.
+    Le coppie sono le stesse di generate_candidate_pairs_B1.
+    """
+    start_time = time.time()
+    paths = compact_pair_paths(output_prefix)
+    keys = ["manufacturer", "year"]
+
+    print("🆔 Assegnazione id ai record...")
+    assign_record_ids(file_a, paths["records_a"], chunk_size)
+    assign_record_ids(file_b, paths["records_b"], chunk_size)
+
+    # in RAM solo le chiavi di blocking di A
+    keys_a = pd.read_csv(file_a, usecols=keys, dtype=str)
+    keys_a["a_id"] = np.arange(len(keys_a))
+    print(f"✔ Record totali in A: {len(keys_a)}")
+
+    total_pairs = 0
+    offset_b = 0
+
+    print("🚀 Inizio scansione file B a chunk...")
+
+    with open(paths["pairs"], "wb") as f_out:
+        for i, chunk_b in enumerate(
+            pd.read_csv(file_b, usecols=keys, chunksize=chunk_size, dtype=str)
+        ):
+            chunk_b["b_id"] = np.arange(offset_b, offset_b + len(chunk_b))
+            offset_b += len(chunk_b)
+
+            merged = pd.merge(keys_a, chunk_b, on=keys, how="inner")
+            write_pair_ids(f_out, merged["a_id"].to_numpy(), merged["b_id"].to_numpy())
+
+            total_pairs += len(merged)
+            print(f"➡ Chunk {i+1}: {len(merged)} coppie | totale {total_pairs}")
+    write_compact_meta(output_prefix)
+
+    size_mb = os.path.getsize(paths["pairs"]) / 1024 ** 2
+
+    print("\n✅ Blocking B1 (compatto) completato")
+    print(f"📁 Coppie: {paths['pairs']} ({size_mb:.1f} MB)")
+    print(f"📁 Record: {paths['records_a']}, {paths['records_b']}")
+    print(f"✔ Totale candidate pairs generate: {total_pairs}")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return total_pairs
+
 def normalize_fuel_type_for_blocking(ft):
     """Normalizza i valori speciali di fuel_type per il blocking."""
     ft = str(ft).strip().lower()
@@ -84,12 +386,74 @@ def normalize_fuel_type_for_blocking(ft):
     else:
         return ft
 
+def iter_block_products(df_a, df_b, block_keys, batch_pairs=500_000, max_block_pairs=None):
+    """
+    Prodotto cartesiano per blocco (stessa chiave block_keys) costruito su array di indici:
+    np.repeat sul lato A e np.tile sul lato B, nello stesso ordine del doppio ciclo
+    (per ogni riga di A tutte le righe di B). Restituisce DataFrame a_* / b_*
+    di al massimo batch_pairs righe.
+    """
+    # posizioni dei record di ogni blocco
+    a_by_block = df_a.groupby(block_keys).indices
+    b_by_block = df_b.groupby(block_keys).indices
+
+    out_a = df_a.add_prefix("a_")
+    out_b = df_b.add_prefix("b_")
+
+    for block_key in sorted(a_by_block):
+
+        idx_b = b_by_block.get(block_key)
+        if idx_b is None:
+            continue
+        idx_a = a_by_block[block_key]
+
+        block_pairs = len(idx_a) * len(idx_b)
+        if max_block_pairs is not None and block_pairs > max_block_pairs:
+            print(f"⚠ Blocco {block_key} sopra il budget: {len(idx_a)} x {len(idx_b)} = "
+                  f"{block_pairs:,} coppie (budget {max_block_pairs:,}), diviso in batch")
+
+        # righe di A per batch, in modo che ogni batch abbia al massimo batch_pairs coppie
+        rows_a_per_batch = max(1, batch_pairs // len(idx_b))
+
+        for start in range(0, len(idx_a), rows_a_per_batch):
+            sub_a = idx_a[start:start + rows_a_per_batch]
+            pos_a = np.repeat(sub_a, len(idx_b))
+            pos_b = np.tile(idx_b, len(sub_a))
+
+            yield pd.concat(
+                [out_a.iloc[pos_a].reset_index(drop=True),
+                 out_b.iloc[pos_b].reset_index(drop=True)],
+                axis=1
+            )
+
+
+def _write_ab_batch(batch, f_out, header):
+    """Scrive un batch a_* / b_* nello stesso formato di csv.DictWriter ('nan' per i mancanti, CRLF)."""
+    batch.to_csv(
+        f_out,
+        index=False,
+        header=header,
+        na_rep="nan",
+        lineterminator="\r\n"
+    )
+
+
 def generate_candidate_pairs_B2(
     file_a,
     file_b,
     output_file,
-    log_every=100_000   # stampa ogni N candidate pairs
+    log_every=100_000,          # stampa ogni N candidate pairs
+    batch_pairs=500_000,        # coppie costruite e scritte per ogni batch
+    max_block_pairs=50_000_000  # budget per blocco: oltre si avvisa e il blocco viene spezzato in batch
 ):
+    """
+    Genera candidate pairs secondo il blocking B2: stessa transmission, stesso year
+    e stesso fuel_type (normalizzato con normalize_fuel_type_for_blocking).
+    - Per ogni blocco il prodotto cartesiano è costruito su array di indici
+      (np.repeat sul lato A, np.tile sul lato B) e scritto in batch
+    - Output: colonne a_* e b_*, stesso formato della scrittura con csv.DictWriter
+      (valori mancanti come 'nan', fine riga CRLF)
+    """
 
     start_time = time.time()
 
@@ -104,60 +468,1992 @@ def generate_candidate_pairs_B2(
     print(f"✔ Record A: {len(df_a)}")
     print(f"✔ Record B: {len(df_b)}")
 
-    a_by_block = {
-        key: g for key, g in df_a.groupby(["transmission", "year", "fuel_type"])
-    }
-
-    b_by_block = {
-        key: g for key, g in df_b.groupby(["transmission", "year", "fuel_type"])
-    }
+    block_keys = ["transmission", "year", "fuel_type"]
 
-    print("🚀 Inizio generazione candidate pairs (streaming)...")
+    print("🚀 Inizio generazione candidate pairs (batch vettoriali)...")
 
     total_pairs = 0
     next_log = log_every
+    header_written = False
 
     with open(output_file, "w", newline="", encoding="utf-8") as f_out:
-        writer = None
 
-        for block_key, block_a in a_by_block.items():
+        for batch in iter_block_products(df_a, df_b, block_keys, batch_pairs, max_block_pairs):
+            _write_ab_batch(batch, f_out, header=not header_written)
+            header_written = True
+            total_pairs += len(batch)
 
-            block_b = b_by_block.get(block_key)
-            if block_b is None:
-                continue
+            # 🔥 LOG PROGRESSIVO
+            if total_pairs >= next_log:
+                elapsed = time.time() - start_time
+                print(f"⏳ {total_pairs:,} candidate pairs scritte | "
+                      f"{elapsed:.1f} sec trascorsi")
+                next_log = (total_pairs // log_every + 1) * log_every
+
+    elapsed_total = time.time() - start_time
 
-            for _, row_a in block_a.iterrows():
-                for _, row_b in block_b.iterrows():
+    print("\n✅ Blocking B2 completato")
+    print(f"✔ Totale candidate pairs generate: {total_pairs:,}")
+    print(f"⏱ Tempo totale: {elapsed_total:.1f} secondi")
 
-                    row_out = {}
+    return total_pairs
 
-                    for c in df_a.columns:
-                        row_out[f"a_{c}"] = row_a[c]
 
-                    for c in df_b.columns:
-                        row_out[f"b_{c}"] = row_b[c]
+# ==========================================================
+# BLOCKING OUT-OF-CORE CON SORT-MERGE ESTERNO
+# ==========================================================
 
-                    if writer is None:
-                        writer = csv.DictWriter(
-                            f_out,
-                            fieldnames=row_out.keys()
-                        )
-                        writer.writeheader()
+def _prepare_B2(df):
+    df["fuel_type"] = df["fuel_type"].apply(normalize_fuel_type_for_blocking)
+    return df
 
-                    writer.writerow(row_out)
-                    total_pairs += 1
 
-                    # 🔥 LOG PROGRESSIVO
-                    if total_pairs >= next_log:
-                        elapsed = time.time() - start_time
-                        print(f"⏳ {total_pairs:,} candidate pairs scritte | "
-                              f"{elapsed:.1f} sec trascorsi")
-                        next_log += log_every
+# Schemi di blocking: chiavi, preparazione dei record e formato di output
+#   layout "B1": chiavi condivise + colonne _a / _b (come generate_candidate_pairs_B1)
+#   layout "AB": tutte le colonne con prefisso a_ / b_ (come generate_candidate_pairs_B2)
+#   dropna: scarta i record con chiave mancante (groupby) invece di farli combaciare (merge)
+BLOCKING_SCHEMES = {
+    "B1": {"keys": ["manufacturer", "year"], "prepare": None, "layout": "B1", "dropna": False},
+    "B2": {"keys": ["transmission", "year", "fuel_type"], "prepare": _prepare_B2, "layout": "AB", "dropna": True},
+}
 
-    elapsed_total = time.time() - start_time
 
-    print("\n✅ Blocking B2 completato")
+def _spill_sorted_runs(path, scheme, chunk_size, tmp_dir, tag):
+    """
+    Legge il file a chunk, ordina ogni chunk sulla chiave di blocking e lo scrive
+    su disco come run ordinata. Restituisce (colonne, lista dei file delle run).
+    """
+    keys = scheme["keys"]
+    columns = None
+    runs = []
+
+    for i, chunk in enumerate(pd.read_csv(path, chunksize=chunk_size, dtype=str)):
+        if scheme["prepare"] is not None:
+            chunk = scheme["prepare"](chunk)
+        if scheme["dropna"]:
+            chunk = chunk.dropna(subset=keys)
+        if columns is None:
+            columns = list(chunk.columns)
+
+        rows = chunk.fillna("").to_numpy(dtype=object).tolist()
+        key_idx = [columns.index(k) for k in keys]
+        rows.sort(key=lambda r: [r[j] for j in key_idx])
+
+        run_path = os.path.join(tmp_dir, f"{tag}_run_{i:05d}.csv")
+        with open(run_path, "w", newline="", encoding="utf-8") as f_run:
+            csv.writer(f_run).writerows(rows)
+        runs.append(run_path)
+        print(f"↳ {tag}: run {i+1} ordinata ({len(rows)} righe)")
+
+    return columns, runs
+
+
+def _iter_merged_runs(run_paths, key_idx):
+    """Fonde le run ordinate (k-way merge) e restituisce le righe in ordine di chiave."""
+    files = [open(p, newline="", encoding="utf-8") for p in run_paths]
+    try:
+        key_of = lambda r: [r[j] for j in key_idx]
+        yield from heapq.merge(*[csv.reader(f) for f in files], key=key_of)
+    finally:
+        for f in files:
+            f.close()
+
+
+def _iter_key_groups(run_paths, key_idx):
+    """Come _iter_merged_runs, ma restituisce i gruppi (chiave, righe) con la stessa chiave."""
+    key_of = lambda r: [r[j] for j in key_idx]
+    for key, rows in itertools.groupby(_iter_merged_runs(run_paths, key_idx), key=key_of):
+        yield key, list(rows)
+
+
+def generate_candidate_pairs_external(
+    file_a,
+    file_b,
+    output_file,
+    scheme="B1",
+    chunk_size=200_000,
+    tmp_dir=None
+):
+    """
+    Blocking out-of-core con sort-merge esterno sulla chiave dello schema (B1 o B2).
+    - Entrambi i file sono letti a chunk e scritti su disco come run ordinate
+    - Le run vengono fuse in streaming e i gruppi con la stessa chiave di A e B
+      sono combinati blocco per blocco
+    - In RAM c'è al massimo un blocco (righe di A e di B con la stessa chiave)
+    Le coppie prodotte sono le stesse di generate_candidate_pairs_B1 / _B2.
+    """
+    start_time = time.time()
+    scheme = BLOCKING_SCHEMES[scheme] if isinstance(scheme, str) else scheme
+    keys = scheme["keys"]
+
+    work_dir = tempfile.mkdtemp(prefix="blocking_runs_", dir=tmp_dir)
+    total_pairs = 0
+    largest_block = 0
+
+    try:
+        print("💾 Creazione run ordinate su disco...")
+        cols_a, runs_a = _spill_sorted_runs(file_a, scheme, chunk_size, work_dir, "a")
+        cols_b, runs_b = _spill_sorted_runs(file_b, scheme, chunk_size, work_dir, "b")
+
+        key_idx_a = [cols_a.index(k) for k in keys]
+        key_idx_b = [cols_b.index(k) for k in keys]
+
+        if scheme["layout"] == "B1":
+            rest_a = [j for j, c in enumerate(cols_a) if c not in keys]
+            rest_b = [j for j, c in enumerate(cols_b) if c not in keys]
+            header = keys + [cols_a[j] + "_a" for j in rest_a] + [cols_b[j] + "_b" for j in rest_b]
+
+            def make_row(row_a, row_b):
+                return [row_a[j] for j in key_idx_a] + [row_a[j] for j in rest_a] + [row_b[j] for j in rest_b]
+        else:
+            header = [f"a_{c}" for c in cols_a] + [f"b_{c}" for c in cols_b]
+
+            # come csv.DictWriter in generate_candidate_pairs_B2: i mancanti diventano 'nan'
+            def make_row(row_a, row_b):
+                return [v if v != "" else "nan" for v in row_a + row_b]
+
+        print("🔀 Merge delle run e generazione candidate pairs...")
+
+        groups_a = _iter_key_groups(runs_a, key_idx_a)
+        groups_b = _iter_key_groups(runs_b, key_idx_b)
+
+        with open(output_file, "w", newline="", encoding="utf-8") as f_out:
+            writer = csv.writer(f_out)
+            writer.writerow(header)
+
+            group_a = next(groups_a, None)
+            group_b = next(groups_b, None)
+
+            while group_a is not None and group_b is not None:
+                key_a, rows_a = group_a
+                key_b, rows_b = group_b
+
+                if key_a < key_b:
+                    group_a = next(groups_a, None)
+                elif key_b < key_a:
+                    group_b = next(groups_b, None)
+                else:
+                    writer.writerows(
+                        make_row(row_a, row_b) for row_a in rows_a for row_b in rows_b
+                    )
+                    total_pairs += len(rows_a) * len(rows_b)
+                    largest_block = max(largest_block, len(rows_a) + len(rows_b))
+                    group_a = next(groups_a, None)
+                    group_b = next(groups_b, None)
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print("\n✅ Blocking esterno completato")
+    print(f"📁 File output: {output_file}")
     print(f"✔ Totale candidate pairs generate: {total_pairs:,}")
-    print(f"⏱ Tempo totale: {elapsed_total:.1f} secondi")
+    print(f"✔ Blocco più grande in RAM: {largest_block:,} record")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return total_pairs
+
+
+# ==========================================================
+# BLOCKING PARALLELO SU PARTIZIONI CON OUTPUT A SHARD
+# ==========================================================
+#
+# Output in output_dir:
+# - shard_XXXXX.csv : candidate pairs di una partizione (formato dello schema)
+# - manifest.json   : schema, elenco degli shard con numero di coppie, totale
+
+MANIFEST_NAME = "manifest.json"
+
+
+def is_manifest(path):
+    return str(path).endswith(".json")
+
+
+def load_manifest(path):
+    """Elenco degli shard del manifest, con percorsi risolti rispetto alla cartella del manifest."""
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    return [
+        {"path": os.path.join(base, shard["file"]), "pairs": shard["pairs"]}
+        for shard in manifest["shards"]
+    ]
+
+
+def partition_file(path, scheme, num_partitions, part_dir, tag, chunk_size, with_ids=False):
+    """
+    Distribuisce i record di un file su num_partitions file CSV in base
+    all'hash della chiave di blocking: record con la stessa chiave finiscono
+    sempre nella stessa partizione.
+    with_ids: aggiunge come prima colonna l'id del record (posizione della riga nel file).
+    """
+    keys = scheme["keys"]
+    part_paths = [os.path.join(part_dir, f"{tag}_part_{p:05d}.csv") for p in range(num_partitions)]
+    written = [False] * num_partitions
+    offset = 0
+
+    for chunk in pd.read_csv(path, chunksize=chunk_size, dtype=str):
+        if with_ids:
+            chunk.insert(0, "id", np.arange(offset, offset + len(chunk)))
+        offset += len(chunk)
+        if scheme["prepare"] is not None:
+            chunk = scheme["prepare"](chunk)
+        if scheme["dropna"]:
+            chunk = chunk.dropna(subset=keys)
+
+        hashes = pd.util.hash_pandas_object(chunk[keys].fillna(""), index=False).to_numpy()
+        partition = hashes % np.uint64(num_partitions)
+
+        for p, part in chunk.groupby(partition):
+            part.to_csv(
+                part_paths[p],
+                mode="a" if written[p] else "w",
+                index=False,
+                header=not written[p]
+            )
+            written[p] = True
+
+    return [pp if w else None for pp, w in zip(part_paths, written)]
+
+
+def _block_partition(part_a, part_b, shard_path, scheme_name):
+    """Worker: blocking di una partizione e scrittura del suo shard. Restituisce (shard, coppie)."""
+    scheme = BLOCKING_SCHEMES[scheme_name]
+    keys = scheme["keys"]
+
+    # solo i campi vuoti sono mancanti: il fuel_type normalizzato 'nan' di B2 resta una chiave valida
+    df_a = pd.read_csv(part_a, dtype=str, keep_default_na=False, na_values=[""])
+    df_b = pd.read_csv(part_b, dtype=str, keep_default_na=False, na_values=[""])
+    total_pairs = 0
+
+    if scheme["layout"] == "B1":
+        merged = pd.merge(df_a, df_b, on=keys, how="inner", suffixes=("_a", "_b"))
+        cols_a = [c + "_a" for c in df_a.columns if c not in keys]
+        cols_b = [c + "_b" for c in df_b.columns if c not in keys]
+        merged[keys + cols_a + cols_b].to_csv(shard_path, index=False)
+        total_pairs = len(merged)
+    else:
+        with open(shard_path, "w", newline="", encoding="utf-8") as f_out:
+            for batch in iter_block_products(df_a, df_b, keys):
+                _write_ab_batch(batch, f_out, header=(total_pairs == 0))
+                total_pairs += len(batch)
+
+    return shard_path, total_pairs
+
+
+def generate_candidate_pairs_parallel(
+    file_a,
+    file_b,
+    output_dir,
+    scheme="B1",
+    num_partitions=32,
+    max_workers=8,
+    chunk_size=200_000
+):
+    """
+    Blocking parallelo (schema B1 o B2): i record di A e B sono partizionati su
+    disco per hash della chiave di blocking, ogni partizione è elaborata da un
+    worker di un ProcessPoolExecutor che scrive il proprio shard, e alla fine
+    viene scritto manifest.json con shard e numero di coppie.
+    Il manifest si può passare direttamente a record_linkage e check_candidate_pairs.
+    """
+    start_time = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+    part_dir = os.path.join(output_dir, "_partitions")
+    os.makedirs(part_dir, exist_ok=True)
+    scheme_def = BLOCKING_SCHEMES[scheme]
+
+    shards = []
+    try:
+        print(f"🧩 Partizionamento su {num_partitions} partizioni...")
+        parts_a = partition_file(file_a, scheme_def, num_partitions, part_dir, "a", chunk_size)
+        parts_b = partition_file(file_b, scheme_def, num_partitions, part_dir, "b", chunk_size)
+
+        print(f"🚀 Blocking delle partizioni con {max_workers} worker...")
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    _block_partition, part_a, part_b,
+                    os.path.join(output_dir, f"shard_{p:05d}.csv"), scheme
+                )
+                for p, (part_a, part_b) in enumerate(zip(parts_a, parts_b))
+                if part_a is not None and part_b is not None
+            ]
+            for future in as_completed(futures):
+                shard_path, pairs = future.result()
+                shards.append({"file": os.path.basename(shard_path), "pairs": pairs})
+                print(f"↳ {os.path.basename(shard_path)}: {pairs:,} coppie")
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+    shards.sort(key=lambda shard: shard["file"])
+    total_pairs = sum(shard["pairs"] for shard in shards)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "scheme": scheme,
+            "layout": scheme_def["layout"],
+            "shards": shards,
+            "total_pairs": total_pairs,
+        }, f, indent=2)
+
+    print("\n✅ Blocking parallelo completato")
+    print(f"📁 Manifest: {manifest_path} ({len(shards)} shard)")
+    print(f"✔ Totale candidate pairs generate: {total_pairs:,}")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return manifest_path
+
+
+# ==========================================================
+# ANALISI DELLA QUALITÀ DEL BLOCKING SENZA GENERARE LE COPPIE
+# ==========================================================
+
+KEY_SEP = "\x1f"
+
+
+def make_blocking_key(columns, normalizers=None, dropna=False):
+    """
+    Crea una funzione di blocking key: DataFrame -> Series di chiavi (stringhe).
+    - normalizers: {colonna: funzione} applicata ai valori prima di formare la chiave
+      (es. {"fuel_type": normalize_fuel_type_for_blocking})
+    - dropna: i record con un campo chiave mancante non finiscono in nessun blocco (chiave NaN);
+      altrimenti il mancante vale '' e combacia con gli altri mancanti, come in pd.merge
+    """
+    columns = list(columns)
+    normalizers = normalizers or {}
+
+    def key_fn(df):
+        parts = df[columns].copy()
+        for col, fn in normalizers.items():
+            # normalizzazione calcolata una volta per valore distinto (mancanti compresi, come .apply)
+            codes, uniques = pd.factorize(parts[col])
+            mapped = np.array([fn(v) for v in uniques] + [fn(np.nan)], dtype=object)
+            parts[col] = mapped[codes]
+        missing = parts.isna().any(axis=1)
+        values = [parts[c].fillna("").astype(str) for c in columns]
+        keys = values[0].str.cat(values[1:], sep=KEY_SEP).astype(object)
+        if dropna:
+            keys[missing] = np.nan
+        return keys
+
+    key_fn.columns = columns
+    key_fn.__name__ = "+".join(columns)
+    return key_fn
+
+
+def scheme_key(scheme):
+    """Blocking key di uno schema di BLOCKING_SCHEMES (stesse chiavi, normalizzazione e mancanti)."""
+    scheme_def = BLOCKING_SCHEMES[scheme]
+    normalizers = {"fuel_type": normalize_fuel_type_for_blocking} if scheme_def["prepare"] is _prepare_B2 else None
+    return make_blocking_key(scheme_def["keys"], normalizers, dropna=scheme_def["dropna"])
+
+
+def _resolve_key(key):
+    return scheme_key(key) if isinstance(key, str) else key
+
+
+def block_counts(path, key, chunk_size=500_000):
+    """Numero di record per blocco di un file, letto a chunk. Restituisce (Series chiave -> count, record totali)."""
+    key_fn = _resolve_key(key)
+    usecols = getattr(key_fn, "columns", None)
+    counts = None
+    total = 0
+
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunk_size, dtype=str):
+        chunk_counts = key_fn(chunk).value_counts(dropna=True)
+        counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value=0)
+        total += len(chunk)
+
+    if counts is None:
+        counts = pd.Series(dtype="int64")
+    return counts.astype("int64"), total
+
+
+def ground_truth_sides(df_gt):
+    """Separa una ground truth a_* / b_* nei due lati con i nomi dello schema mediato."""
+    side_a = df_gt[[c for c in df_gt.columns if c.startswith("a_")]].rename(columns=lambda c: c[2:])
+    side_b = df_gt[[c for c in df_gt.columns if c.startswith("b_")]].rename(columns=lambda c: c[2:])
+    return side_a, side_b
+
+
+def pairs_in_same_block(df_gt, key):
+    """Maschera booleana: la coppia della ground truth finisce nello stesso blocco."""
+    key_fn = _resolve_key(key)
+    side_a, side_b = ground_truth_sides(df_gt)
+    key_a = key_fn(side_a).reset_index(drop=True)
+    key_b = key_fn(side_b).reset_index(drop=True)
+    return (key_a.notna() & (key_a == key_b)).to_numpy()
+
+
+def pair_completeness(gt_files, key):
+    """Pair completeness (quota dei match della ground truth nello stesso blocco) per ciascun file."""
+    results = {}
+    for gt_file in gt_files:
+        if not os.path.exists(gt_file):
+            print(f"⚠ Ground truth non trovata, salto: {gt_file}")
+            continue
+        df_gt = pd.read_csv(gt_file, dtype=str)
+        same_block = pairs_in_same_block(df_gt, key)
+        is_match = (df_gt["match"].astype(str).str.strip() == "1").to_numpy()
+        results[gt_file] = {
+            "matches": int(is_match.sum()),
+            "matches_in_block": int((same_block & is_match).sum()),
+            "pair_completeness": float((same_block & is_match).sum() / is_match.sum()) if is_match.any() else 0.0,
+            "labeled_in_block": float(same_block.mean()) if len(same_block) else 0.0,
+        }
+    return results
+
+
+def analyze_blocking(
+    file_a,
+    file_b,
+    key="B1",
+    ground_truth=("test.csv", "validation.csv"),
+    chunk_size=500_000,
+    top_blocks=10
+):
+    """
+    Report analitico di uno schema di blocking calcolato solo dai conteggi per blocco:
+    - candidate pairs = somma su k di |A_k| * |B_k|
+    - reduction ratio = 1 - candidate / (|A| * |B|)
+    - pair completeness sui match della ground truth (chiave di a_ uguale a quella di b_)
+    - istogramma delle dimensioni dei blocchi (coppie per blocco, per potenze di 10)
+    key: nome dello schema ("B1", "B2") o funzione DataFrame -> Series di chiavi
+    """
+    start_time = time.time()
+
+    counts_a, total_a = block_counts(file_a, key, chunk_size)
+    counts_b, total_b = block_counts(file_b, key, chunk_size)
+
+    joint = pd.concat([counts_a.rename("a"), counts_b.rename("b")], axis=1, join="inner")
+    block_pairs = joint["a"].astype("int64") * joint["b"].astype("int64")
+    candidates = int(block_pairs.sum())
+    cartesian = total_a * total_b
+    reduction_ratio = 1 - candidates / cartesian if cartesian else 0.0
+
+    # istogramma: blocchi per ordine di grandezza del numero di coppie
+    magnitude = np.floor(np.log10(block_pairs.to_numpy(dtype=float))).astype(int) if len(block_pairs) else np.array([], dtype=int)
+    histogram = {}
+    for m in np.unique(magnitude):
+        in_bin = magnitude == m
+        histogram[f"[1e{m}, 1e{m + 1})"] = {
+            "blocks": int(in_bin.sum()),
+            "pairs": int(block_pairs.to_numpy()[in_bin].sum()),
+        }
+
+    completeness = pair_completeness(ground_truth, key)
+
+    print("=" * 80)
+    print(f"ANALISI BLOCKING: {key if isinstance(key, str) else getattr(key, '__name__', 'custom')}")
+    print("=" * 80)
+    print(f"Record A: {total_a:,} | Record B: {total_b:,}")
+    print(f"Blocchi A: {len(counts_a):,} | Blocchi B: {len(counts_b):,} | Blocchi in comune: {len(joint):,}")
+    print(f"Candidate pairs: {candidates:,}")
+    print(f"Reduction ratio: {reduction_ratio:.6f}")
+    for gt_file, res in completeness.items():
+        print(f"Pair completeness {gt_file}: {res['pair_completeness']:.4f} "
+              f"({res['matches_in_block']}/{res['matches']} match)")
+    print("\nIstogramma coppie per blocco:")
+    for label, h in histogram.items():
+        print(f"  {label:>14}: {h['blocks']:>8,} blocchi, {h['pairs']:>16,} coppie")
+    print("\nBlocchi più grandi:")
+    for block_key, pairs in block_pairs.sort_values(ascending=False).head(top_blocks).items():
+        print(f"  {str(block_key).replace(KEY_SEP, ' | '):<40} {joint.loc[block_key, 'a']:>8,} x {joint.loc[block_key, 'b']:>8,} = {pairs:,}")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return {
+        "records_a": total_a,
+        "records_b": total_b,
+        "blocks": len(joint),
+        "candidate_pairs": candidates,
+        "reduction_ratio": reduction_ratio,
+        "pair_completeness": completeness,
+        "histogram": histogram,
+        "block_pairs": block_pairs,
+    }
+
+
+# ==========================================================
+# SPLIT DEI BLOCCHI TROPPO GRANDI (SKEW) SU CHIAVI SECONDARIE
+# ==========================================================
+
+def _class_key(column, classes):
+    def key(df):
+        # classi di equivalenza delle regole (linkage_rules): i valori equivalenti restano nello stesso sotto-blocco
+        values = df[column].fillna("").astype(str).str.strip().str.lower()
+        return values.map(lambda v: classes.get(v, v))
+    key.columns = [column]
+    return key
+
+
+def _model_prefix_key(n=3):
+    def key(df):
+        # "f-150 xlt" e "f150" -> "f15"
+        return (df["model"].fillna("").astype(str).str.lower()
+                .str.replace(r"[^0-9a-z]", "", regex=True).str[:n])
+    key.columns = ["model"]
+    return key
+
+
+# Chiavi secondarie per lo split, nell'ordine di applicazione di default
+SECONDARY_KEYS = {
+    "body_type": _class_key("body_type", BODY_CLASSES),
+    "drive": _class_key("drive", DRIVE_CLASSES),
+    "model_prefix": _model_prefix_key(3),
+}
+
+
+def make_split_key(key, plan):
+    """
+    Blocking key con lo split applicato: per ogni livello del piano, i record che
+    stanno in un blocco troppo grande ricevono in coda alla chiave la chiave secondaria.
+    plan: lista di (nome chiave secondaria, insieme dei blocchi da dividere).
+    """
+    base_fn = _resolve_key(key)
+    columns = list(getattr(base_fn, "columns", []))
+    for secondary, _ in plan:
+        columns += [c for c in SECONDARY_KEYS[secondary].columns if c not in columns]
+
+    def key_fn(df):
+        keys = base_fn(df).copy()
+        for secondary, oversized in plan:
+            mask = keys.isin(oversized)
+            if mask.any():
+                keys[mask] = keys[mask] + KEY_SEP + SECONDARY_KEYS[secondary](df[mask])
+        return keys
+
+    key_fn.columns = columns
+    key_fn.__name__ = f"{getattr(base_fn, '__name__', 'key')} (split)"
+    return key_fn
+
+
+def plan_block_splits(
+    file_a,
+    file_b,
+    key="B1",
+    max_block_pairs=10_000_000,
+    secondary=("body_type", "drive", "model_prefix"),
+    chunk_size=500_000
+):
+    """
+    Piano di split ricorsivo: i blocchi con |A|*|B| > max_block_pairs vengono divisi
+    sulla prima chiave secondaria; i sotto-blocchi ancora troppo grandi sulla successiva, ecc.
+    Usa solo i conteggi per blocco. Restituisce il piano per make_split_key.
+    """
+    plan = []
+    for secondary_key in secondary:
+        key_fn = make_split_key(key, plan)
+        counts_a, _ = block_counts(file_a, key_fn, chunk_size)
+        counts_b, _ = block_counts(file_b, key_fn, chunk_size)
+        joint = pd.concat([counts_a.rename("a"), counts_b.rename("b")], axis=1, join="inner")
+        block_pairs = joint["a"].astype("int64") * joint["b"].astype("int64")
+        oversized = set(block_pairs.index[block_pairs > max_block_pairs])
+
+        if not oversized:
+            break
+        print(f"✂ {len(oversized)} blocchi sopra il budget ({int(block_pairs[list(oversized)].sum()):,} coppie) "
+              f"-> split su {secondary_key}")
+        plan.append((secondary_key, oversized))
+
+    return plan
+
+
+def generate_candidate_pairs_B1_split(
+    file_a,
+    file_b,
+    output_file,
+    max_block_pairs=10_000_000,
+    secondary=("body_type", "drive", "model_prefix"),
+    ground_truth=("test.csv",),
+    chunk_size=200_000
+):
+    """
+    Blocking B1 con split dei blocchi troppo grandi (vedi plan_block_splits).
+    Output nello stesso formato di generate_candidate_pairs_B1; stampa quante
+    coppie sono state risparmiate e quanta pair completeness è costata sulla ground truth.
+    """
+    start_time = time.time()
+
+    plan = plan_block_splits(file_a, file_b, "B1", max_block_pairs, secondary, chunk_size)
+    split_key = make_split_key("B1", plan)
+
+    print(f"📥 Caricamento file A in RAM: {file_a}")
+    df_a = pd.read_csv(file_a, dtype=str)
+    keys_a = pd.DataFrame({"_block": split_key(df_a).to_numpy(), "a_pos": np.arange(len(df_a))})
+
+    total_pairs = 0
+    first_chunk = True
+
+    for i, chunk_b in enumerate(pd.read_csv(file_b, chunksize=chunk_size, dtype=str)):
+        keys_b = pd.DataFrame({"_block": split_key(chunk_b).to_numpy(), "b_pos": np.arange(len(chunk_b))})
+        merged = pd.merge(keys_a, keys_b, on="_block", how="inner")
+        total_pairs += len(merged)
+        print(f"➡ Chunk {i+1}: {len(merged)} coppie | totale {total_pairs}")
+
+        if len(merged) == 0:
+            continue
+
+        pairs_to_frame(df_a, chunk_b, merged["a_pos"].to_numpy(), merged["b_pos"].to_numpy()).to_csv(
+            output_file,
+            mode="w" if first_chunk else "a",
+            index=False,
+            header=first_chunk
+        )
+        first_chunk = False
+
+    # confronto con il B1 originale, solo dai conteggi
+    counts_a, _ = block_counts(file_a, "B1")
+    counts_b, _ = block_counts(file_b, "B1")
+    joint = pd.concat([counts_a.rename("a"), counts_b.rename("b")], axis=1, join="inner")
+    pairs_before = int((joint["a"].astype("int64") * joint["b"].astype("int64")).sum())
+
+    pc_before = pair_completeness(ground_truth, "B1")
+    pc_after = pair_completeness(ground_truth, split_key)
+
+    print("\n✅ Blocking B1 con split completato")
+    print(f"📁 File output: {output_file}")
+    print(f"✔ Candidate pairs: {total_pairs:,} (B1: {pairs_before:,}, risparmiate {pairs_before - total_pairs:,})")
+    for gt_file in pc_after:
+        before = pc_before[gt_file]["pair_completeness"]
+        after = pc_after[gt_file]["pair_completeness"]
+        print(f"✔ Pair completeness {gt_file}: {before:.4f} -> {after:.4f} (costo {before - after:.4f})")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return {
+        "plan": plan,
+        "candidate_pairs": total_pairs,
+        "pairs_saved": pairs_before - total_pairs,
+        "pair_completeness_before": pc_before,
+        "pair_completeness_after": pc_after,
+    }
+
+
+# ==========================================================
+# TOKEN BLOCKING SUL CAMPO MODEL (INDICE INVERTITO + PURGING)
+# ==========================================================
+
+# stessi token di TfidfVectorizer (parole di almeno 2 caratteri) usato da score_model
+MODEL_TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+# colonne lette da model_token_keys
+MODEL_TOKEN_COLUMNS = ["manufacturer", "model"]
+
+
+def model_token_keys(df):
+    """
+    Chiavi di token blocking di ogni record: manufacturer + token del model.
+    Restituisce una Series (indice = posizione del record) con una riga per token distinto.
+    """
+    manufacturer = df["manufacturer"].fillna("").astype(str).reset_index(drop=True)
+    tokens = df["model"].fillna("").astype(str).str.lower().str.findall(MODEL_TOKEN_PATTERN).reset_index(drop=True)
+    exploded = tokens.explode().dropna()
+    keys = manufacturer.loc[exploded.index] + KEY_SEP + exploded.astype(str)
+    return keys[~keys.reset_index().duplicated().to_numpy()]
+
+
+def _token_postings(path, chunk_size):
+    """Liste di posting (chiave token, id record) di un file, con id = posizione della riga."""
+    postings = []
+    offset = 0
+    for chunk in pd.read_csv(path, usecols=MODEL_TOKEN_COLUMNS, chunksize=chunk_size, dtype=str):
+        keys = model_token_keys(chunk)
+        postings.append(pd.DataFrame({"key": keys.to_numpy(), "id": keys.index.to_numpy() + offset}))
+        offset += len(chunk)
+    return pd.concat(postings, ignore_index=True), offset
+
+
+def token_blocking_pair_completeness(gt_files, kept_keys):
+    """Quota dei match della ground truth che condividono almeno un token non eliminato."""
+    results = {}
+    for gt_file in gt_files:
+        if not os.path.exists(gt_file):
+            print(f"⚠ Ground truth non trovata, salto: {gt_file}")
+            continue
+        df_gt = pd.read_csv(gt_file, dtype=str)
+        df_gt = df_gt[df_gt["match"].astype(str).str.strip() == "1"].reset_index(drop=True)
+        side_a, side_b = ground_truth_sides(df_gt)
+        keys_a = model_token_keys(side_a)
+        keys_b = model_token_keys(side_b)
+        shared = pd.merge(
+            pd.DataFrame({"key": keys_a.to_numpy(), "row": keys_a.index}),
+            pd.DataFrame({"key": keys_b.to_numpy(), "row": keys_b.index}),
+            on=["key", "row"]
+        )
+        covered = shared.loc[shared["key"].isin(kept_keys), "row"].nunique()
+        results[gt_file] = {
+            "matches": len(df_gt),
+            "matches_in_block": int(covered),
+            "pair_completeness": covered / len(df_gt) if len(df_gt) else 0.0,
+        }
+    return results
+
+
+def generate_candidate_pairs_token(
+    file_a,
+    file_b,
+    output_prefix,
+    max_posting=1_000,
+    batch_pairs=20_000_000,
+    ground_truth=("test.csv",),
+    chunk_size=500_000
+):
+    """
+    Token blocking sul model, nel perimetro dello stesso manufacturer:
+    - indice invertito (manufacturer, token) -> id dei record, per A e per B
+    - purging: i token con una posting list più lunga di max_posting (in A o in B) vengono scartati
+    - le coppie prodotte da più token in comune sono deduplicate
+    Output nel formato compatto (output_prefix_pairs.bin + tabelle dei record).
+    """
+    start_time = time.time()
+    paths = compact_pair_paths(output_prefix)
+
+    print("📚 Costruzione indice invertito sui token di model...")
+    postings_a, total_a = _token_postings(file_a, chunk_size)
+    postings_b, total_b = _token_postings(file_b, chunk_size)
+
+    sizes = pd.concat(
+        [postings_a["key"].value_counts().rename("a"), postings_b["key"].value_counts().rename("b")],
+        axis=1, join="inner"
+    )
+    purged = sizes[(sizes["a"] > max_posting) | (sizes["b"] > max_posting)]
+    kept = sizes.drop(index=purged.index)
+    print(f"✔ Token in comune: {len(sizes):,} | eliminati dal purging: {len(purged):,} "
+          f"({int((purged['a'] * purged['b']).sum()):,} coppie evitate)")
+
+    # i token vengono elaborati a gruppi di al massimo batch_pairs coppie (prima della deduplica)
+    block_pairs = (kept["a"] * kept["b"]).astype("int64")
+    batch_of = (block_pairs.cumsum() // batch_pairs).rename("batch")
+    postings_a = postings_a.join(batch_of, on="key", how="inner")
+    postings_b = postings_b.join(batch_of, on="key", how="inner")
+
+    pair_codes = np.empty(0, dtype=np.int64)
+    for batch, part_a in postings_a.groupby("batch"):
+        part_b = postings_b[postings_b["batch"] == batch]
+        merged = pd.merge(part_a[["key", "id"]], part_b[["key", "id"]], on="key", suffixes=("_a", "_b"))
+        codes = merged["id_a"].to_numpy(dtype=np.int64) * total_b + merged["id_b"].to_numpy(dtype=np.int64)
+        pair_codes = np.union1d(pair_codes, codes)
+        print(f"↳ batch {batch + 1}: {len(merged):,} coppie dai token, {len(pair_codes):,} distinte finora")
+
+    print("🆔 Scrittura output compatto...")
+    assign_record_ids(file_a, paths["records_a"], chunk_size)
+    assign_record_ids(file_b, paths["records_b"], chunk_size)
+    with open(paths["pairs"], "wb") as f_out:
+        write_pair_ids(f_out, pair_codes // total_b, pair_codes % total_b)
+    # stesso manufacturer ma year libero: il lato B conserva il proprio year
+    write_compact_meta(output_prefix, b_key_columns=("year",))
+
+    # confronto con B1, solo dai conteggi
+    counts_a, _ = block_counts(file_a, "B1")
+    counts_b, _ = block_counts(file_b, "B1")
+    joint = pd.concat([counts_a.rename("a"), counts_b.rename("b")], axis=1, join="inner")
+    pairs_b1 = int((joint["a"].astype("int64") * joint["b"].astype("int64")).sum())
+
+    pc_token = token_blocking_pair_completeness(ground_truth, set(kept.index))
+    pc_b1 = pair_completeness(ground_truth, "B1")
+
+    print("\n✅ Token blocking completato")
+    print(f"📁 Coppie: {paths['pairs']}")
+    print(f"✔ Candidate pairs: {len(pair_codes):,} (B1: {pairs_b1:,})")
+    for gt_file, res in pc_token.items():
+        print(f"✔ Pair completeness {gt_file}: {res['pair_completeness']:.4f} "
+              f"(B1: {pc_b1[gt_file]['pair_completeness']:.4f})")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return {
+        "candidate_pairs": len(pair_codes),
+        "purged_tokens": len(purged),
+        "pair_completeness": pc_token,
+    }
+
+
+# ==========================================================
+# MINHASH LSH SU SHINGLE DI CARATTERI
+# ==========================================================
+
+# primo minore di 2^32: (a * x + b) % MINHASH_PRIME sta in uint32 e a * x + b non supera uint64
+MINHASH_PRIME = np.uint64(4294967291)
+
+
+def record_shingles(text, shingle_size=3):
+    """Hash crc32 (uint32) degli shingle di caratteri del testo normalizzato ("f-150 xlt" -> "f150 xlt")."""
+    text = re.sub(r"\s+", " ", re.sub(r"[^0-9a-z ]", "", str(text).lower())).strip()
+    if not text:
+        return np.empty(0, dtype=np.uint32)
+    if len(text) < shingle_size:
+        grams = {text}
+    else:
+        grams = {text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint32, count=len(grams))
+
+
+def minhash_signatures(texts, num_perm=64, shingle_size=3, batch_size=5_000, seed=42):
+    """
+    Firme MinHash (matrice uint32 n x num_perm) calcolate a batch con NumPy.
+    Le righe dei testi senza shingle restano al valore massimo e vanno escluse dai bucket.
+    Restituisce (firme, maschera dei record con almeno uno shingle).
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 2 ** 32 - 5, size=num_perm, dtype=np.int64).astype(np.uint64)
+    b = rng.randint(0, 2 ** 32 - 5, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+    texts = list(texts)
+    signatures = np.full((len(texts), num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    has_shingles = np.zeros(len(texts), dtype=bool)
+
+    for start in range(0, len(texts), batch_size):
+        shingles = [record_shingles(t, shingle_size) for t in texts[start:start + batch_size]]
+        lengths = np.array([len(sh) for sh in shingles])
+        non_empty = np.flatnonzero(lengths)
+        if len(non_empty) == 0:
+            continue
+
+        flat = np.concatenate([shingles[i] for i in non_empty]).astype(np.uint64)
+        offsets = np.concatenate([[0], np.cumsum(lengths[non_empty])[:-1]])
+
+        hashed = (flat[:, None] * a[None, :] + b[None, :]) % MINHASH_PRIME
+        signatures[start + non_empty] = np.minimum.reduceat(hashed, offsets, axis=0).astype(np.uint32)
+        has_shingles[start + non_empty] = True
+
+    return signatures, has_shingles
+
+
+def _lsh_text(df, text_columns):
+    values = [df[c].fillna("").astype(str) for c in text_columns]
+    return values[0].str.cat(values[1:], sep=" ") if len(values) > 1 else values[0]
+
+
+def lsh_bucket_keys(signatures, scope_codes, bands, rows):
+    """Per ogni banda, hash uint64 del bucket (righe della banda + perimetro del record)."""
+    keys = []
+    for band in range(bands):
+        band_frame = pd.DataFrame(signatures[:, band * rows:(band + 1) * rows])
+        band_frame["scope"] = scope_codes
+        keys.append(pd.util.hash_pandas_object(band_frame, index=False).to_numpy())
+    return keys
+
+
+def generate_candidate_pairs_lsh(
+    file_a,
+    file_b,
+    output_file,
+    bands=16,
+    rows=4,
+    shingle_size=3,
+    text_columns=("model",),
+    scope=("manufacturer", "year"),
+    max_bucket_pairs=None,
+    ground_truth=("test.csv",),
+    batch_size=5_000,
+    write_batch=500_000
+):
+    """
+    Blocking MinHash LSH su shingle di caratteri del model:
+    - firme MinHash (bands * rows permutazioni) calcolate a batch e salvate come matrici uint32
+    - per ogni banda i record con la stessa porzione di firma (e stesso perimetro scope)
+      finiscono nello stesso bucket; le coppie A x B dei bucket sono unite e deduplicate
+    - coppia candidata con probabilità ~ 1 - (1 - J^rows)^bands per Jaccard J
+    Output nello stesso formato di generate_candidate_pairs_B1; se year o manufacturer
+    non fanno parte di scope viene aggiunta anche la colonna <chiave>_b.
+    """
+    start_time = time.time()
+    num_perm = bands * rows
+    scope = list(scope)
+
+    print("📥 Caricamento record...")
+    df_a = pd.read_csv(file_a, dtype=str)
+    df_b = pd.read_csv(file_b, dtype=str)
+
+    print(f"🔏 Firme MinHash ({num_perm} permutazioni)...")
+    sig_a, valid_a = minhash_signatures(_lsh_text(df_a, text_columns), num_perm, shingle_size, batch_size)
+    sig_b, valid_b = minhash_signatures(_lsh_text(df_b, text_columns), num_perm, shingle_size, batch_size)
+    np.save(f"{output_file}.sig_a.npy", sig_a)
+    np.save(f"{output_file}.sig_b.npy", sig_b)
+
+    # perimetro (es. manufacturer + year) come codice intero condiviso tra A e B
+    scope_fn = make_blocking_key(scope)
+    scope_codes, _ = pd.factorize(pd.concat([scope_fn(df_a), scope_fn(df_b)], ignore_index=True))
+    scope_a, scope_b = scope_codes[:len(df_a)], scope_codes[len(df_a):]
+
+    buckets_a = lsh_bucket_keys(sig_a, scope_a, bands, rows)
+    buckets_b = lsh_bucket_keys(sig_b, scope_b, bands, rows)
+    ids_a = np.flatnonzero(valid_a)
+    ids_b = np.flatnonzero(valid_b)
+
+    print("🪣 Generazione coppie dai bucket...")
+    pair_codes = np.empty(0, dtype=np.int64)
+    for band in range(bands):
+        bucket_a = pd.DataFrame({"bucket": buckets_a[band][ids_a], "a": ids_a})
+        bucket_b = pd.DataFrame({"bucket": buckets_b[band][ids_b], "b": ids_b})
+        if max_bucket_pairs is not None:
+            sizes = pd.concat([bucket_a["bucket"].value_counts().rename("na"),
+                               bucket_b["bucket"].value_counts().rename("nb")], axis=1, join="inner")
+            too_big = sizes.index[sizes["na"] * sizes["nb"] > max_bucket_pairs]
+            bucket_a = bucket_a[~bucket_a["bucket"].isin(too_big)]
+        merged = pd.merge(bucket_a, bucket_b, on="bucket")
+        codes = merged["a"].to_numpy(dtype=np.int64) * len(df_b) + merged["b"].to_numpy(dtype=np.int64)
+        pair_codes = np.union1d(pair_codes, codes)
+        print(f"↳ banda {band + 1}/{bands}: {len(merged):,} coppie, {len(pair_codes):,} distinte finora")
+
+    b_key_columns = [k for k in ("manufacturer", "year") if k not in scope]
+    for start in range(0, len(pair_codes), write_batch):
+        codes = pair_codes[start:start + write_batch]
+        pairs_to_frame(df_a, df_b, codes // len(df_b), codes % len(df_b), b_key_columns=b_key_columns).to_csv(
+            output_file,
+            mode="w" if start == 0 else "a",
+            index=False,
+            header=(start == 0)
+        )
+
+    completeness = lsh_pair_completeness(ground_truth, bands, rows, shingle_size, text_columns, scope, batch_size)
+
+    print("\n✅ Blocking MinHash LSH completato")
+    print(f"📁 File output: {output_file}")
+    print(f"✔ Totale candidate pairs generate: {len(pair_codes):,}")
+    for gt_file, res in completeness.items():
+        print(f"✔ Pair completeness {gt_file}: {res['pair_completeness']:.4f} "
+              f"({res['matches_in_block']}/{res['matches']} match)")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return {"candidate_pairs": len(pair_codes), "pair_completeness": completeness}
+
+
+def lsh_pair_completeness(gt_files, bands, rows, shingle_size=3, text_columns=("model",),
+                          scope=("manufacturer", "year"), batch_size=5_000):
+    """Quota dei match della ground truth che cadono nello stesso bucket in almeno una banda."""
+    results = {}
+    scope_fn = make_blocking_key(list(scope))
+    for gt_file in gt_files:
+        if not os.path.exists(gt_file):
+            print(f"⚠ Ground truth non trovata, salto: {gt_file}")
+            continue
+        df_gt = pd.read_csv(gt_file, dtype=str)
+        df_gt = df_gt[df_gt["match"].astype(str).str.strip() == "1"].reset_index(drop=True)
+        side_a, side_b = ground_truth_sides(df_gt)
+        sig_a, valid_a = minhash_signatures(_lsh_text(side_a, text_columns), bands * rows, shingle_size, batch_size)
+        sig_b, valid_b = minhash_signatures(_lsh_text(side_b, text_columns), bands * rows, shingle_size, batch_size)
+
+        band_equal = (sig_a == sig_b).reshape(len(df_gt), bands, rows).all(axis=2).any(axis=1)
+        covered = band_equal & valid_a & valid_b & (scope_fn(side_a) == scope_fn(side_b)).to_numpy()
+        results[gt_file] = {
+            "matches": len(df_gt),
+            "matches_in_block": int(covered.sum()),
+            "pair_completeness": float(covered.mean()) if len(df_gt) else 0.0,
+        }
+    return results
+
+
+# ==========================================================
+# SORTED NEIGHBORHOOD CON FINESTRA SCORREVOLE
+# ==========================================================
+
+def _norm_text(df, column):
+    return df[column].fillna("").astype(str).str.lower().str.replace(r"[^0-9a-z]", "", regex=True)
+
+
+def _sort_key(*columns):
+    def key(df):
+        values = [_norm_text(df, c) for c in columns]
+        return values[0].str.cat(values[1:], sep=" ")
+    key.columns = list(columns)
+    key.__name__ = "+".join(columns)
+    return key
+
+
+# Chiavi di ordinamento composite per le passate del sorted neighborhood
+SORT_KEYS = {
+    "manufacturer_model_year": _sort_key("manufacturer", "model", "year"),
+    "manufacturer_year_model": _sort_key("manufacturer", "year", "model"),
+    "model_manufacturer_year": _sort_key("model", "manufacturer", "year"),
+}
+
+
+def _spill_sort_key_runs(path, key_fn, source, chunk_size, tmp_dir, tag):
+    """Run ordinate su disco con sole (chiave di ordinamento, sorgente, id)."""
+    runs = []
+    offset = 0
+    for i, chunk in enumerate(pd.read_csv(path, usecols=key_fn.columns, chunksize=chunk_size, dtype=str)):
+        keys = key_fn(chunk).tolist()
+        rows = sorted(zip(keys, itertools.repeat(source), range(offset, offset + len(chunk))))
+        offset += len(chunk)
+
+        run_path = os.path.join(tmp_dir, f"{tag}_run_{i:05d}.csv")
+        with open(run_path, "w", newline="", encoding="utf-8") as f_run:
+            csv.writer(f_run).writerows(rows)
+        runs.append(run_path)
+    return runs, offset
+
+
+def _window_pair_codes(sources, ids, window, first_new, total_b):
+    """
+    Coppie A-B entro la finestra su un tratto ordinato: per ogni distanza d < window
+    le posizioni (i, i + d) con sorgenti diverse, solo se i + d >= first_new
+    (le coppie interamente nel tratto precedente sono già state emesse).
+    """
+    codes = []
+    n = len(ids)
+    for d in range(1, window):
+        left = np.arange(max(first_new - d, 0), n - d)
+        if len(left) == 0:
+            continue
+        right = left + d
+        cross = sources[left] != sources[right]
+        left, right = left[cross], right[cross]
+        a_pos = np.where(sources[left] == 0, left, right)
+        b_pos = np.where(sources[left] == 0, right, left)
+        codes.append(ids[a_pos] * total_b + ids[b_pos])
+    return np.unique(np.concatenate(codes)) if codes else np.empty(0, dtype=np.int64)
+
+
+def ground_truth_pair_ids(gt_file, file_a, file_b, fields=None, only_matches=True):
+    """
+    Id (posizione nei file A e B) dei record della ground truth, trovati per uguaglianza
+    di tutti gli attributi. Record con attributi identici sono indistinguibili (come per
+    le chiavi del test set di record_linkage): restituisce tutte le combinazioni,
+    come DataFrame (gt_row, a_id, b_id).
+    """
+    df_gt = pd.read_csv(gt_file, dtype=str)
+    if only_matches:
+        df_gt = df_gt[df_gt["match"].astype(str).str.strip() == "1"]
+    df_gt = df_gt.reset_index(drop=True)
+    side_a, side_b = ground_truth_sides(df_gt)
+    fields = list(fields or [c for c in side_a.columns if c in side_b.columns])
+
+    def locate(side, path):
+        records = pd.read_csv(path, usecols=fields, dtype=str).fillna("")
+        records["id"] = np.arange(len(records))
+        side = side[fields].fillna("").assign(gt_row=np.arange(len(side)))
+        return pd.merge(side, records, on=fields)[["gt_row", "id"]]
+
+    ids_a = locate(side_a, file_a).rename(columns={"id": "a_id"})
+    ids_b = locate(side_b, file_b).rename(columns={"id": "b_id"})
+    return pd.merge(ids_a, ids_b, on="gt_row"), len(df_gt)
+
+
+def pair_completeness_from_codes(gt_files, file_a, file_b, pair_codes, total_b):
+    """Pair completeness di un insieme di coppie (codici a_id * |B| + b_id ordinati) sulla ground truth."""
+    results = {}
+    for gt_file in gt_files:
+        if not os.path.exists(gt_file):
+            print(f"⚠ Ground truth non trovata, salto: {gt_file}")
+            continue
+        located, matches = ground_truth_pair_ids(gt_file, file_a, file_b)
+        codes = located["a_id"].to_numpy(dtype=np.int64) * total_b + located["b_id"].to_numpy(dtype=np.int64)
+        covered = located.loc[np.isin(codes, pair_codes), "gt_row"].nunique()
+        results[gt_file] = {
+            "matches": matches,
+            "matches_in_block": int(covered),
+            "pair_completeness": covered / matches if matches else 0.0,
+        }
+    return results
+
+
+def generate_candidate_pairs_sorted_neighborhood(
+    file_a,
+    file_b,
+    output_prefix,
+    window=10,
+    passes=("manufacturer_model_year", "manufacturer_year_model"),
+    ground_truth=("test.csv",),
+    chunk_size=500_000,
+    stream_block=1_000_000,
+    tmp_dir=None
+):
+    """
+    Sorted neighborhood: i record di A e B sono ordinati insieme su una chiave composita
+    e sono candidate solo le coppie A-B a distanza < window nell'ordinamento.
+    - ordinamento esterno: run ordinate di (chiave, sorgente, id) su disco e k-way merge
+    - la finestra è applicata con NumPy su tratti di stream_block record dello stream ordinato
+    - più passate con chiavi diverse (passes, nomi di SORT_KEYS o funzioni), unione deduplicata
+    Le coppie crescono linearmente con i dati (al più (window - 1) per record e passata).
+    Output nel formato compatto (output_prefix_pairs.bin + tabelle dei record).
+    """
+    start_time = time.time()
+    paths = compact_pair_paths(output_prefix)
+    pair_codes = np.empty(0, dtype=np.int64)
+    total_b = None
+
+    for pass_key in passes:
+        key_fn = SORT_KEYS[pass_key] if isinstance(pass_key, str) else pass_key
+        print(f"🔃 Passata su {key_fn.__name__} (finestra {window})...")
+
+        work_dir = tempfile.mkdtemp(prefix="sorted_nb_", dir=tmp_dir)
+        try:
+            runs_a, _ = _spill_sort_key_runs(file_a, key_fn, 0, chunk_size, work_dir, "a")
+            runs_b, total_b = _spill_sort_key_runs(file_b, key_fn, 1, chunk_size, work_dir, "b")
+
+            stream = _iter_merged_runs(runs_a + runs_b, [0])
+            carry_sources = np.empty(0, dtype=np.int8)
+            carry_ids = np.empty(0, dtype=np.int64)
+            pass_codes = []
+
+            while True:
+                block = list(itertools.islice(stream, stream_block))
+                if not block:
+                    break
+                sources = np.concatenate([carry_sources, np.array([int(r[1]) for r in block], dtype=np.int8)])
+                ids = np.concatenate([carry_ids, np.array([int(r[2]) for r in block], dtype=np.int64)])
+
+                pass_codes.append(_window_pair_codes(sources, ids, window, len(carry_ids), total_b))
+
+                carry_sources = sources[-(window - 1):] if window > 1 else sources[:0]
+                carry_ids = ids[-(window - 1):] if window > 1 else ids[:0]
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        pass_codes = np.unique(np.concatenate(pass_codes)) if pass_codes else np.empty(0, dtype=np.int64)
+        pair_codes = np.union1d(pair_codes, pass_codes)
+        print(f"↳ {len(pass_codes):,} coppie nella passata, {len(pair_codes):,} distinte in totale")
+
+    print("🆔 Scrittura output compatto...")
+    assign_record_ids(file_a, paths["records_a"], chunk_size)
+    assign_record_ids(file_b, paths["records_b"], chunk_size)
+    with open(paths["pairs"], "wb") as f_out:
+        write_pair_ids(f_out, pair_codes // total_b, pair_codes % total_b)
+    # le finestre attraversano manufacturer e year: il lato B li conserva entrambi
+    write_compact_meta(output_prefix, b_key_columns=PAIR_KEY_COLUMNS)
+
+    completeness = pair_completeness_from_codes(ground_truth, file_a, file_b, pair_codes, total_b)
+
+    print("\n✅ Sorted neighborhood completato")
+    print(f"📁 Coppie: {paths['pairs']}")
+    print(f"✔ Totale candidate pairs generate: {len(pair_codes):,}")
+    for gt_file, res in completeness.items():
+        print(f"✔ Pair completeness {gt_file}: {res['pair_completeness']:.4f} "
+              f"({res['matches_in_block']}/{res['matches']} match)")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return {"candidate_pairs": len(pair_codes), "pair_completeness": completeness}
+
+
+# ==========================================================
+# META-BLOCKING: PRUNING DEGLI ARCHI DEL GRAFO DI BLOCKING
+# ==========================================================
+
+def _collection_fn(collection):
+    """Funzione di blocking di una collezione: "B1", "B2", "token" o una funzione DataFrame -> Series."""
+    if callable(collection):
+        return collection
+    if collection == "token":
+        return model_token_keys
+    return scheme_key(collection)
+
+
+def _collection_columns(collection, fn):
+    """Colonne lette dalla funzione di blocking di una collezione (tutte se non dichiarate)."""
+    if collection == "token":
+        return MODEL_TOKEN_COLUMNS
+    return getattr(fn, "columns", None)
+
+
+def _block_assignments(path, collections, chunk_size):
+    """
+    Appartenenza ai blocchi di ogni record di un file, per tutte le collezioni:
+    DataFrame (block, id), con block = "<collezione><SEP><chiave>" e id = posizione della riga.
+    """
+    fns = {str(getattr(c, "__name__", c)): _collection_fn(c) for c in collections}
+    columns = [_collection_columns(c, fns[str(getattr(c, "__name__", c))]) for c in collections]
+    usecols = None if any(cols is None for cols in columns) else sorted({col for cols in columns for col in cols})
+    parts = []
+    offset = 0
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunk_size, dtype=str):
+        chunk = chunk.reset_index(drop=True)
+        for name, fn in fns.items():
+            keys = fn(chunk).dropna()
+            parts.append(pd.DataFrame({
+                "block": name + KEY_SEP + keys.astype(str).to_numpy(),
+                "id": keys.index.to_numpy() + offset,
+            }))
+        offset += len(chunk)
+    assignments = pd.concat(parts, ignore_index=True).drop_duplicates()
+    return assignments, offset
+
+
+def _node_batches(a_ids, a_blocks, b_len, batch_edges):
+    """Suddivide i nodi di A (ordinati) in gruppi con al massimo ~batch_edges archi (prima della deduplica)."""
+    edges_per_row = b_len[a_blocks]
+    node_edges = np.bincount(a_ids, weights=edges_per_row)
+    node_batch = (np.cumsum(node_edges) // max(batch_edges, 1)).astype(np.int64)
+    row_batch = node_batch[a_ids]
+    bounds = np.flatnonzero(np.diff(row_batch)) + 1
+    return np.split(np.arange(len(a_ids)), bounds)
+
+
+def _batch_edges(rows, a_ids, a_blocks, b_start, b_len, b_sorted_ids, total_b):
+    """Archi (codice a_id * |B| + b_id, blocchi in comune) generati dalle righe di assegnazione di un gruppo di nodi A."""
+    lengths = b_len[a_blocks[rows]]
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    row_offsets = np.cumsum(lengths) - lengths
+    pos = np.arange(total) - np.repeat(row_offsets, lengths) + np.repeat(b_start[a_blocks[rows]], lengths)
+    codes = np.repeat(a_ids[rows], lengths) * total_b + b_sorted_ids[pos]
+    return np.unique(codes, return_counts=True)
+
+
+def _blocking_graph(file_a, file_b, collections, max_block_pairs=None, batch_edges=20_000_000, chunk_size=500_000):
+    """
+    Indice del grafo di blocking: assegnazioni ai blocchi (senza i blocchi con un solo lato
+    e, se richiesto, senza quelli con |A|*|B| > max_block_pairs), blocchi di B in formato CSR
+    e nodi di A ordinati e divisi in gruppi da al massimo ~batch_edges archi.
+    """
+    assign_a, total_a = _block_assignments(file_a, collections, chunk_size)
+    assign_b, total_b = _block_assignments(file_b, collections, chunk_size)
+
+    codes, _ = pd.factorize(pd.concat([assign_a["block"], assign_b["block"]], ignore_index=True))
+    block_a, block_b = codes[:len(assign_a)], codes[len(assign_a):]
+    n_blocks = codes.max() + 1 if len(codes) else 0
+
+    size_a = np.bincount(block_a, minlength=n_blocks)
+    size_b = np.bincount(block_b, minlength=n_blocks)
+    useful = (size_a > 0) & (size_b > 0)
+    if max_block_pairs is not None:
+        purged = useful & (size_a.astype(np.int64) * size_b > max_block_pairs)
+        print(f"✔ Block purging: {int(purged.sum())} blocchi eliminati")
+        useful &= ~purged
+
+    keep_a, keep_b = useful[block_a], useful[block_b]
+    a_ids = assign_a["id"].to_numpy(dtype=np.int64)[keep_a]
+    a_blocks = block_a[keep_a]
+    b_ids = assign_b["id"].to_numpy(dtype=np.int64)[keep_b]
+    b_blocks = block_b[keep_b]
+
+    blocks_per_a = np.bincount(a_ids, minlength=total_a)
+    blocks_per_b = np.bincount(b_ids, minlength=total_b)
+
+    # indice dei blocchi di B (CSR): posizioni ordinate per blocco
+    order_b = np.argsort(b_blocks, kind="stable")
+    b_sorted_ids = b_ids[order_b]
+    b_len = np.bincount(b_blocks, minlength=n_blocks)
+    b_start = np.cumsum(b_len) - b_len
+
+    order_a = np.argsort(a_ids, kind="stable")
+    a_ids, a_blocks = a_ids[order_a], a_blocks[order_a]
+    batches = _node_batches(a_ids, a_blocks, b_len, batch_edges)
+    print(f"✔ Blocchi utili: {int(useful.sum()):,} | gruppi di nodi: {len(batches)}")
+
+    return {
+        "a_ids": a_ids, "a_blocks": a_blocks, "b_start": b_start, "b_len": b_len, "b_sorted_ids": b_sorted_ids,
+        "batches": batches, "total_a": total_a, "total_b": total_b,
+        "blocks_per_a": blocks_per_a, "blocks_per_b": blocks_per_b,
+    }
+
+
+def _graph_edges(graph):
+    """Archi del grafo di blocking (codici a_id * |B| + b_id, blocchi in comune), un gruppo di nodi di A alla volta."""
+    for rows in graph["batches"]:
+        yield _batch_edges(rows, graph["a_ids"], graph["a_blocks"], graph["b_start"], graph["b_len"],
+                           graph["b_sorted_ids"], graph["total_b"])
+
+
+def _edge_weights(codes, common, blocks_per_a, blocks_per_b, total_b, weighting):
+    if weighting == "cbs":
+        return common.astype(float)
+    if weighting == "js":
+        a = codes // total_b
+        b = codes % total_b
+        return common / (blocks_per_a[a] + blocks_per_b[b] - common)
+    raise ValueError("weighting deve essere 'cbs' o 'js'")
+
+
+def _top_k_threshold(nodes, weights, k, n_nodes):
+    """Per ogni nodo il k-esimo peso più alto dei suoi archi (0 se ne ha meno di k)."""
+    order = np.lexsort((-weights, nodes))
+    nodes, weights = nodes[order], weights[order]
+    rank = np.arange(len(nodes)) - np.searchsorted(nodes, nodes)
+    threshold = np.zeros(n_nodes)
+    last = rank == k - 1
+    threshold[nodes[last]] = weights[last]
+    return threshold
+
+
+def meta_blocking(
+    file_a,
+    file_b,
+    output_prefix,
+    collections=("B1", "B2", "token"),
+    weighting="js",
+    pruning="wnp",
+    k=10,
+    max_block_pairs=None,
+    batch_edges=20_000_000,
+    ground_truth=("test.csv",),
+    chunk_size=500_000
+):
+    """
+    Meta-blocking sulle collezioni di blocchi (B1, B2, token blocking o funzioni di chiave):
+    - grafo di blocking: nodi = record, archi = coppie A-B che condividono almeno un blocco
+    - peso dell'arco: 'cbs' (numero di blocchi in comune) o 'js' (Jaccard degli insiemi di blocchi)
+    - pruning per nodo: 'wnp' (arco tenuto se >= peso medio di almeno uno dei due nodi)
+      o 'cnp' (arco tenuto se tra i k archi più pesanti di almeno uno dei due nodi)
+    Gli archi sono generati nodo per nodo (gruppi di nodi di A con al massimo batch_edges archi),
+    in due passate: la prima accumula le statistiche dei nodi di B, la seconda applica il pruning.
+    max_block_pairs: block purging dei blocchi con |A|*|B| oltre il limite.
+    Output nel formato compatto; stampa la riduzione delle coppie e la pair completeness prima/dopo.
+    """
+    start_time = time.time()
+    paths = compact_pair_paths(output_prefix)
+
+    print("📚 Assegnazione dei record ai blocchi...")
+    graph = _blocking_graph(file_a, file_b, collections, max_block_pairs, batch_edges, chunk_size)
+    total_a, total_b = graph["total_a"], graph["total_b"]
+    blocks_per_a, blocks_per_b = graph["blocks_per_a"], graph["blocks_per_b"]
+
+    # ground truth come codici di coppia, per la pair completeness prima e dopo il pruning
+    gt_codes = {}
+    for gt_file in ground_truth:
+        if os.path.exists(gt_file):
+            located, matches = ground_truth_pair_ids(gt_file, file_a, file_b)
+            gt_codes[gt_file] = (located["a_id"].to_numpy(dtype=np.int64) * total_b
+                                 + located["b_id"].to_numpy(dtype=np.int64), located["gt_row"].to_numpy(), matches)
+        else:
+            print(f"⚠ Ground truth non trovata, salto: {gt_file}")
+
+    # passata 1: statistiche dei nodi di B (peso medio per WNP, k-esimo peso per CNP)
+    print("🔁 Passata 1: statistiche dei nodi di B...")
+    weight_sum_b = np.zeros(total_b)
+    degree_b = np.zeros(total_b)
+    top_b_nodes = np.empty(0, dtype=np.int64)
+    top_b_weights = np.empty(0)
+    total_edges = 0
+
+    for edge_codes, common in _graph_edges(graph):
+        weights = _edge_weights(edge_codes, common, blocks_per_a, blocks_per_b, total_b, weighting)
+        nodes_b = edge_codes % total_b
+        total_edges += len(edge_codes)
+        if pruning == "wnp":
+            weight_sum_b += np.bincount(nodes_b, weights=weights, minlength=total_b)
+            degree_b += np.bincount(nodes_b, minlength=total_b)
+        else:
+            # tengo solo i k archi più pesanti di ogni nodo di B visti finora
+            nodes = np.concatenate([top_b_nodes, nodes_b])
+            w = np.concatenate([top_b_weights, weights])
+            order = np.lexsort((-w, nodes))
+            nodes, w = nodes[order], w[order]
+            rank = np.arange(len(nodes)) - np.searchsorted(nodes, nodes)
+            top_b_nodes, top_b_weights = nodes[rank < k], w[rank < k]
+
+    if pruning == "wnp":
+        threshold_b = np.divide(weight_sum_b, degree_b, out=np.full(total_b, np.inf), where=degree_b > 0)
+    elif pruning == "cnp":
+        threshold_b = _top_k_threshold(top_b_nodes, top_b_weights, k, total_b)
+    else:
+        raise ValueError("pruning deve essere 'wnp' o 'cnp'")
+
+    # passata 2: pruning e scrittura degli archi tenuti
+    print("✂ Passata 2: pruning degli archi...")
+    kept_edges = 0
+    covered_before = {gt_file: set() for gt_file in gt_codes}
+    covered_after = {gt_file: set() for gt_file in gt_codes}
+
+    with open(paths["pairs"], "wb") as f_out:
+        for edge_codes, common in _graph_edges(graph):
+            weights = _edge_weights(edge_codes, common, blocks_per_a, blocks_per_b, total_b, weighting)
+            nodes_a = edge_codes // total_b
+            nodes_b = edge_codes % total_b
+
+            if pruning == "wnp":
+                sum_a = np.bincount(nodes_a, weights=weights, minlength=total_a)
+                deg_a = np.bincount(nodes_a, minlength=total_a)
+                threshold_a = np.divide(sum_a, deg_a, out=np.full(total_a, np.inf), where=deg_a > 0)
+            else:
+                threshold_a = _top_k_threshold(nodes_a, weights, k, total_a)
+
+            keep = (weights >= threshold_a[nodes_a]) | (weights >= threshold_b[nodes_b])
+            write_pair_ids(f_out, nodes_a[keep], nodes_b[keep])
+            kept_edges += int(keep.sum())
+
+            for gt_file, (codes_gt, rows_gt, _) in gt_codes.items():
+                covered_before[gt_file].update(rows_gt[np.isin(codes_gt, edge_codes)])
+                covered_after[gt_file].update(rows_gt[np.isin(codes_gt, edge_codes[keep])])
+
+    print("🆔 Scrittura tabelle dei record...")
+    assign_record_ids(file_a, paths["records_a"], chunk_size)
+    assign_record_ids(file_b, paths["records_b"], chunk_size)
+    # solo la collezione B1 fissa manufacturer e year; le altre (B2, token, ...) no
+    write_compact_meta(output_prefix, b_key_columns=() if set(collections) <= {"B1"} else PAIR_KEY_COLUMNS)
+
+    completeness = {}
+    print("\n✅ Meta-blocking completato")
+    print(f"📁 Coppie: {paths['pairs']}")
+    print(f"✔ Archi del grafo: {total_edges:,} -> tenuti {kept_edges:,} "
+          f"({kept_edges / total_edges if total_edges else 0:.2%})")
+    for gt_file, (_, _, matches) in gt_codes.items():
+        before = len(covered_before[gt_file]) / matches if matches else 0.0
+        after = len(covered_after[gt_file]) / matches if matches else 0.0
+        completeness[gt_file] = {"before": before, "after": after}
+        print(f"✔ Pair completeness {gt_file}: {before:.4f} -> {after:.4f} (costo {before - after:.4f})")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return {
+        "edges": total_edges,
+        "kept_edges": kept_edges,
+        "pair_completeness": completeness,
+    }
+
+
+# ==========================================================
+# BLOCKING CON TOLLERANZA SULL'ANNO (INDICE ORDINATO PER RANGE)
+# ==========================================================
+
+YEAR_SLOT_OFFSET = np.int64(2 ** 31)
+
+
+def _year_range_keys(df, manufacturers, years):
+    """
+    Chiave intera ordinabile (manufacturer, year): codice del manufacturer * 2^32 + slot dell'anno.
+    Anni interi -> slot 2^31 + anno (ordinati, interrogabili per intervallo);
+    anni non numerici o mancanti -> codice della stringa (solo uguaglianza esatta, come in B1).
+    Restituisce (chiavi, anno numerico o NaN, manufacturer noto).
+    """
+    m_codes = manufacturers.get_indexer(df["manufacturer"])
+    year_num = pd.to_numeric(df["year"], errors="coerce").to_numpy(dtype=float)
+    numeric = ~np.isnan(year_num) & (year_num == np.floor(year_num))
+    year_num = np.where(numeric, year_num, np.nan)
+
+    slots = years.get_indexer(df["year"]).astype(np.int64)
+    slots[numeric] = YEAR_SLOT_OFFSET + year_num[numeric].astype(np.int64)
+    keys = m_codes.astype(np.int64) * 2 ** 32 + slots
+    return keys, year_num, (m_codes >= 0) & (slots >= 0)
+
+
+def generate_candidate_pairs_year_tolerant(
+    file_a,
+    file_b,
+    output_file,
+    k=1,
+    check_mileage=False,
+    max_diff=None,
+    ground_truth=("test.csv",),
+    chunk_size=200_000
+):
+    """
+    Blocking B1 con tolleranza sull'anno: stesso manufacturer e |year_a - year_b| <= k.
+    - A in RAM, indicizzato per (manufacturer, year) con un array ordinato:
+      per ogni record di B gli anni year-k..year+k sono un unico intervallo contiguo,
+      trovato con due ricerche binarie (np.searchsorted)
+    - check_mileage: scarta le coppie con chilometraggio noto su entrambi i lati
+      e differenza oltre max_diff (default: la stessa tolleranza di score_mileage)
+    - anni non numerici o mancanti: solo uguaglianza esatta
+    Con k=0 le coppie sono le stesse di generate_candidate_pairs_B1.
+    Output nel formato B1 con la colonna year_b aggiuntiva; stampa la crescita
+    delle candidate pairs (e la pair completeness) per ogni tolleranza 0..k.
+    """
+    start_time = time.time()
+    if max_diff is None:
+        max_diff = MILEAGE_MAX_DIFF
+
+    print(f"📥 Caricamento file A in RAM: {file_a}")
+    df_a = pd.read_csv(file_a, dtype=str)
+    print(f"✔ Record totali in A: {len(df_a)}")
+
+    manufacturers = pd.Index(pd.unique(df_a["manufacturer"]))
+    years = pd.Index(pd.unique(df_a["year"]))
+    keys_a, year_a, known_a = _year_range_keys(df_a, manufacturers, years)
+    order = np.argsort(keys_a, kind="stable")
+    order = order[known_a[order]]
+    sorted_keys = keys_a[order]
+    mileage_a = np.trunc(pd.to_numeric(df_a["mileage"], errors="coerce").to_numpy(dtype=float))
+
+    # ground truth come codici di coppia a_id * 2^32 + b_id
+    gt_pairs = {}
+    for gt_file in ground_truth:
+        if os.path.exists(gt_file):
+            located, matches = ground_truth_pair_ids(gt_file, file_a, file_b)
+            codes = located["a_id"].to_numpy(dtype=np.int64) * 2 ** 32 + located["b_id"].to_numpy(dtype=np.int64)
+            gt_pairs[gt_file] = (codes, located["gt_row"].to_numpy(), matches, np.full(matches, np.inf))
+        else:
+            print(f"⚠ Ground truth non trovata, salto: {gt_file}")
+
+    pairs_per_diff = np.zeros(k + 1, dtype=np.int64)
+    total_pairs = 0
+    dropped_mileage = 0
+    offset_b = 0
+    first_chunk = True
+
+    print(f"🚀 Inizio scansione file B a chunk (tolleranza anno ±{k})...")
+
+    for i, chunk_b in enumerate(pd.read_csv(file_b, chunksize=chunk_size, dtype=str)):
+        chunk_b = chunk_b.reset_index(drop=True)
+        keys_b, year_b, known_b = _year_range_keys(chunk_b, manufacturers, years)
+        radius = np.where(np.isnan(year_b), 0, k)
+
+        lo = np.searchsorted(sorted_keys, keys_b - radius, side="left")
+        hi = np.searchsorted(sorted_keys, keys_b + radius, side="right")
+        counts = np.where(known_b, hi - lo, 0)
+
+        total = int(counts.sum())
+        b_pos = np.repeat(np.arange(len(chunk_b)), counts)
+        run_offsets = np.cumsum(counts) - counts
+        a_pos = order[np.arange(total) - np.repeat(run_offsets, counts) + np.repeat(lo, counts)]
+
+        year_diff = np.nan_to_num(np.abs(year_a[a_pos] - year_b[b_pos])).astype(np.int64)
+
+        if check_mileage:
+            mileage_b = np.trunc(pd.to_numeric(chunk_b["mileage"], errors="coerce").to_numpy(dtype=float))
+            with np.errstate(invalid="ignore"):
+                far = np.abs(mileage_a[a_pos] - mileage_b[b_pos]) > max_diff
+            dropped_mileage += int(far.sum())
+            a_pos, b_pos, year_diff = a_pos[~far], b_pos[~far], year_diff[~far]
+
+        pairs_per_diff += np.bincount(year_diff, minlength=k + 1)
+        total_pairs += len(a_pos)
+
+        pair_codes = a_pos.astype(np.int64) * 2 ** 32 + (b_pos + offset_b)
+        for codes, rows, _, min_diff in gt_pairs.values():
+            hit = np.isin(codes, pair_codes)
+            if hit.any():
+                found = pd.Series(year_diff, index=pair_codes).groupby(level=0).min()
+                np.minimum.at(min_diff, rows[hit], found.loc[codes[hit]].to_numpy())
+        offset_b += len(chunk_b)
+
+        print(f"➡ Chunk {i+1}: {len(a_pos)} coppie | totale {total_pairs}")
+        if len(a_pos) == 0:
+            continue
+
+        pairs_to_frame(df_a, chunk_b, a_pos, b_pos, b_key_columns=("year",)).to_csv(
+            output_file,
+            mode="w" if first_chunk else "a",
+            index=False,
+            header=first_chunk
+        )
+        first_chunk = False
+
+    print("\n✅ Blocking con tolleranza sull'anno completato")
+    print(f"📁 File output: {output_file}")
+    print(f"✔ Totale candidate pairs generate: {total_pairs}")
+    if check_mileage:
+        print(f"✔ Coppie scartate per chilometraggio (> {max_diff}): {dropped_mileage}")
+
+    growth = []
+    cumulative = np.cumsum(pairs_per_diff)
+    for tol in range(k + 1):
+        row = {"k": tol, "candidate_pairs": int(cumulative[tol]),
+               "growth": cumulative[tol] / cumulative[0] if cumulative[0] else float("nan")}
+        for gt_file, (_, _, matches, min_diff) in gt_pairs.items():
+            row[gt_file] = float((min_diff <= tol).sum() / matches) if matches else 0.0
+        growth.append(row)
+        completeness = " | ".join(f"PC {f}: {row[f]:.4f}" for f in gt_pairs)
+        print(f"↳ k={tol}: {row['candidate_pairs']:,} coppie (x{row['growth']:.2f}) {completeness}")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return pd.DataFrame(growth)
+
+
+# ==========================================================
+# SCHEMA DI BLOCKING APPRESO DALLE COPPIE ETICHETTATE
+# ==========================================================
+#
+# Predicato: dizionario serializzabile, es. {"type": "exact", "field": "manufacturer"},
+# {"type": "model_prefix", "n": 3}, {"type": "fuel"}, {"type": "body_class"}, {"type": "year_bucket", "size": 2}.
+# Schema appreso: disgiunzione (lista) di congiunzioni (liste) di predicati, salvato in JSON.
+
+DEFAULT_PREDICATES = (
+    [{"type": "exact", "field": f} for f in ("manufacturer", "year", "transmission", "fuel_type",
+                                              "body_type", "cylinders", "drive", "color")]
+    + [{"type": "model_prefix", "n": n} for n in (2, 3, 4, 6)]
+    + [{"type": "fuel"}, {"type": "body_class"}]
+    + [{"type": "year_bucket", "size": size} for size in (2, 5)]
+)
+
+_PREDICATE_FIELDS = {"model_prefix": "model", "fuel": "fuel_type", "body_class": "body_type", "year_bucket": "year"}
+
+
+def _predicate_field(predicate):
+    return _PREDICATE_FIELDS.get(predicate["type"], predicate.get("field"))
+
+
+def predicate_name(predicate):
+    params = ",".join(f"{k}={v}" for k, v in predicate.items() if k != "type")
+    return f"{predicate['type']}({params})"
+
+
+def predicate_key(predicate):
+    """Funzione DataFrame -> Series di chiavi di un predicato; NaN (nessun blocco) per i valori mancanti."""
+    kind = predicate["type"]
+    field = _predicate_field(predicate)
+
+    def key_fn(df):
+        if kind == "exact":
+            keys = df[field]
+        elif kind == "model_prefix":
+            keys = _model_prefix_key(predicate["n"])(df)
+        elif kind == "fuel":
+            keys = make_blocking_key([field], {field: normalize_fuel_type_for_blocking})(df)
+        elif kind == "body_class":
+            keys = _class_key(field, BODY_CLASSES)(df)
+        elif kind == "year_bucket":
+            year = pd.to_numeric(df[field], errors="coerce")
+            keys = np.floor(year / predicate["size"]).map("{:.0f}".format, na_action="ignore")
+        else:
+            raise ValueError(f"Predicato sconosciuto: {kind}")
+        keys = keys.astype(object)
+        return keys.where(~(keys.isna() | keys.isin(["", "nan"])))
+
+    key_fn.columns = [field]
+    key_fn.__name__ = predicate_name(predicate)
+    return key_fn
+
+
+def conjunction_key(conjunction):
+    """Blocking key di una congiunzione di predicati: stesso blocco solo se tutti i predicati coincidono."""
+    fns = [predicate_key(p) for p in conjunction]
+
+    def key_fn(df):
+        parts = [fn(df) for fn in fns]
+        missing = pd.concat(parts, axis=1).isna().any(axis=1)
+        keys = parts[0].astype(str).str.cat([p.astype(str) for p in parts[1:]], sep=KEY_SEP).astype(object)
+        keys[missing] = np.nan
+        return keys
+
+    key_fn.columns = sorted({_predicate_field(p) for p in conjunction})
+    key_fn.__name__ = " & ".join(predicate_name(p) for p in conjunction)
+    return key_fn
+
+
+def _encode_keys(keys, vocabulary):
+    """Codici interi delle chiavi su un vocabolario condiviso tra A e B (aggiornato sul posto); -1 = mancante."""
+    for value in keys.dropna().unique():
+        if value not in vocabulary:
+            vocabulary[value] = len(vocabulary)
+    return keys.map(vocabulary).fillna(-1).to_numpy(dtype=np.int64).astype(np.int32)
+
+
+def _predicate_codes(path, predicates, vocabularies, chunk_size):
+    """Matrice (record x predicati) dei codici di blocco di ogni predicato, letta a chunk."""
+    fns = [predicate_key(p) for p in predicates]
+    usecols = sorted({_predicate_field(p) for p in predicates})
+    parts = []
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunk_size, dtype=str):
+        parts.append(np.column_stack([_encode_keys(fn(chunk), vocab) for fn, vocab in zip(fns, vocabularies)]))
+    return np.vstack(parts) if parts else np.empty((0, len(predicates)), dtype=np.int32)
+
+
+def _conjunction_pairs(codes_a, codes_b, members):
+    """Candidate pairs di una congiunzione dai soli conteggi per blocco: somma su k di |A_k| * |B_k|."""
+    joint = np.concatenate([codes_a[:, members], codes_b[:, members]]).astype(np.int64)
+    valid = (joint >= 0).all(axis=1)
+    if not valid.any():
+        # tutti i valori di un predicato mancanti: nessun blocco
+        return 0
+    block = joint[valid, 0]
+    for j in range(1, len(members)):
+        # combino un predicato alla volta e ricompatto i codici (nessun overflow)
+        _, block = np.unique(block * (joint[valid, j].max() + 1) + joint[valid, j], return_inverse=True)
+    _, block = np.unique(block, return_inverse=True)
+    in_a = valid[:len(codes_a)]
+    n_blocks = block.max() + 1 if len(block) else 0
+    size_a = np.bincount(block[:in_a.sum()], minlength=n_blocks).astype(np.int64)
+    size_b = np.bincount(block[in_a.sum():], minlength=n_blocks).astype(np.int64)
+    return int((size_a * size_b).sum())
+
+
+def learn_blocking_scheme(
+    train_file,
+    file_a,
+    file_b,
+    pair_budget=50_000_000,
+    predicates=DEFAULT_PREDICATES,
+    max_conjunction_size=2,
+    output_json="learned_blocking.json",
+    chunk_size=500_000
+):
+    """
+    Impara uno schema di blocking dalle coppie etichettate (train.csv):
+    - candidati: congiunzioni di fino a max_conjunction_size predicati su campi diversi
+    - copertura: match del train con chiave di a_ uguale a quella di b_ per tutti i predicati
+    - costo: candidate pairs su file_a x file_b, calcolate dai conteggi per blocco
+    - greedy: aggiunge alla disgiunzione la congiunzione con più match nuovi per coppia
+      generata, finché il totale (somma dei costi, stima per eccesso) resta nel budget
+    Lo schema viene salvato in output_json ed è eseguibile con generate_candidate_pairs_learned.
+    """
+    start_time = time.time()
+    predicates = [dict(p) for p in predicates]
+
+    df_train = pd.read_csv(train_file, dtype=str)
+    df_train = df_train[df_train["match"].astype(str).str.strip() == "1"]
+    print(f"✔ Match nel train: {len(df_train)}")
+
+    # copertura di ogni predicato sui match del train
+    same = np.column_stack([pairs_in_same_block(df_train, predicate_key(p)) for p in predicates])
+
+    print("📊 Codici di blocco dei predicati su A e B...")
+    vocabularies = [{} for _ in predicates]
+    codes_a = _predicate_codes(file_a, predicates, vocabularies, chunk_size)
+    codes_b = _predicate_codes(file_b, predicates, vocabularies, chunk_size)
+
+    candidates = []
+    for size in range(1, max_conjunction_size + 1):
+        for members in itertools.combinations(range(len(predicates)), size):
+            if len({_predicate_field(predicates[m]) for m in members}) < size:
+                continue
+            coverage = same[:, list(members)].all(axis=1)
+            if not coverage.any():
+                continue
+            pairs = _conjunction_pairs(codes_a, codes_b, list(members))
+            candidates.append((members, coverage, pairs))
+    print(f"✔ Congiunzioni candidate con copertura > 0: {len(candidates)}")
+
+    selected = []
+    covered = np.zeros(len(df_train), dtype=bool)
+    used_pairs = 0
+    while True:
+        best = None
+        for members, coverage, pairs in candidates:
+            gain = int((coverage & ~covered).sum())
+            if gain == 0 or used_pairs + pairs > pair_budget:
+                continue
+            ratio = gain / max(pairs, 1)
+            if best is None or ratio > best[0]:
+                best = (ratio, members, coverage, pairs, gain)
+        if best is None:
+            break
+        _, members, coverage, pairs, gain = best
+        covered |= coverage
+        used_pairs += pairs
+        conjunction = [predicates[m] for m in members]
+        selected.append({"conjunction": conjunction, "pairs": pairs, "new_matches": gain})
+        print(f"➕ {conjunction_key(conjunction).__name__}: +{gain} match, {pairs:,} coppie "
+              f"| PC train {covered.mean():.4f} | coppie totali {used_pairs:,}")
+
+    scheme = {
+        "type": "learned_blocking",
+        "train_file": str(train_file),
+        "pair_budget": pair_budget,
+        "estimated_pairs": used_pairs,
+        "train_pair_completeness": float(covered.mean()) if len(covered) else 0.0,
+        "conjunctions": [s["conjunction"] for s in selected],
+        "steps": selected,
+    }
+    with open(output_json, "w", encoding="utf-8") as f:
+        json.dump(scheme, f, indent=2)
+
+    print("\n✅ Schema di blocking appreso")
+    print(f"📁 File schema: {output_json}")
+    print(f"✔ Congiunzioni: {len(selected)} | coppie stimate: {used_pairs:,} | PC train: {scheme['train_pair_completeness']:.4f}")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return scheme
+
+
+def load_blocking_scheme(scheme):
+    """Schema appreso da file JSON (o già come dizionario)."""
+    if isinstance(scheme, dict):
+        return scheme
+    with open(scheme, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def learned_scheme_keys(scheme):
+    """Blocking key delle congiunzioni dello schema (una collezione di blocchi ciascuna)."""
+    return [conjunction_key(c) for c in load_blocking_scheme(scheme)["conjunctions"]]
+
+
+def learned_b_key_columns(scheme):
+    """Chiavi di PAIR_KEY_COLUMNS non fissate da tutte le congiunzioni (predicato exact sul campo)."""
+    conjunctions = load_blocking_scheme(scheme)["conjunctions"]
+    return [
+        key for key in PAIR_KEY_COLUMNS
+        if not all(any(p["type"] == "exact" and p.get("field") == key for p in c) for c in conjunctions)
+    ]
+
+
+def learned_pair_completeness(gt_files, scheme):
+    """Pair completeness della disgiunzione: la coppia è candidata se condivide il blocco di almeno una congiunzione."""
+    keys = learned_scheme_keys(scheme)
+    results = {}
+    for gt_file in gt_files:
+        if not os.path.exists(gt_file):
+            print(f"⚠ Ground truth non trovata, salto: {gt_file}")
+            continue
+        df_gt = pd.read_csv(gt_file, dtype=str)
+        in_block = np.zeros(len(df_gt), dtype=bool)
+        for key_fn in keys:
+            in_block |= pairs_in_same_block(df_gt, key_fn)
+        is_match = (df_gt["match"].astype(str).str.strip() == "1").to_numpy()
+        results[gt_file] = {
+            "matches": int(is_match.sum()),
+            "matches_in_block": int((in_block & is_match).sum()),
+            "pair_completeness": float((in_block & is_match).sum() / is_match.sum()) if is_match.any() else 0.0,
+        }
+    return results
+
+
+def generate_candidate_pairs_learned(
+    file_a,
+    file_b,
+    scheme,
+    output_prefix,
+    batch_edges=20_000_000,
+    ground_truth=("test.csv",),
+    chunk_size=500_000
+):
+    """
+    Esegue uno schema appreso (file JSON di learn_blocking_scheme): unione deduplicata
+    delle coppie dei blocchi di tutte le congiunzioni, generate per gruppi di nodi di A
+    come nel meta-blocking. Output nel formato compatto.
+    """
+    start_time = time.time()
+    paths = compact_pair_paths(output_prefix)
+    keys = learned_scheme_keys(scheme)
+    for key_fn in keys:
+        print(f"↳ congiunzione: {key_fn.__name__}")
+
+    print("📚 Assegnazione dei record ai blocchi...")
+    graph = _blocking_graph(file_a, file_b, keys, None, batch_edges, chunk_size)
+
+    total_pairs = 0
+    with open(paths["pairs"], "wb") as f_out:
+        for edge_codes, _ in _graph_edges(graph):
+            write_pair_ids(f_out, edge_codes // graph["total_b"], edge_codes % graph["total_b"])
+            total_pairs += len(edge_codes)
+
+    print("🆔 Scrittura tabelle dei record...")
+    assign_record_ids(file_a, paths["records_a"], chunk_size)
+    assign_record_ids(file_b, paths["records_b"], chunk_size)
+    write_compact_meta(output_prefix, b_key_columns=learned_b_key_columns(scheme))
+
+    completeness = learned_pair_completeness(ground_truth, scheme)
+
+    print("\n✅ Blocking con schema appreso completato")
+    print(f"📁 Coppie: {paths['pairs']}")
+    print(f"✔ Totale candidate pairs generate: {total_pairs:,}")
+    for gt_file, res in completeness.items():
+        print(f"✔ Pair completeness {gt_file}: {res['pair_completeness']:.4f} "
+              f"({res['matches_in_block']}/{res['matches']} match)")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
+
+    return {"candidate_pairs": total_pairs, "pair_completeness": completeness}
+
+
+# ==========================================================
+# BLOCKING TOP-K NEAREST NEIGHBOUR (TF-IDF SPARSO)
+# ==========================================================
+
+KNN_TEXT_COLUMNS = ("model", "year", "fuel_type", "transmission", "body_type", "drive")
+
+# matrici TF-IDF di A e B (righe ordinate per manufacturer), caricate una volta per processo
+_knn_state = {}
+
+
+def _init_knn_worker(matrix_a, matrix_b):
+    _knn_state["a"] = matrix_a
+    _knn_state["b"] = matrix_b
+
+
+def _knn_chunk(task):
+    """
+    Top-k di un chunk di righe di A sul gruppo di B dello stesso manufacturer:
+    prodotto sparso chunk x gruppo^T e selezione dei k valori più alti per riga.
+    Restituisce (posizioni in A, posizioni in B, similarità) sulle matrici ordinate.
+    """
+    a_start, a_end, b_start, b_end, k, min_sim = task
+    sims = (_knn_state["a"][a_start:a_end] @ _knn_state["b"][b_start:b_end].T).tocsr()
+    rows = np.repeat(np.arange(a_end - a_start), np.diff(sims.indptr))
+    order = np.lexsort((-sims.data, rows))
+    rank = np.arange(len(order)) - sims.indptr[rows[order]]
+    keep = order[(rank < k) & (sims.data[order] > 0) & (sims.data[order] >= min_sim)]
+    return a_start + rows[keep], b_start + sims.indices[keep], sims.data[keep].astype(np.float32)
+
+
+def _sorted_groups(codes):
+    """Ordine stabile dei record per gruppo e intervallo [inizio, fine) di ogni gruppo nell'ordine."""
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    groups = np.unique(sorted_codes)
+    starts = np.searchsorted(sorted_codes, groups, side="left")
+    ends = np.searchsorted(sorted_codes, groups, side="right")
+    return order, dict(zip(groups.tolist(), zip(starts.tolist(), ends.tolist())))
+
+
+def generate_candidate_pairs_knn(
+    file_a,
+    file_b,
+    output_prefix,
+    k=10,
+    text_columns=KNN_TEXT_COLUMNS,
+    ngram_range=(3, 3),
+    min_sim=0.0,
+    max_products=20_000_000,
+    max_workers=8,
+    ground_truth=("test.csv",),
+    chunk_size=500_000
+):
+    """
+    Blocking top-k nearest neighbour: per ogni record di A i k record di B più simili
+    con lo stesso manufacturer (budget fisso di candidati per record, a differenza dei blocchi di B1).
+    - record serializzato = text_columns unite da spazi, vettori TF-IDF su n-grammi di caratteri
+      (TfidfVectorizer, vocabolario e idf stimati su A + B)
+    - A e B ordinati per manufacturer: ogni gruppo è un intervallo contiguo di righe delle matrici
+    - ogni gruppo di A è diviso in chunk con al massimo ~max_products prodotti riga x riga;
+      i chunk sono elaborati da un pool di processi con prodotto sparso e top-k per riga
+      (nessuna matrice densa)
+    Output nel formato compatto; in <prefix>_knn_sims.bin le similarità (float32, stesso ordine delle coppie).
+    """
+    start_time = time.time()
+    paths = compact_pair_paths(output_prefix)
+    sims_path = f"{output_prefix}_knn_sims.bin"
+    usecols = ["manufacturer"] + [c for c in text_columns if c != "manufacturer"]
+
+    print("📥 Caricamento record...")
+    df_a = pd.read_csv(file_a, usecols=usecols, dtype=str)
+    df_b = pd.read_csv(file_b, usecols=usecols, dtype=str)
+    total_b = len(df_b)
+
+    manufacturer_codes, _ = pd.factorize(
+        pd.concat([df_a["manufacturer"], df_b["manufacturer"]], ignore_index=True).fillna(""))
+    order_a, groups_a = _sorted_groups(manufacturer_codes[:len(df_a)])
+    order_b, groups_b = _sorted_groups(manufacturer_codes[len(df_a):])
+
+    print(f"🔤 TF-IDF su n-grammi di caratteri {ngram_range}...")
+    text_a = _lsh_text(df_a, text_columns).str.lower()
+    text_b = _lsh_text(df_b, text_columns).str.lower()
+    vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=ngram_range, dtype=np.float32)
+    vectorizer.fit(pd.concat([text_a, text_b], ignore_index=True))
+    matrix_a = vectorizer.transform(text_a.iloc[order_a])
+    matrix_b = vectorizer.transform(text_b.iloc[order_b])
+    print(f"✔ Vocabolario: {len(vectorizer.vocabulary_):,} n-grammi")
+    del df_a, df_b, text_a, text_b
+
+    tasks = []
+    for group, (a_start, a_end) in groups_a.items():
+        if group not in groups_b:
+            continue
+        b_start, b_end = groups_b[group]
+        rows = max(1, max_products // (b_end - b_start))
+        for start in range(a_start, a_end, rows):
+            tasks.append((start, min(start + rows, a_end), b_start, b_end, k, min_sim))
+    print(f"🚀 {len(tasks)} chunk su {max_workers} processi...")
+
+    total_pairs = 0
+    pair_codes = []
+    with open(paths["pairs"], "wb") as f_pairs, open(sims_path, "wb") as f_sims:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_knn_worker,
+                                 initargs=(matrix_a, matrix_b)) as executor:
+            for i, (a_pos, b_pos, sims) in enumerate(executor.map(_knn_chunk, tasks)):
+                a_ids, b_ids = order_a[a_pos], order_b[b_pos]
+                write_pair_ids(f_pairs, a_ids, b_ids)
+                sims.tofile(f_sims)
+                pair_codes.append(a_ids.astype(np.int64) * total_b + b_ids)
+                total_pairs += len(a_ids)
+                if (i + 1) % 100 == 0:
+                    print(f"↳ chunk {i + 1}/{len(tasks)} | coppie finora: {total_pairs:,}")
+
+    print("🆔 Scrittura tabelle dei record...")
+    total_a = assign_record_ids(file_a, paths["records_a"], chunk_size)
+    assign_record_ids(file_b, paths["records_b"], chunk_size)
+    # vicini cercati nello stesso manufacturer ma con year libero: il lato B conserva il proprio year
+    write_compact_meta(output_prefix, b_key_columns=("year",))
+
+    pair_codes = np.sort(np.concatenate(pair_codes)) if pair_codes else np.empty(0, dtype=np.int64)
+    completeness = pair_completeness_from_codes(ground_truth, file_a, file_b, pair_codes, total_b)
 
+    print("\n✅ Blocking top-k nearest neighbour completato")
+    print(f"📁 Coppie: {paths['pairs']} | similarità: {sims_path}")
+    print(f"✔ Totale candidate pairs generate: {total_pairs:,} ({total_pairs / max(total_a, 1):.1f} per record di A)")
+    for gt_file, res in completeness.items():
+        print(f"✔ Pair completeness {gt_file}: {res['pair_completeness']:.4f} "
+              f"({res['matches_in_block']}/{res['matches']} match)")
+    print(f"⏱ Tempo totale: {time.time() - start_time:.1f} secondi")
 
+    return {"candidate_pairs": total_pairs, "pair_completeness": completeness}
@@ -1,120 +1,120 @@
 import pandas as pd
 import csv
+from blocking import candidate_tasks, load_candidate_task, CANDIDATE_RANGE_BYTES
+from record_linkage import (
+    build_test_dict, build_test_tables, create_shared_tables, attach_shared_tables,
+    release_shared_tables, shared_test_hits, checkpoint_params, load_checkpoint, save_checkpoint
+)
+import os
 import time
 from concurrent.futures import ProcessPoolExecutor, as_completed
-from threading import Lock
-
-# ------------------------------
-# Funzione di sicurezza: converte valori in stringa
-# ------------------------------
-def safe_str(val):
-    return '' if pd.isna(val) else str(val)
-
-# ------------------------------
-# Lock globale per la scrittura concorrente
-# ------------------------------
-write_lock = Lock()
 
 # ------------------------------
 # Worker per chunk
 # ------------------------------
-def process_chunk(chunk, test_dict, output_file=None):
-    """Elabora un chunk e salva solo le righe che corrispondono al test set."""
+def process_chunk(chunk, tables=None):
+    """Righe del chunk che corrispondono al test set (non scrive: lo fa il processo principale)."""
+    # chiave univoca test set: semi-join sugli hash delle tabelle condivise, chiave verificata solo sui candidati
+    hit_positions, _ = shared_test_hits(chunk, tables)
+    return chunk.iloc[hit_positions].to_numpy(dtype=object).tolist()
+
+
+def process_task(task, chunk_size=500_000):
+    """
+    Worker per un'unità di lavoro di candidate_tasks: legge da sé il proprio intervallo
+    (byte del CSV o coppie del formato compatto) e restituisce le sole righe del test set,
+    scritte poi dal processo principale.
+    """
     filtered_rows = []
-
-    for idx, row in chunk.iterrows():
-        # chiave univoca test set
-        pair_tuple = (
-            safe_str(row['manufacturer']), safe_str(row['model_a']), safe_str(row['year']),
-            safe_str(row['mileage_a']), safe_str(row['fuel_type_a']), safe_str(row['transmission_a']),
-            safe_str(row['body_type_a']), safe_str(row['cylinders_a']), safe_str(row['drive_a']),
-            safe_str(row['color_a']),
-            safe_str(row.get('manufacturer_b', row['manufacturer'])), safe_str(row['model_b']),
-            safe_str(row.get('year_b', row['year'])), safe_str(row.get('mileage_b', row['mileage_a'])),
-            safe_str(row.get('fuel_type_b', row['fuel_type_a'])), safe_str(row.get('transmission_b', row['transmission_a'])),
-            safe_str(row.get('body_type_b', row['body_type_a'])), safe_str(row.get('cylinders_b', row['cylinders_a'])),
-            safe_str(row.get('drive_b', row['drive_a'])), safe_str(row.get('color_b', row['color_a']))
-        )
-
-        if pair_tuple in test_dict:
-            # Salva la riga originale nel file di backup
-            filtered_rows.append(row)
-
-    # Scrittura thread-safe su file
-    if output_file and filtered_rows:
-        with write_lock:
-            with open(output_file, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                for row in filtered_rows:
-                    writer.writerow(row.tolist())
-
-    return len(filtered_rows)  # ritorna quante righe sono state salvate
+    for chunk in load_candidate_task(task, chunk_size):
+        filtered_rows.extend(process_chunk(chunk))
+    return filtered_rows
 
 # ------------------------------
 # Funzione principale Windows-safe + Ctrl+C
 # ------------------------------
 def filter_candidate_pairs(blocking_file, test_file, output_file,
-                                    chunk_size=500_000, max_workers=8):
+                                    chunk_size=500_000, max_workers=8, range_bytes=CANDIDATE_RANGE_BYTES,
+                                    checkpoint_file=None, resume=False):
+    # checkpoint_file: dopo ogni chunk completato salva (in modo atomico) le righe salvate e la
+    # dimensione del file di output; con resume=True i chunk già completati vengono saltati
+    if resume and not checkpoint_file:
+        raise ValueError("resume=True richiede checkpoint_file")
+
     # Carico test set
     df_test = pd.read_csv(test_file, dtype=str)
-    test_dict = {
-        tuple(safe_str(df_test.loc[i, col]) for col in [
-            'a_manufacturer','a_model','a_year','a_mileage','a_fuel_type','a_transmission','a_body_type',
-            'a_cylinders','a_drive','a_color',
-            'b_manufacturer','b_model','b_year','b_mileage','b_fuel_type','b_transmission','b_body_type',
-            'b_cylinders','b_drive','b_color'
-        ]): True
-        for i in df_test.index
-    }
-
-    # Pulisce eventuale file di output precedente
-    open(output_file, 'w').close()
+    test_dict = build_test_dict(df_test, labels=False)
+
+    checkpoint = None
+    if checkpoint_file:
+        params = checkpoint_params(blocking_file, test_file, chunk_size=chunk_size,
+                                   range_bytes=range_bytes, output_file=os.path.abspath(output_file))
+        checkpoint = load_checkpoint(checkpoint_file, params, resume)
+
+    # Tabelle di lookup in memoria condivisa: i worker le collegano una volta sola
+    shared_blocks, table_specs = create_shared_tables(build_test_tables(test_dict))
+
+    if checkpoint and checkpoint['done']:
+        # Ripresa: si scartano le righe scritte dopo l'ultimo checkpoint (chunk interrotti)
+        with open(output_file, 'ab') as f:
+            f.truncate(checkpoint['output_bytes'])
+        total_saved = sum(checkpoint['done'].values())
+    else:
+        # Pulisce eventuale file di output precedente
+        open(output_file, 'w').close()
+        total_saved = 0
 
     start_time = time.time()
-    total_saved = 0
+
+    # I worker leggono da sé il proprio intervallo (byte o coppie); l'unico scrittore
+    # del file di output è il processo principale
+    def save_rows(task_id, filtered_rows):
+        nonlocal total_saved
+        if filtered_rows:
+            with open(output_file, 'a', newline='', encoding='utf-8') as f:
+                csv.writer(f).writerows(filtered_rows)
+        total_saved += len(filtered_rows)
+        print(f"Righe salvate finora: {total_saved}")
+        if checkpoint is not None:
+            checkpoint['done'][str(task_id)] = len(filtered_rows)
+            checkpoint['output_bytes'] = os.path.getsize(output_file)
+            save_checkpoint(checkpoint_file, checkpoint)
 
     try:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = set()
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=attach_shared_tables,
+                                 initargs=(table_specs,)) as executor:
+            futures = {}
             chunk_number = 0
-            chunk_iter = pd.read_csv(blocking_file, chunksize=chunk_size, dtype=str)
+            task_iter = candidate_tasks(blocking_file, chunk_size, range_bytes)
 
-            for chunk in chunk_iter:
+            for task in task_iter:
                 chunk_number += 1
+                if checkpoint is not None and str(chunk_number) in checkpoint['done']:
+                    print(f"Chunk {chunk_number} già completato: saltato")
+                    continue
                 print(f"\nInvio chunk {chunk_number} al worker disponibile...")
-                future = executor.submit(process_chunk, chunk, test_dict, output_file)
-                futures.add(future)
+                future = executor.submit(process_task, task, chunk_size)
+                futures[future] = chunk_number
 
                 # Limita chunk in RAM a max_workers: aspetta che almeno uno finisca
                 while len(futures) >= max_workers:
-                    done, futures = wait_one_done(futures)
-                    for saved_count in done:
-                        total_saved += saved_count
-                        print(f"Righe salvate finora: {total_saved}")
+                    future = next(as_completed(futures))
+                    save_rows(futures.pop(future), future.result())
 
             # Elabora eventuali chunk rimanenti
-            for future in as_completed(futures):
-                saved_count = future.result()
-                total_saved += saved_count
-                print(f"Righe salvate finora: {total_saved}")
+            for future in as_completed(list(futures)):
+                save_rows(futures.pop(future), future.result())
 
     except KeyboardInterrupt:
         print("\nInterruzione ricevuta! Terminazione immediata dei worker...")
+        if checkpoint_file:
+            print(f"Chunk completati salvati in {checkpoint_file}: rilanciare con resume=True")
         executor.shutdown(wait=False)
         return
+    finally:
+        release_shared_tables(shared_blocks)
 
     end_time = time.time()
     print("\n--- Elaborazione completata ---")
     print(f"Totale righe salvate nel file di backup: {total_saved}")
     print(f"Tempo totale: {end_time - start_time:.2f}s")
-
-# ------------------------------
-# Funzione helper per wait dei futures
-# ------------------------------
-def wait_one_done(futures_set):
-    done = []
-    for future in as_completed(futures_set):
-        done.append(future.result())
-        futures_set.remove(future)
-        break
-    return done, futures_set
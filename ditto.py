@@ -118,3 +118,38 @@ def evaluate_ditto_model(checkpoint_path, test_txt, lm='distilbert', max_len=256
     f1 = evaluate(model, test_loader, threshold=0.7)
     print(f"[RESULT] F1 Score: {f1:.4f}")
     return f1
+
+
+def ditto_scores(checkpoint_path, test_txt, output_csv, lm='distilbert', max_len=256, batch_size=64, device=None):
+    """
+    Salva una volta sola le probabilità di match di Ditto (CSV score,label, una riga per
+    coppia del file test.txt) per threshold_sweep.evaluate_thresholds
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"[INFO] Using device: {device}")
+
+    test_dataset = DittoDataset(test_txt, lm=lm, max_len=max_len)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=DittoDataset.pad)
+
+    model = DittoModel(lm=lm, device=device)
+    model.to(device)
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+    print("[INFO] Model loaded successfully.")
+
+    all_probs, all_y = [], []
+    with torch.no_grad():
+        for x, y in tqdm(test_loader):
+            logits = model(x)
+            all_probs.extend(logits.softmax(dim=1)[:, 1].cpu().numpy().tolist())
+            all_y.extend(y.cpu().numpy().tolist())
+
+    with open(output_csv, 'w', encoding='utf-8') as f:
+        f.write("score,label\n")
+        for prob, label in zip(all_probs, all_y):
+            f.write(f"{prob},{int(label)}\n")
+
+    print(f"[INFO] Scores saved to {output_csv} ({len(all_probs)} pairs)")
+    return output_csv
@@ -1,4 +1,5 @@
 import pandas as pd
+from blocking import read_candidate_pairs
 
 FIELDS = [
     "manufacturer",
@@ -74,8 +75,8 @@ def safe_str(val):
 
 
 def generate_ditto_input(candidates_csv, test_csv, output_txt):
-    # Leggi i CSV come stringhe
-    candidates = pd.read_csv(candidates_csv, dtype=str)
+    # Leggi i CSV come stringhe (anche formato compatto ..._pairs.bin)
+    candidates = pd.concat(read_candidate_pairs(candidates_csv), ignore_index=True)
     test = pd.read_csv(test_csv, dtype=str)
 
     # Rimuovi colonne invalid
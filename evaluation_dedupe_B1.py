@@ -1,6 +1,7 @@
 import csv
 import dedupe
 import itertools
+from blocking import is_compact_pairs, read_candidate_pairs
 
 
 def to_float(val):
@@ -16,6 +17,17 @@ def to_float(val):
         return None
 
 
+def iter_pairwise_rows(filename):
+    """Righe del file pairwise come dict di stringhe; per il formato compatto unisce gli attributi al volo."""
+    if is_compact_pairs(filename):
+        for chunk in read_candidate_pairs(filename):
+            yield from chunk.fillna("").to_dict("records")
+        return
+
+    with open(filename, newline="", encoding="utf-8") as f:
+        yield from csv.DictReader(f)
+
+
 def read_pairwise_dataset(filename, verbose_every=1000):
     """Legge un CSV pairwise e crea due dataset separati (data_1, data_2)."""
     numeric_fields = {"year", "mileage", "price"}
@@ -24,43 +36,40 @@ def read_pairwise_dataset(filename, verbose_every=1000):
     data_2 = {}
 
     print(f"[read_pairwise_dataset] Caricamento CSV: {filename}")
-    with open(filename, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-
-        for i, row in enumerate(reader):
-            record_a = {}
-            record_b = {}
-
-            for k, v in row.items():
-                # Conversione valore
-                if v is None or v.strip() == "":
-                    value = None
-                elif k in numeric_fields:
-                    value = to_float(v)
-                    if value is None:
-                        print(f"[DEBUG] riga {i}, campo {k} non convertibile: '{v}'")
-                else:
-                    value = v.strip().lower()
-
-                # Campi condivisi tra A e B
-                if k in ("manufacturer", "year"):
-                    record_a[k] = value
-                    record_b[k] = value
-                elif k.endswith("_a"):
-                    record_a[k[:-2]] = value
-                elif k.endswith("_b"):
-                    record_b[k[:-2]] = value
-                else:
-                    record_a[k] = value
-                    record_b[k] = value
-
-            data_1[f"A_{i}"] = record_a
-            data_2[f"B_{i}"] = record_b
-
-            if i < 5:
-                print(f"[pairwise] riga {i}: A_{i}, B_{i}")
-            elif i % verbose_every == 0:
-                print(f"[pairwise] riga {i} letta...")
+    for i, row in enumerate(iter_pairwise_rows(filename)):
+        record_a = {}
+        record_b = {}
+
+        for k, v in row.items():
+            # Conversione valore
+            if v is None or v.strip() == "":
+                value = None
+            elif k in numeric_fields:
+                value = to_float(v)
+                if value is None:
+                    print(f"[DEBUG] riga {i}, campo {k} non convertibile: '{v}'")
+            else:
+                value = v.strip().lower()
+
+            # Campi condivisi tra A e B
+            if k in ("manufacturer", "year"):
+                record_a[k] = value
+                record_b[k] = value
+            elif k.endswith("_a"):
+                record_a[k[:-2]] = value
+            elif k.endswith("_b"):
+                record_b[k[:-2]] = value
+            else:
+                record_a[k] = value
+                record_b[k] = value
+
+        data_1[f"A_{i}"] = record_a
+        data_2[f"B_{i}"] = record_b
+
+        if i < 5:
+            print(f"[pairwise] riga {i}: A_{i}, B_{i}")
+        elif i % verbose_every == 0:
+            print(f"[pairwise] riga {i} letta...")
 
     print(f"[read_pairwise_dataset] Record lato A: {len(data_1)}, lato B: {len(data_2)}")
     return data_1, data_2
@@ -234,3 +243,46 @@ def evaluate_dedupe(filename_pairwise, settings_file, groundtruth_csv, use_stati
     print(f"  F1 Score:  {f1:.4f}")
 
     return precision, recall, f1
+
+
+def dedupe_scores(filename_pairwise, settings_file, groundtruth_csv, output_csv, use_static=True):
+    """
+    Salva una volta sola i punteggi grezzi di dedupe (CSV id_1,id_2,score,label) per
+    threshold_sweep.evaluate_thresholds: join con soglia 0 e vincolo many-to-many, così ogni
+    coppia confrontata conserva il suo punteggio. Le coppie del ground truth non confrontate
+    sono salvate con punteggio vuoto (mai predette come match).
+    """
+    print("[dedupe_scores] STEP 1: Carico dati pairwise")
+    data_1, data_2 = read_pairwise_dataset(filename_pairwise)
+    data_1 = clean_numeric_fields(data_1)
+    data_2 = clean_numeric_fields(data_2)
+
+    print("[dedupe_scores] STEP 2: Applico blocking")
+    data_1, data_2, pair_to_index = index_B1_pairwise(data_1, data_2)
+
+    print("[dedupe_scores] STEP 3: Carico modello RecordLink addestrato")
+    with open(settings_file, "rb") as sf:
+        linker = dedupe.StaticRecordLink(sf) if use_static else dedupe.RecordLink(sf)
+
+    print("[dedupe_scores] STEP 4: Calcolo punteggi di tutte le coppie")
+    linked_records = linker.join(data_1, data_2, threshold=0.0, constraint="many-to-many")
+
+    all_ids = set(data_1.keys()) | set(data_2.keys())
+    groundtruth_pairs = read_groundtruth_pairwise(groundtruth_csv, valid_ids=all_ids)
+
+    scored = set()
+    with open(output_csv, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id_1", "id_2", "score", "label"])
+        for (id_1, id_2), score in linked_records:
+            pair = frozenset((id_1, id_2))
+            scored.add(pair)
+            writer.writerow([id_1, id_2, float(score), int(pair in groundtruth_pairs)])
+        for pair in groundtruth_pairs - scored:
+            id_1, id_2 = sorted(pair)
+            writer.writerow([id_1, id_2, "", 1])
+
+    print(f"[dedupe_scores] Coppie con punteggio: {len(scored)}, "
+          f"ground truth senza punteggio: {len(groundtruth_pairs - scored)}")
+    print(f"[dedupe_scores] Punteggi salvati in {output_csv}")
+    return output_csv
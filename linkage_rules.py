@@ -0,0 +1,40 @@
+# ------------------------------
+# Definizioni condivise delle regole (record_linkage e blocking)
+# ------------------------------
+# Equivalenze tra valori categorici
+FUEL_EQUIVALENCES = {'flex fuel vehicle': 'gasoline', 'biodiesel': 'diesel'}
+BODY_EQUIVALENCES = {'truck': 'pickup', 'offroad': ['suv','pickup']}
+DRIVE_EQUIVALENCES = {'4wd':'awd','awd':'4wd','fwd':'4x2','rwd':'4x2'}
+
+# Differenza massima di chilometraggio con punteggio > 0 (usata anche dal blocking con tolleranza sull'anno)
+MILEAGE_MAX_DIFF = 50000
+
+
+def equivalence_classes(equivalences):
+    """
+    Classi di equivalenza (union-find) da un dizionario di equivalenze delle regole,
+    es. BODY_EQUIVALENCES -> {truck, pickup, offroad, suv}.
+    Restituisce {valore: rappresentante della classe}.
+    """
+    parent = {}
+
+    def find(v):
+        parent.setdefault(v, v)
+        while parent[v] != v:
+            parent[v] = parent[parent[v]]
+            v = parent[v]
+        return v
+
+    for value, targets in equivalences.items():
+        for target in (targets if isinstance(targets, list) else [targets]):
+            root_a, root_b = find(value), find(target)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    return {v: find(v) for v in parent}
+
+
+# Classi di equivalenza calcolate una volta sola (usate dal blocking per non separare valori equivalenti)
+FUEL_CLASSES = equivalence_classes(FUEL_EQUIVALENCES)
+BODY_CLASSES = equivalence_classes(BODY_EQUIVALENCES)
+DRIVE_CLASSES = equivalence_classes(DRIVE_EQUIVALENCES)
@@ -12,6 +12,7 @@ import evaluation_dedupe_B1 as eval_dp
 # import ditto
 # import torch
 # import check_candidate_pairs 
+# import threshold_sweep
 
 
 
@@ -177,6 +178,22 @@ import evaluation_dedupe_B1 as eval_dp
 # )
 
 
+# Schema di blocking appreso da train.csv (alternativa a B1/B2 scelti a mano)
+# scheme = blocking.learn_blocking_scheme(
+#     train_file="train.csv",
+#     file_a="vehicles_final.csv",
+#     file_b="used_cars_final.csv",
+#     pair_budget=50_000_000,
+#     output_json="learned_blocking.json",
+# )
+# blocking.generate_candidate_pairs_learned(
+#     file_a="vehicles_final.csv",
+#     file_b="used_cars_final.csv",
+#     scheme="learned_blocking.json",
+#     output_prefix=r"D:\HM6\candidate_pairs_learned",
+# )
+
+
 # ===================================
 # STEP 4e – REGOLE PER RECORD LINKAGE
 # ===================================
@@ -197,7 +214,17 @@ import evaluation_dedupe_B1 as eval_dp
 #     'D:\HM6\candidate_pairs_B1.csv', 
 #     'test.csv', 
 #     chunk_size=1000000, 
-#     match_threshold=0.70
+#     match_threshold=0.70,
+#     file_a='vehicles_final.csv',  # tabelle delle regole costruite una volta sui dataset
+#     file_b='used_cars_final.csv'
+# )
+
+# Stesse metriche senza scansionare candidate_pairs_B1.csv
+# rl.evaluate_B1_direct(
+#     'test.csv',
+#     match_threshold=0.70,
+#     file_a='vehicles_final.csv',
+#     file_b='used_cars_final.csv'
 # )
 
 
@@ -209,7 +236,30 @@ import evaluation_dedupe_B1 as eval_dp
 #         chunk_size=500000,
 #         match_threshold=0.70,
 #         max_workers=8, 
-#         backup_file='B1_recordLinkage.csv'
+#         backup_file='B1_recordLinkage.bin',
+#         checkpoint_file='B1_recordLinkage.checkpoint.json',  # dopo Ctrl+C rilanciare con resume=True
+#         resume=False,
+#         file_a='vehicles_final.csv',  # tabelle delle regole costruite una volta sui dataset
+#         file_b='used_cars_final.csv'
+#     )
+
+# Tutte le soglie dai punteggi salvati in backup_file, senza rifare lo scan
+# threshold_sweep.evaluate_thresholds('B1_recordLinkage.bin', match_thresholds=(0.60, 0.70, 0.80),
+#                                     curve_csv='B1_pr_curve.csv')
+
+
+# Blocking B1 e regole in un solo passaggio, senza candidate_pairs_B1.csv
+# if __name__ == "__main__":
+
+#     rl.link_blocks_fused(
+#         'vehicles_final.csv',
+#         'used_cars_final.csv',
+#         r'D:\HM6\B1_fused',
+#         scheme='B1',
+#         emit='matches',
+#         match_threshold=0.70,
+#         test_file='test.csv',
+#         max_workers=8
 #     )
 
 
@@ -227,6 +277,10 @@ if __name__ == "__main__":
         groundtruth_csv="validation.csv"
     )
 
+# Punteggi dedupe salvati una volta, soglie valutate con threshold_sweep
+# eval_dp.dedupe_scores("B1_pairs_finale.csv", "settings.json", "validation.csv", "B1_dedupe_scores.csv")
+# threshold_sweep.evaluate_thresholds("B1_dedupe_scores.csv")
+
 
 # ===============================
 # STEP 4g – DITTO TRAINING
@@ -256,7 +310,9 @@ if __name__ == "__main__":
 #         test_file="test.csv",
 #         output_file="B1_pairs.csv",
 #         chunk_size=500_000, 
-#         max_workers=8        
+#         max_workers=8,
+#         checkpoint_file="B1_pairs.checkpoint.json",  # dopo Ctrl+C rilanciare con resume=True
+#         resume=False
 #     )
 
 # utils.remove_duplicates_from_csv("B1_pairs.csv", "B1_pairs_finale.csv")
@@ -268,4 +324,8 @@ if __name__ == "__main__":
 # ditto.evaluate_ditto_model(
 #     checkpoint_path = 'checkpoints/Homework6/model.pt',
 #     test_txt = 'B1_ditto_pairs.txt'
-# )
\ No newline at end of file
+# )
+
+# Probabilità di Ditto salvate una volta, soglie valutate con threshold_sweep
+# ditto.ditto_scores('checkpoints/Homework6/model.pt', 'B1_ditto_pairs.txt', 'B1_ditto_scores.csv')
+# threshold_sweep.evaluate_thresholds('B1_ditto_scores.csv')
\ No newline at end of file
@@ -1,12 +1,27 @@
 import pandas as pd
+import numpy as np
+import math
 import time
+from collections import Counter, OrderedDict
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.metrics import precision_score, recall_score, f1_score
 from concurrent.futures import ProcessPoolExecutor, as_completed
-from multiprocessing import Lock
-from threading import Lock
-import csv
+import threading
+import queue
+import json
+import os
+import shutil
+import tempfile
+from multiprocessing import shared_memory
+from blocking import (
+    read_candidate_pairs, BLOCKING_SCHEMES, partition_file, iter_block_products,
+    write_pair_ids, compact_pair_paths, write_compact_meta, PAIR_KEY_COLUMNS,
+    assign_record_ids, pairs_in_same_block, KEY_SEP,
+    candidate_tasks, load_candidate_task, CANDIDATE_RANGE_BYTES
+)
+# Regole condivise con il blocking (equivalenze categoriche, soglia di chilometraggio): definite in linkage_rules
+from linkage_rules import FUEL_EQUIVALENCES, BODY_EQUIVALENCES, DRIVE_EQUIVALENCES, MILEAGE_MAX_DIFF
 
 # ------------------------------
 # Funzioni di scoring
@@ -32,7 +47,7 @@ def score_model(model_a, model_b, max_score=0.5):
     cos_sim = cosine_similarity(v[0], v[1])[0][0]
     return cos_sim * max_score
 
-def score_mileage(mileage_a, mileage_b, max_score=0.1, max_diff=50000):
+def score_mileage(mileage_a, mileage_b, max_score=0.1, max_diff=MILEAGE_MAX_DIFF):
     if mileage_a is None or mileage_b is None:
         return 0
     try:
@@ -48,7 +63,7 @@ def score_fuel(fuel_a, fuel_b, max_score=0.05):
     fuel_b_str = safe_str(fuel_b).lower()
     if fuel_a_str == '' or fuel_b_str == '':
         return 0
-    equivalences = {'flex fuel vehicle': 'gasoline', 'biodiesel': 'diesel'}
+    equivalences = FUEL_EQUIVALENCES
     if fuel_a_str == fuel_b_str:
         return max_score
     elif fuel_a_str in equivalences and equivalences[fuel_a_str] == fuel_b_str:
@@ -64,7 +79,7 @@ def score_body(body_a, body_b, max_score=0.05):
     body_b_str = safe_str(body_b).lower()
     if body_a_str == '' or body_b_str == '':
         return 0
-    equivalences = {'truck': 'pickup', 'offroad': ['suv','pickup']}
+    equivalences = BODY_EQUIVALENCES
     if body_a_str == body_b_str:
         return max_score
     elif body_a_str in equivalences:
@@ -101,7 +116,7 @@ def score_drive(drive_a, drive_b, max_score=0.02):
     drive_b_str = safe_str(drive_b).lower()
     if drive_a_str == '' or drive_b_str == '':
         return 0
-    equivalences = {'4wd':'awd','awd':'4wd','fwd':'4x2','rwd':'4x2'}
+    equivalences = DRIVE_EQUIVALENCES
     if drive_a_str == drive_b_str:
         return max_score
     elif drive_a_str in equivalences and equivalences[drive_a_str] == drive_b_str:
@@ -124,29 +139,593 @@ def score_exact(field_a, field_b, max_score):
         return 0
     return max_score if field_a_str == field_b_str else 0
 
+# ------------------------------
+# Scoring vettoriale di un intero chunk
+# ------------------------------
+# Colonne (lato A, lato B) di ogni campo nel formato del blocking B1.
+# manufacturer e year sono condivisi: se il file contiene anche
+# manufacturer_b / year_b si usano quelle per il lato B (come nella chiave del test set).
+B1_PAIR_COLUMNS = {
+    'model': ('model_a', 'model_b'),
+    'manufacturer': ('manufacturer', 'manufacturer_b'),
+    'year': ('year', 'year_b'),
+    'mileage': ('mileage_a', 'mileage_b'),
+    'fuel_type': ('fuel_type_a', 'fuel_type_b'),
+    'transmission': ('transmission_a', 'transmission_b'),
+    'body_type': ('body_type_a', 'body_type_b'),
+    'cylinders': ('cylinders_a', 'cylinders_b'),
+    'drive': ('drive_a', 'drive_b'),
+    'color': ('color_a', 'color_b'),
+}
+
+# Stessi campi nel formato a_/b_ (ground truth, test.csv, blocking B2)
+AB_PAIR_COLUMNS = {field: (f'a_{field}', f'b_{field}') for field in B1_PAIR_COLUMNS}
+
+# Campi della chiave del test set, nello stesso ordine per il lato a_ e il lato b_
+TEST_FIELDS = ['manufacturer','model','year','mileage','fuel_type','transmission','body_type',
+               'cylinders','drive','color']
+
+# Tokenizzazione identica a quella di TfidfVectorizer() usato in score_model
+_model_analyzer = TfidfVectorizer().build_analyzer()
+
+
+def _column_values(chunk, col, fallback=None):
+    """Valori di una colonna come array di stringhe ('' per i mancanti, come safe_str)."""
+    if col not in chunk.columns:
+        col = fallback
+    return chunk[col].fillna('').astype(str).to_numpy(dtype=object)
+
+
+def _score_unique_pairs(values_a, values_b, pair_score):
+    """
+    Applica pair_score una sola volta per ogni coppia distinta (valore_a, valore_b)
+    e ridistribuisce il risultato su tutte le righe del chunk.
+    """
+    codes_a, uniques_a = pd.factorize(values_a)
+    codes_b, uniques_b = pd.factorize(values_b)
+    n_b = max(len(uniques_b), 1)
+    pair_codes = codes_a.astype('int64') * n_b + codes_b
+    unique_codes, inverse = np.unique(pair_codes, return_inverse=True)
+    scores = np.array(
+        [pair_score(uniques_a[code // n_b], uniques_b[code % n_b]) for code in unique_codes],
+        dtype=float
+    )
+    return scores[inverse.reshape(-1)] if len(scores) else np.zeros(len(values_a))
+
+
+def _pair_cosine(counts_a, counts_b):
+    """
+    Cosine similarity TF-IDF tra due conteggi di token, con vocabolario e idf stimati
+    sulle sole due stringhe come in score_model. Con due documenti l'idf smussato vale
+    1 per i termini comuni e log(3/2) + 1 per gli altri.
+    """
+    if not counts_a or not counts_b:
+        return 0.0
+    idf_single = math.log(3 / 2) + 1
+    weights_a = {t: c * (1.0 if t in counts_b else idf_single) for t, c in counts_a.items()}
+    weights_b = {t: c * (1.0 if t in counts_a else idf_single) for t, c in counts_b.items()}
+    norm_a = math.sqrt(sum(w * w for w in weights_a.values()))
+    norm_b = math.sqrt(sum(w * w for w in weights_b.values()))
+    return sum(
+        (weights_a[t] / norm_a) * (weights_b[t] / norm_b)
+        for t in sorted(weights_a.keys() & weights_b.keys())
+    )
+
+
+def model_cosine(model_a, model_b):
+    """Come score_model (senza max_score) ma senza costruire un TfidfVectorizer."""
+    return _pair_cosine(Counter(_model_analyzer(model_a)), Counter(_model_analyzer(model_b)))
+
+
+# ------------------------------
+# Servizio di similarità sul campo model
+# ------------------------------
+class ModelSimilarity:
+    """
+    Similarità TF-IDF tra stringhe model con memoizzazione.
+
+    - idf='pair'   : idf stimato sulle sole due stringhe, identico a score_model (default)
+    - idf='corpus' : vocabolario e idf stimati una volta con fit() / fit_files()
+                     (una volta per run, oppure una volta per blocco)
+
+    Ogni stringa distinta viene vettorizzata una sola volta; il punteggio di ogni
+    coppia distinta è memorizzato in una cache LRU di al più max_pairs elementi.
+    hits / misses contano gli accessi alla cache delle coppie.
+    """
+
+    def __init__(self, idf='pair', max_pairs=1_000_000):
+        if idf not in ('pair', 'corpus'):
+            raise ValueError("idf deve essere 'pair' o 'corpus'")
+        self.idf = idf
+        self.max_pairs = max_pairs
+        self.vectorizer = None
+        self._vectors = {}
+        self._pairs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def fit(self, models):
+        """Stima vocabolario e idf sul corpus di stringhe model (solo idf='corpus')."""
+        corpus = [m for m in pd.unique(pd.Series(list(models), dtype=object).dropna().astype(str)) if m != '']
+        self.vectorizer = TfidfVectorizer().fit(corpus)
+        self.idf = 'corpus'
+        self.clear()
+        return self
+
+    def fit_files(self, *files, chunk_size=500_000):
+        """fit() sulle stringhe model distinte di uno o più CSV letti a chunk."""
+        models = set()
+        for path in files:
+            for chunk in pd.read_csv(path, usecols=['model'], chunksize=chunk_size, dtype=str):
+                models.update(chunk['model'].dropna().unique())
+        return self.fit(models)
+
+    def clear(self):
+        self._vectors.clear()
+        self._pairs.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'cached_pairs': len(self._pairs),
+            'cached_strings': len(self._vectors),
+        }
+
+    def _vector(self, model):
+        vec = self._vectors.get(model)
+        if vec is None:
+            if self.idf == 'pair':
+                vec = Counter(_model_analyzer(model))
+            else:
+                vec = self.vectorizer.transform([model])
+            self._vectors[model] = vec
+        return vec
+
+    def _compute(self, model_a, model_b):
+        vec_a = self._vector(model_a)
+        vec_b = self._vector(model_b)
+        if self.idf == 'pair':
+            return _pair_cosine(vec_a, vec_b)
+        # righe già normalizzate L2: il prodotto scalare è la cosine similarity
+        return float(vec_a.multiply(vec_b).sum())
+
+    def similarity(self, model_a, model_b):
+        """Cosine similarity tra due stringhe model ('' o mancante -> 0)."""
+        model_a = safe_str(model_a)
+        model_b = safe_str(model_b)
+        if model_a == '' or model_b == '':
+            return 0.0
+        key = (model_a, model_b) if model_a <= model_b else (model_b, model_a)
+        score = self._pairs.get(key)
+        if score is not None:
+            self.hits += 1
+            self._pairs.move_to_end(key)
+            return score
+        self.misses += 1
+        score = self._compute(*key)
+        self._pairs[key] = score
+        if len(self._pairs) > self.max_pairs:
+            self._pairs.popitem(last=False)
+        return score
+
+    def scores(self, values_a, values_b, max_score=0.5):
+        """Punteggio model (similarità * max_score) per array di stringhe allineati."""
+        return _score_unique_pairs(
+            values_a, values_b,
+            lambda a, b: self.similarity(a, b) * max_score
+        )
+
+
+# Servizio di default (idf per coppia, come score_model), uno per processo
+model_similarity = ModelSimilarity()
+
+
+def _mileage_scores(values_a, values_b, max_score=0.1, max_diff=MILEAGE_MAX_DIFF):
+    # int(float(x)) di score_mileage -> troncamento; valori non numerici -> 0
+    mileage_a = np.trunc(pd.to_numeric(pd.Series(values_a), errors='coerce').to_numpy(dtype=float))
+    mileage_b = np.trunc(pd.to_numeric(pd.Series(values_b), errors='coerce').to_numpy(dtype=float))
+    with np.errstate(invalid='ignore'):
+        diff = np.abs(mileage_a - mileage_b)
+        valid = diff <= max_diff
+    scores = np.zeros(len(diff))
+    scores[valid] = max_score * (1 - diff[valid] / max_diff)
+    return scores
+
+
+def _exact_scores(values_a, values_b, max_score):
+    non_empty = (values_a != '') & (values_b != '')
+    return np.where(non_empty & (values_a == values_b), max_score, 0.0)
+
+
+# ------------------------------
+# Tabelle precalcolate delle regole sui campi categorici
+# ------------------------------
+class RuleTable:
+    """
+    Regola di un campo categorico compilata in una matrice densa codice_a x codice_b -> punteggio.
+
+    I valori (stringhe come in _column_values) sono codificati in interi con un vocabolario
+    unico per il dataset; la matrice è generata applicando la regola scalare (score_fuel,
+    score_body, ...) a ogni coppia del vocabolario, quindi le equivalenze restano definite
+    solo in FUEL_EQUIVALENCES / BODY_EQUIVALENCES / DRIVE_EQUIVALENCES.
+    Il punteggio di un chunk è un gather matrix[codici_a, codici_b].
+
+    Il vocabolario si costruisce una volta con fit() / fit_files() (fit_rule_tables), oppure
+    cresce da sé con i valori nuovi trovati nei chunk: la matrice ha una capacità che raddoppia,
+    e a ogni aggiunta si calcolano solo le celle dei valori nuovi. Oltre max_vocab valori si
+    torna alla regola applicata alle coppie distinte del chunk (_score_unique_pairs),
+    segnalato una volta sola.
+    """
+
+    def __init__(self, rule, field=None, max_vocab=4096):
+        self.rule = rule
+        self.field = field
+        self.max_vocab = max_vocab
+        self.codes = {}
+        self.values = []
+        self.matrix = np.zeros((0, 0))
+        self._capacity = np.zeros((0, 0))
+        self._rule_grid = np.frompyfunc(rule, 2, 1)
+        self._fallback_logged = False
+
+    def fit(self, values):
+        """Aggiunge al vocabolario i valori distinti (es. tutti quelli del campo in A e B)."""
+        uniques = pd.unique(pd.Series(list(values), dtype=object).fillna('').astype(str))
+        new_values = [v for v in uniques if v not in self.codes]
+        if len(self.values) + len(new_values) > self.max_vocab:
+            self._log_fallback()
+            return self
+        self._add(new_values)
+        return self
+
+    def fit_files(self, *files, chunk_size=500_000):
+        """fit() sui valori distinti della colonna self.field di uno o più CSV letti a chunk."""
+        values = set()
+        for path in files:
+            for chunk in pd.read_csv(path, usecols=[self.field], chunksize=chunk_size, dtype=str):
+                values.update(chunk[self.field].fillna('').unique())
+        return self.fit(sorted(values))
+
+    def _log_fallback(self):
+        if not self._fallback_logged:
+            self._fallback_logged = True
+            print(f"RuleTable {self.field}: oltre {self.max_vocab} valori distinti, "
+                  f"regola applicata alle coppie distinte dei chunk")
+
+    def _add(self, new_values):
+        if not new_values:
+            return
+        old_n = len(self.values)
+        for value in new_values:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+        n = len(self.values)
+
+        if n > len(self._capacity):
+            # capacità raddoppiata: la copia della matrice è ammortizzata sulle aggiunte
+            size = max(n, min(2 * len(self._capacity), self.max_vocab), 16)
+            capacity = np.empty((size, size))
+            capacity[:old_n, :old_n] = self._capacity[:old_n, :old_n]
+            self._capacity = capacity
+
+        # righe dei valori nuovi su tutto il vocabolario, colonne dei nuovi per i valori già presenti
+        values = np.array(self.values, dtype=object)
+        self._capacity[old_n:n, :n] = self._rule_grid(values[old_n:, None], values[None, :])
+        self._capacity[:old_n, old_n:n] = self._rule_grid(values[:old_n, None], values[None, old_n:])
+        self.matrix = self._capacity[:n, :n]
+
+    def _global_codes(self, local_codes, uniques):
+        mapping = np.fromiter((self.codes[v] for v in uniques), dtype=np.int64, count=len(uniques))
+        return mapping[local_codes]
+
+    def encode(self, values):
+        """Codici interi dei valori; i valori nuovi vengono aggiunti al vocabolario."""
+        local_codes, uniques = pd.factorize(values)
+        self._add([v for v in uniques if v not in self.codes])
+        return self._global_codes(local_codes, uniques)
+
+    def scores(self, values_a, values_b):
+        """Punteggio della regola per array di stringhe allineati."""
+        if len(values_a) == 0:
+            return np.zeros(0)
+        # codifica locale del chunk (valori distinti), poi mappa sui codici del vocabolario
+        local_a, uniques_a = pd.factorize(values_a)
+        local_b, uniques_b = pd.factorize(values_b)
+        new_values = list(dict.fromkeys(v for v in (*uniques_a, *uniques_b) if v not in self.codes))
+        if len(self.values) + len(new_values) > self.max_vocab:
+            self._log_fallback()
+            return _score_unique_pairs(values_a, values_b, self.rule)
+        self._add(new_values)
+        return self.matrix[self._global_codes(local_a, uniques_a), self._global_codes(local_b, uniques_b)]
+
+
+# Regole dei campi categorici, una tabella per campo (per processo, come model_similarity)
+RULE_FIELDS = {
+    'fuel_type': score_fuel,
+    'body_type': score_body,
+    'cylinders': score_cylinders,
+    'drive': score_drive,
+    'color': score_color,
+}
+rule_tables = {field: RuleTable(rule, field) for field, rule in RULE_FIELDS.items()}
+
+
+def fit_rule_tables(*files, chunk_size=500_000):
+    """Costruisce una volta i vocabolari di tutte le rule_tables dai dataset (es. A e B)."""
+    for table in rule_tables.values():
+        table.fit_files(*files, chunk_size=chunk_size)
+    return rule_tables
+
+
+def rule_vocabularies():
+    """Vocabolari delle rule_tables del processo, da passare all'initializer dei worker."""
+    return {field: list(table.values) for field, table in rule_tables.items()}
+
+
+def load_rule_vocabularies(vocabularies):
+    """Nei worker: stesso vocabolario (e stessi codici) del processo principale, senza rileggere i file."""
+    for field, values in (vocabularies or {}).items():
+        rule_tables[field].fit(values)
+
+
+# Punteggio massimo del model (score_model): margine ancora raggiungibile dopo i campi economici
+MODEL_MAX_SCORE = 0.5
+
+# Margine sulle decisioni anticipate: copre gli errori di arrotondamento delle somme
+PRUNING_EPS = 1e-9
+
+
+def new_pruning_stats():
+    """Contatori di score_pairs(match_threshold=...): coppie viste e valutazioni del model saltate."""
+    return {'pairs': 0, 'model_evaluated': 0, 'skipped_below': 0, 'skipped_above': 0}
+
+
+def score_pairs(chunk, columns=B1_PAIR_COLUMNS, model_sim=None, model_scores=None,
+                match_threshold=None, prune_matches=True, stats=None):
+    """
+    Calcola il punteggio totale delle regole per tutte le coppie di un DataFrame,
+    campo per campo su intere colonne. Restituisce un array NumPy con un punteggio
+    per riga, uguale alla somma delle funzioni score_* applicate riga per riga.
+
+    columns: mappa campo -> (colonna lato A, colonna lato B),
+             B1_PAIR_COLUMNS per i file di blocking B1, AB_PAIR_COLUMNS per il formato a_/b_.
+    model_sim: istanza di ModelSimilarity (default: model_similarity, idf per coppia).
+    model_scores: punteggi del model già calcolati per le righe (es. dalla tabella condivisa del test set).
+    match_threshold: se indicato, i campi economici vengono valutati prima e il model (TF-IDF)
+                     solo per le coppie il cui esito rispetto alla soglia non è già deciso:
+                     - punteggio parziale + MODEL_MAX_SCORE < soglia: non può essere un match
+                     - punteggio parziale >= soglia (solo con prune_matches): è già un match
+                     Per le coppie saltate il punteggio restituito è quello parziale (senza model),
+                     la decisione punteggio >= soglia resta identica.
+    stats: dizionario di new_pruning_stats() aggiornato con i conteggi.
+    """
+    if model_sim is None:
+        model_sim = model_similarity
+
+    values = {}
+    for field, (col_a, col_b) in columns.items():
+        values[field] = (
+            _column_values(chunk, col_a),
+            _column_values(chunk, col_b, fallback=col_a)
+        )
+
+    # Campi economici prima (confronti vettoriali, poi regole sui valori distinti), il model per ultimo
+    fields = [
+        _exact_scores(*values['manufacturer'], 0.2),
+        _exact_scores(*values['year'], 0.1),
+        _mileage_scores(*values['mileage']),
+        rule_tables['fuel_type'].scores(*values['fuel_type']),
+        _exact_scores(*values['transmission'], 0.05),
+        rule_tables['body_type'].scores(*values['body_type']),
+        rule_tables['cylinders'].scores(*values['cylinders']),
+        rule_tables['drive'].scores(*values['drive']),
+        rule_tables['color'].scores(*values['color']),
+    ]
+
+    if model_scores is not None:
+        model = model_scores
+    elif match_threshold is None:
+        model = model_sim.scores(*values['model'])
+    else:
+        partial = np.sum(fields, axis=0) if len(chunk) else np.zeros(0)
+        below = partial + MODEL_MAX_SCORE < match_threshold - PRUNING_EPS
+        above = partial >= match_threshold + PRUNING_EPS if prune_matches else np.zeros(len(chunk), dtype=bool)
+        undecided = np.flatnonzero(~(below | above))
+        model = np.zeros(len(chunk))
+        if len(undecided):
+            model[undecided] = model_sim.scores(values['model'][0][undecided], values['model'][1][undecided])
+        if stats is not None:
+            stats['pairs'] += len(chunk)
+            stats['model_evaluated'] += len(undecided)
+            stats['skipped_below'] += int(below.sum())
+            stats['skipped_above'] += int(above.sum())
+
+    # Stesso ordine di somma delle regole riga per riga
+    total = np.zeros(len(chunk))
+    total += model
+    for field_scores in fields:
+        total += field_scores
+    return total
+
+# ------------------------------
+# Semi-join vettoriale con il test set
+# ------------------------------
+def pair_key_frame(chunk, columns=B1_PAIR_COLUMNS):
+    """
+    Chiave di coppia del test set per tutte le righe: 10 campi di A poi 10 di B,
+    stringhe con '' per i mancanti (come le tuple di safe_str).
+    columns: B1_PAIR_COLUMNS per i file di blocking, AB_PAIR_COLUMNS per test.csv.
+    """
+    keys = {}
+    for field in TEST_FIELDS:
+        keys['a_' + field] = _column_values(chunk, columns[field][0])
+    for field in TEST_FIELDS:
+        keys['b_' + field] = _column_values(chunk, columns[field][1], fallback=columns[field][0])
+    return pd.DataFrame(keys, index=chunk.index)
+
+
+def hash_pair_keys(keys):
+    """Hash a 64 bit di ogni riga di una pair_key_frame."""
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def build_test_dict(df_test, labels=True):
+    """
+    Dizionario chiave di coppia -> etichetta 'match' (labels=True) o True, costruito su intere colonne.
+    Come il dizionario costruito riga per riga, per chiavi ripetute vale l'ultima riga.
+    """
+    keys = pair_key_frame(df_test, AB_PAIR_COLUMNS).itertuples(index=False, name=None)
+    values = df_test['match'].astype(int).tolist() if labels else [True] * len(df_test)
+    return dict(zip(keys, values))
+
+
+def test_key_hashes(test_dict):
+    """Array ordinato degli hash delle chiavi del test set, per il filtro con np.isin."""
+    keys = pd.DataFrame(list(test_dict), columns=['a_' + f for f in TEST_FIELDS] + ['b_' + f for f in TEST_FIELDS])
+    return np.unique(hash_pair_keys(keys))
+
+
+def test_set_hits(chunk, test_dict, test_hashes=None):
+    """
+    Righe del chunk la cui chiave di coppia è nel test set: filtro sugli hash dell'intero chunk
+    (np.isin) e verifica della tupla esatta solo sulle righe candidate.
+    Restituisce (posizioni nel chunk, tuple chiave).
+    """
+    if test_hashes is None:
+        test_hashes = test_key_hashes(test_dict)
+    keys = pair_key_frame(chunk)
+    candidates = np.flatnonzero(np.isin(hash_pair_keys(keys), test_hashes))
+
+    hit_positions = []
+    hit_tuples = []
+    for pos, pair_tuple in zip(candidates, keys.iloc[candidates].itertuples(index=False, name=None)):
+        if pair_tuple in test_dict:
+            hit_positions.append(int(pos))
+            hit_tuples.append(pair_tuple)
+    return hit_positions, hit_tuples
+
+# ------------------------------
+# Tabelle di lookup del test set in memoria condivisa
+# ------------------------------
+# Nei worker: array NumPy collegati (zero-copy) dall'initializer del pool
+_shared_tables = {}
+_shared_blocks = []
+
+
+def build_test_tables(test_dict, model_sim=None):
+    """
+    Tabelle di lookup del test set come array NumPy allineati, ordinati per hash:
+    - hashes: hash a 64 bit della chiave di coppia (ricerca con np.searchsorted)
+    - keys: chiave completa (20 campi uniti da KEY_SEP, UTF-8) per la verifica esatta
+    - labels: etichetta match
+    - model_scores: punteggio del model della coppia, calcolato una volta sola
+    """
+    if model_sim is None:
+        model_sim = model_similarity
+    key_columns = ['a_' + f for f in TEST_FIELDS] + ['b_' + f for f in TEST_FIELDS]
+    keys = pd.DataFrame(list(test_dict), columns=key_columns)
+    hashes = hash_pair_keys(keys)
+    order = np.argsort(hashes, kind='stable')
+
+    joined = keys[key_columns[0]].str.cat([keys[c] for c in key_columns[1:]], sep=KEY_SEP)
+    return {
+        'hashes': hashes[order],
+        'keys': np.array([k.encode('utf-8') for k in joined], dtype=bytes)[order],
+        'labels': np.array([int(v) for v in test_dict.values()], dtype=np.int8)[order],
+        'model_scores': model_sim.scores(keys['a_model'].to_numpy(dtype=object),
+                                         keys['b_model'].to_numpy(dtype=object))[order],
+    }
+
+
+def create_shared_tables(tables):
+    """Copia le tabelle in blocchi multiprocessing.shared_memory. Restituisce (blocchi, descrittori per i worker)."""
+    blocks = []
+    specs = {}
+    for name, array in tables.items():
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        blocks.append(shm)
+        specs[name] = (shm.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def attach_shared_tables(specs, vocabularies=None):
+    """
+    Initializer del pool: collega le tabelle condivise come array NumPy del worker, senza copie.
+    vocabularies: vocabolari delle rule_tables del processo principale (rule_vocabularies()).
+    """
+    load_rule_vocabularies(vocabularies)
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared_blocks.append(shm)
+        _shared_tables[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def release_shared_tables(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+
+def shared_test_hits(chunk, tables=None):
+    """
+    Come test_set_hits, sulle tabelle del test set: restituisce (posizioni nel chunk,
+    indici delle coppie nelle tabelle). Hash cercati con np.searchsorted, chiave
+    completa confrontata solo sulle righe candidate.
+    """
+    if tables is None:
+        tables = _shared_tables
+    keys = pair_key_frame(chunk)
+    hashes = hash_pair_keys(keys)
+    idx = np.searchsorted(tables['hashes'], hashes)
+    idx[idx == len(tables['hashes'])] = 0
+    candidates = np.flatnonzero(tables['hashes'][idx] == hashes) if len(tables['hashes']) else np.empty(0, dtype=int)
+
+    candidate_keys = keys.iloc[candidates]
+    joined = candidate_keys.iloc[:, 0].str.cat([candidate_keys.iloc[:, j] for j in range(1, keys.shape[1])], sep=KEY_SEP)
+    exact = np.array([k.encode('utf-8') for k in joined], dtype=bytes) == tables['keys'][idx[candidates]]
+    return candidates[exact], idx[candidates[exact]]
+
+
 # ------------------------------
 # Funzione ottimizzata con early pruning e print su test set
 # ------------------------------
-def evaluate_B1(blocking_file, test_file, chunk_size=1000000, match_threshold=0.70):
+def evaluate_B1(blocking_file, test_file, chunk_size=1000000, match_threshold=0.70, model_sim=None, scores_file=None,
+                file_a=None, file_b=None):
+    # model_sim: ModelSimilarity da usare (es. ModelSimilarity().fit_files(file_a, file_b)
+    # per un idf stimato una volta sull'intero corpus); default idf per coppia
+    # scores_file: log binario dei punteggi grezzi (come backup_file di evaluate_B1_parallel),
+    # da cui threshold_sweep.evaluate_thresholds valuta qualsiasi soglia senza rifare lo scan
+    # file_a / file_b: dataset di origine, per costruire una volta le tabelle delle regole (fit_rule_tables)
+    # Coppie del test set non generate dal blocking: contano come non match (come evaluate_B1_parallel
+    # e link_blocks_fused) e nel log hanno punteggio NaN, quindi la soglia scelta dal log dà le stesse metriche
+    if model_sim is None:
+        model_sim = model_similarity
+    if file_a is not None and file_b is not None:
+        fit_rule_tables(file_a, file_b)
+
     # Carico test file
     df_test = pd.read_csv(test_file, dtype=str)
     
     # Creo dizionario di lookup: chiave = tutti i campi principali di A e B, valore = match
-    test_dict = {
-        tuple(safe_str(df_test.loc[i, col]) for col in [
-            'a_manufacturer','a_model','a_year','a_mileage','a_fuel_type','a_transmission','a_body_type',
-            'a_cylinders','a_drive','a_color',
-            'b_manufacturer','b_model','b_year','b_mileage','b_fuel_type','b_transmission','b_body_type',
-            'b_cylinders','b_drive','b_color'
-        ]): int(df_test.loc[i, 'match'])
-        for i in df_test.index
-    }
+    test_dict = build_test_dict(df_test)
+    test_hashes = test_key_hashes(test_dict)
 
     # Traccia righe test set valutate
     evaluated_test_set = set()
     
     y_true = []
     y_pred = []
+    sink = ResultSink(scores_file) if scores_file else None
+    # senza log dei punteggi serve solo la decisione: il model è saltato quando l'esito è già deciso
+    pruning = new_pruning_stats()
+    key_columns = ['a_' + f for f in TEST_FIELDS] + ['b_' + f for f in TEST_FIELDS]
     
     start_train = time.time()
     end_train = time.time()
@@ -155,54 +734,47 @@ def evaluate_B1(blocking_file, test_file, chunk_size=1000000, match_threshold=0.
     chunk_number = 0
     total_rows = 0
     
-    for chunk in pd.read_csv(blocking_file, chunksize=chunk_size, dtype=str):
+    for chunk in read_candidate_pairs(blocking_file, chunk_size):
         chunk_number += 1
         print(f"\n--- Elaborazione chunk {chunk_number} ---")
-        for idx, row in chunk.iterrows():
-            total_rows += 1
+        total_rows += len(chunk)
+
+        # Early pruning: calcolo solo sulle coppie del test set (semi-join sugli hash della chiave)
+        hit_positions, hit_tuples = test_set_hits(chunk, test_dict, test_hashes)
+
+        # Punteggio calcolato in blocco sulle sole righe del test set
+        scores = score_pairs(chunk.iloc[hit_positions], model_sim=model_sim,
+                             match_threshold=None if sink else match_threshold, stats=pruning)
+        for pair_tuple, total_score in zip(hit_tuples, scores):
+            true_match = test_dict[pair_tuple]
+            pred_match = 1 if total_score >= match_threshold else 0
+            y_true.append(true_match)
+            y_pred.append(pred_match)
             
-            # Creo chiave univoca della coppia
-            pair_tuple = (
-                safe_str(row['manufacturer']), safe_str(row['model_a']), safe_str(row['year']),
-                safe_str(row['mileage_a']), safe_str(row['fuel_type_a']), safe_str(row['transmission_a']),
-                safe_str(row['body_type_a']), safe_str(row['cylinders_a']), safe_str(row['drive_a']),
-                safe_str(row['color_a']),
-                safe_str(row.get('manufacturer_b', row['manufacturer'])), safe_str(row['model_b']),
-                safe_str(row.get('year_b', row['year'])), safe_str(row.get('mileage_b', row['mileage_a'])),
-                safe_str(row.get('fuel_type_b', row['fuel_type_a'])), safe_str(row.get('transmission_b', row['transmission_a'])),
-                safe_str(row.get('body_type_b', row['body_type_a'])), safe_str(row.get('cylinders_b', row['cylinders_a'])),
-                safe_str(row.get('drive_b', row['drive_a'])), safe_str(row.get('color_b', row['color_a']))
-            )
+            evaluated_test_set.add(pair_tuple)
             
-            # Early pruning: calcolo solo se la coppia è nel test set
-            if pair_tuple in test_dict:
-                true_match = test_dict[pair_tuple]
-                
-                # Calcolo punteggio
-                total_score = 0
-                total_score += score_model(row['model_a'], row['model_b'])
-                total_score += score_exact(row['manufacturer'], row['manufacturer'], 0.2)
-                total_score += score_exact(row['year'], row['year'], 0.1)
-                total_score += score_mileage(row['mileage_a'], row['mileage_b'])
-                total_score += score_fuel(row['fuel_type_a'], row['fuel_type_b'])
-                total_score += score_exact(row['transmission_a'], row['transmission_b'], 0.05)
-                total_score += score_body(row['body_type_a'], row['body_type_b'])
-                total_score += score_cylinders(row['cylinders_a'], row['cylinders_b'])
-                total_score += score_drive(row['drive_a'], row['drive_b'])
-                total_score += score_color(row['color_a'], row['color_b'])
-                
-                pred_match = 1 if total_score >= match_threshold else 0
-                y_true.append(true_match)
-                y_pred.append(pred_match)
-                
-                evaluated_test_set.add(pair_tuple)
-                
-                if len(evaluated_test_set) % 100 == 0:
-                    print(f"Righe del test set già valutate: {len(evaluated_test_set)} / {len(df_test)}")
+            if len(evaluated_test_set) % 100 == 0:
+                print(f"Righe del test set già valutate: {len(evaluated_test_set)} / {len(df_test)}")
+
+        if sink and hit_tuples:
+            labels = np.array([test_dict[t] for t in hit_tuples])
+            sink.put(result_records(hash_pair_keys(pd.DataFrame(hit_tuples, columns=key_columns)),
+                                    scores, (scores >= match_threshold).astype(int), labels))
         
         print(f"Chunk {chunk_number} completato. Test set valutato finora: {len(evaluated_test_set)} / {len(df_test)}")
     
     end_infer = time.time()
+
+    # Coppie del test set mai trovate nel blocking: non match, nel log con punteggio NaN
+    missing = [t for t in test_dict if t not in evaluated_test_set]
+    y_true.extend(test_dict[t] for t in missing)
+    y_pred.extend([0] * len(missing))
+    if sink:
+        if missing:
+            sink.put(result_records(hash_pair_keys(pd.DataFrame(missing, columns=key_columns)),
+                                    np.nan, 0, [test_dict[t] for t in missing]))
+        sink.close()
+        print(f"Log dei punteggi: {scores_file} ({sink.rows_written} record)")
     
     precision = precision_score(y_true, y_pred)
     recall = recall_score(y_true, y_pred)
@@ -216,6 +788,12 @@ def evaluate_B1(blocking_file, test_file, chunk_size=1000000, match_threshold=0.
     print(f"Righe del test set valutate: {len(evaluated_test_set)} / {len(df_test)}")
     print(f"Precision: {precision:.4f}, Recall: {recall:.4f}, F1: {f1:.4f}")
     print(f"Tempo train: {train_time:.2f}s, Tempo inferenza: {infer_time:.2f}s")
+    cache = model_sim.stats()
+    print(f"Cache model: {cache['hits']} hit, {cache['misses']} miss "
+          f"(hit rate {cache['hit_rate']:.2%}, coppie in cache {cache['cached_pairs']})")
+    if pruning['pairs']:
+        print(f"Model saltato: {pruning['skipped_below']} sotto soglia, {pruning['skipped_above']} già match "
+              f"(valutato su {pruning['model_evaluated']} / {pruning['pairs']} coppie)")
     
     return {
         'precision': precision,
@@ -226,6 +804,82 @@ def evaluate_B1(blocking_file, test_file, chunk_size=1000000, match_threshold=0.
     }
 
 
+# ------------------------------
+# Valutazione diretta: blocking applicato alle coppie del test set
+# ------------------------------
+def _side_counts(path, side_keys, chunk_size):
+    """Numero di record del file con esattamente i valori di ogni lato del test set (hash dei 10 campi)."""
+    side_hashes = hash_pair_keys(side_keys)
+    counts = pd.Series(0, index=np.unique(side_hashes), dtype='int64')
+    for chunk in pd.read_csv(path, usecols=TEST_FIELDS, chunksize=chunk_size, dtype=str):
+        keys = pd.DataFrame({f: _column_values(chunk, f) for f in TEST_FIELDS})
+        hashes = hash_pair_keys(keys)
+        hashes = hashes[np.isin(hashes, counts.index)]
+        counts = counts.add(pd.Series(hashes).value_counts(), fill_value=0).astype('int64')
+    return counts.reindex(side_hashes).to_numpy()
+
+
+def evaluate_B1_direct(test_file, match_threshold=0.70, key='B1', file_a=None, file_b=None,
+                       model_sim=None, chunk_size=500_000):
+    """
+    Valutazione senza scansione del file di blocking: una coppia del test set è tra le
+    candidate se i due record hanno la stessa blocking key (per B1 stesso manufacturer e year);
+    le coppie sopravvissute vengono valutate con score_pairs, le altre contano come non match.
+    Stesse metriche di evaluate_B1 / evaluate_B1_parallel sul file B1:
+    - chiavi del test set ripetute -> una sola coppia con l'etichetta dell'ultima riga (come test_dict)
+    - con file_a e file_b, ogni coppia conta tante volte quante sono le righe del file
+      di blocking con la sua chiave (record identici ripetuti nei file), e le coppie
+      i cui record non sono nei file sono non match; senza i file ogni record conta una volta.
+    key: nome dello schema di blocking o funzione DataFrame -> Series di chiavi.
+    Con file_a e file_b le tabelle delle regole sono costruite una volta sui dataset (fit_rule_tables).
+    """
+    if model_sim is None:
+        model_sim = model_similarity
+    start_time = time.time()
+    if file_a is not None and file_b is not None:
+        fit_rule_tables(file_a, file_b, chunk_size=chunk_size)
+
+    test_dict = build_test_dict(pd.read_csv(test_file, dtype=str))
+    key_columns = ['a_' + f for f in TEST_FIELDS] + ['b_' + f for f in TEST_FIELDS]
+    pairs = pd.DataFrame(list(test_dict), columns=key_columns)
+    labels = np.array(list(test_dict.values()), dtype=int)
+
+    in_block = pairs_in_same_block(pairs, key)
+    multiplicity = np.ones(len(pairs), dtype=np.int64)
+    if file_a is not None and file_b is not None:
+        side_a = pairs[key_columns[:len(TEST_FIELDS)]].set_axis(TEST_FIELDS, axis=1)
+        side_b = pairs[key_columns[len(TEST_FIELDS):]].set_axis(TEST_FIELDS, axis=1)
+        multiplicity = _side_counts(file_a, side_a, chunk_size) * _side_counts(file_b, side_b, chunk_size)
+        in_block = in_block & (multiplicity > 0)
+
+    preds = np.zeros(len(pairs), dtype=int)
+    scores = score_pairs(pairs[in_block], AB_PAIR_COLUMNS, model_sim)
+    preds[in_block] = (scores >= match_threshold).astype(int)
+
+    # coppie nel blocco: una volta per riga del file di blocking; le altre una volta come non match
+    repeat = np.where(in_block, multiplicity, 1)
+    y_true = np.repeat(labels, repeat)
+    y_pred = np.repeat(preds, repeat)
+
+    precision = precision_score(y_true, y_pred)
+    recall = recall_score(y_true, y_pred)
+    f1 = f1_score(y_true, y_pred)
+    end_time = time.time()
+
+    print("\n--- Valutazione diretta completata ---")
+    print(f"Coppie del test set nei blocchi: {int(in_block.sum())} / {len(pairs)}")
+    print(f"Precision: {precision:.4f}, Recall: {recall:.4f}, F1: {f1:.4f}")
+    print(f"Tempo totale: {end_time - start_time:.2f}s")
+
+    return {
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+        'pairs_in_block': int(in_block.sum()),
+        'total_time': end_time - start_time
+    }
+
+
 # ------------------------------
 # Funzione di sicurezza: converte valori in stringa
 # ------------------------------
@@ -233,140 +887,340 @@ def safe_str(val):
     return '' if pd.isna(val) else str(val)
 
 # ------------------------------
-# Lock globale per la scrittura concorrente
+# Log dei risultati: un solo scrittore nel processo principale
 # ------------------------------
-write_lock = Lock()
+# Record binario a larghezza fissa: hash della chiave di coppia, punteggio, predizione, etichetta
+# (punteggio in float64, la stessa precisione con cui il run confronta score >= match_threshold)
+RESULT_DTYPE = np.dtype([('pair_hash', '<u8'), ('score', '<f8'), ('pred', 'i1'), ('label', 'i1')])
+
+
+def result_records(pair_hashes, scores, preds, labels):
+    records = np.empty(len(pair_hashes), dtype=RESULT_DTYPE)
+    records['pair_hash'] = pair_hashes
+    records['score'] = scores
+    records['pred'] = preds
+    records['label'] = labels
+    return records
+
+
+def read_result_log(path):
+    """Legge il log dei risultati come DataFrame (pair_hash, score, pred, label)."""
+    size = os.path.getsize(path)
+    if size % RESULT_DTYPE.itemsize:
+        raise ValueError(
+            f"{path}: {size} byte non multiplo del record ({RESULT_DTYPE.itemsize} byte), "
+            f"log scritto con un formato diverso da RESULT_DTYPE"
+        )
+    return pd.DataFrame(np.fromfile(path, dtype=RESULT_DTYPE))
+
+
+class ResultSink:
+    """
+    Scrittore unico del log dei risultati: i worker restituiscono i record al processo
+    principale, che li mette in una coda limitata (put blocca se lo scrittore è indietro);
+    un solo thread li accoda al file in scritture da almeno flush_rows record.
+    keep_rows: se indicato (ripresa da checkpoint) il log esistente non viene svuotato
+    ma troncato ai primi keep_rows record, e i nuovi vengono accodati.
+    """
+
+    def __init__(self, path, max_pending=64, flush_rows=1_000_000, keep_rows=None):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.rows_written = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        if keep_rows is None:
+            open(path, 'wb').close()
+        else:
+            with open(path, 'ab') as f:
+                f.truncate(keep_rows * RESULT_DTYPE.itemsize)
+            self.rows_written = keep_rows
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, records):
+        if self.error is not None:
+            raise self.error
+        if len(records):
+            self._queue.put(records)
+
+    def _run(self):
+        pending = []
+        pending_rows = 0
+        try:
+            with open(self.path, 'ab') as f:
+                while True:
+                    records = self._queue.get()
+                    synced = isinstance(records, threading.Event)
+                    if records is not None and not synced:
+                        pending.append(records)
+                        pending_rows += len(records)
+                    if pending and (records is None or synced or pending_rows >= self.flush_rows):
+                        np.concatenate(pending).tofile(f)
+                        self.rows_written += pending_rows
+                        pending = []
+                        pending_rows = 0
+                    if synced:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        records.set()
+                    if records is None:
+                        break
+        except Exception as e:
+            self.error = e
+
+    def sync(self):
+        """Attende che tutti i record già ricevuti siano su disco; restituisce i record scritti."""
+        done = threading.Event()
+        self._queue.put(done)
+        while not done.wait(0.1):
+            if self.error is not None:
+                raise self.error
+        return self.rows_written
+
+    def close(self):
+        """Scrive i record rimasti e attende la fine dello scrittore."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 # ------------------------------
-# Worker per chunk
+# Checkpoint delle elaborazioni lunghe
 # ------------------------------
-def process_chunk(chunk, test_dict, match_threshold=0.70, backup_file=None):
-    y_true_chunk = []
-    y_pred_chunk = []
-    evaluated_test_set_chunk = set()
+def save_checkpoint(path, state):
+    """Salva il checkpoint in modo atomico: file temporaneo nella stessa cartella + os.replace."""
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".checkpoint_", suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-    # Apriamo il file di backup in append (con lock)
-    backup_fp = None
-    if backup_file:
-        backup_fp = open(backup_file, 'a', newline='', encoding='utf-8')
-        backup_writer = csv.writer(backup_fp)
-    
-    for idx, row in chunk.iterrows():
-        # chiave univoca test set
-        pair_tuple = (
-            safe_str(row['manufacturer']), safe_str(row['model_a']), safe_str(row['year']),
-            safe_str(row['mileage_a']), safe_str(row['fuel_type_a']), safe_str(row['transmission_a']),
-            safe_str(row['body_type_a']), safe_str(row['cylinders_a']), safe_str(row['drive_a']),
-            safe_str(row['color_a']),
-            safe_str(row.get('manufacturer_b', row['manufacturer'])), safe_str(row['model_b']),
-            safe_str(row.get('year_b', row['year'])), safe_str(row.get('mileage_b', row['mileage_a'])),
-            safe_str(row.get('fuel_type_b', row['fuel_type_a'])), safe_str(row.get('transmission_b', row['transmission_a'])),
-            safe_str(row.get('body_type_b', row['body_type_a'])), safe_str(row.get('cylinders_b', row['cylinders_a'])),
-            safe_str(row.get('drive_b', row['drive_a'])), safe_str(row.get('color_b', row['color_a']))
+
+def load_checkpoint(path, params, resume=True):
+    """
+    Stato iniziale di un'elaborazione con checkpoint:
+    - resume=False o checkpoint assente: stato vuoto
+    - altrimenti il checkpoint salvato, che deve essere stato creato con gli stessi parametri
+      (file, chunk_size, range_bytes, ...), altrimenti gli indici dei chunk non corrispondono
+    """
+    state = {'params': params, 'done': {}}
+    if not resume or not os.path.exists(path):
+        if resume:
+            print(f"Nessun checkpoint in {path}: elaborazione da capo")
+        return state
+
+    with open(path, encoding='utf-8') as f:
+        saved = json.load(f)
+    if saved.get('params') != params:
+        raise ValueError(
+            f"Checkpoint {path} creato con parametri diversi: {saved.get('params')} (attuali: {params})"
         )
+    print(f"Ripresa da {path}: {len(saved['done'])} chunk già completati")
+    return saved
 
-        if pair_tuple in test_dict:
-            # calcolo punteggio (qui puoi usare le tue regole)
-            total_score = 0
-            total_score += score_model(row['model_a'], row['model_b'])
-            total_score += score_exact(row['manufacturer'], row['manufacturer'], 0.2)
-            total_score += score_exact(row['year'], row['year'], 0.1)
-            total_score += score_mileage(row['mileage_a'], row['mileage_b'])
-            total_score += score_fuel(row['fuel_type_a'], row['fuel_type_b'])
-            total_score += score_exact(row['transmission_a'], row['transmission_b'], 0.05)
-            total_score += score_body(row['body_type_a'], row['body_type_b'])
-            total_score += score_cylinders(row['cylinders_a'], row['cylinders_b'])
-            total_score += score_drive(row['drive_a'], row['drive_b'])
-            total_score += score_color(row['color_a'], row['color_b'])
 
-            pred_match = 1 if total_score >= match_threshold else 0
-            true_match = test_dict[pair_tuple]
+def confusion_tally(y_true, y_pred):
+    """Conteggi tp/fp/fn/tn di un chunk, la forma compatta salvata nel checkpoint."""
+    y_true = np.asarray(y_true, dtype=int)
+    y_pred = np.asarray(y_pred, dtype=int)
+    return {
+        'tp': int(((y_true == 1) & (y_pred == 1)).sum()),
+        'fp': int(((y_true == 0) & (y_pred == 1)).sum()),
+        'fn': int(((y_true == 1) & (y_pred == 0)).sum()),
+        'tn': int(((y_true == 0) & (y_pred == 0)).sum()),
+    }
+
 
-            y_true_chunk.append(true_match)
-            y_pred_chunk.append(pred_match)
-            evaluated_test_set_chunk.add(pair_tuple)
+def tally_labels(tally):
+    """Ricostruisce y_true/y_pred (a meno dell'ordine, irrilevante per le metriche) da confusion_tally."""
+    y_true = [1] * tally['tp'] + [0] * tally['fp'] + [1] * tally['fn'] + [0] * tally['tn']
+    y_pred = [1] * tally['tp'] + [1] * tally['fp'] + [0] * tally['fn'] + [0] * tally['tn']
+    return y_true, y_pred
 
-            # Scrittura backup (thread-safe)
-            if backup_file:
-                with write_lock:
-                    backup_writer.writerow([pair_tuple, pred_match, true_match])
 
-    if backup_fp:
-        backup_fp.close()
+def file_identity(path):
+    """Percorso, dimensione e data di modifica: un file riscritto nello stesso percorso non coincide."""
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
 
-    return y_true_chunk, y_pred_chunk, evaluated_test_set_chunk
+
+def checkpoint_params(blocking_file, test_file, **params):
+    """Parametri che identificano un'elaborazione: i file (con dimensione e data) e le opzioni."""
+    return {'blocking_file': file_identity(blocking_file), 'test_file': file_identity(test_file), **params}
+
+
+# ------------------------------
+# Worker per chunk
+# ------------------------------
+def process_chunk(chunk, match_threshold=0.70, tables=None):
+    """
+    Valuta le righe del chunk che sono nel test set. Non scrive su file: restituisce
+    (y_true, y_pred, indici del test set valutati, record per il log dei risultati).
+    tables: tabelle del test set (default: quelle condivise collegate dall'initializer del pool).
+    """
+    if tables is None:
+        tables = _shared_tables
+
+    # chiave univoca test set: semi-join sugli hash, chiave verificata solo sui candidati
+    hit_positions, hit_index = shared_test_hits(chunk, tables)
+
+    # calcolo punteggio vettoriale sulle sole righe del test set (model dalla tabella)
+    scores = score_pairs(chunk.iloc[hit_positions], model_scores=tables['model_scores'][hit_index])
+    preds = (scores >= match_threshold).astype(int)
+    labels = tables['labels'][hit_index].astype(int)
+
+    records = result_records(tables['hashes'][hit_index], scores, preds, labels)
+    return labels.tolist(), preds.tolist(), set(hit_index.tolist()), records
+
+
+def process_task(task, match_threshold=0.70, chunk_size=500_000):
+    """
+    Worker per un'unità di lavoro di candidate_tasks: legge da sé il proprio intervallo
+    (byte del CSV o coppie del formato compatto), valuta i chunk con process_chunk
+    e restituisce i risultati aggregati.
+    """
+    y_true_task, y_pred_task = [], []
+    evaluated_task = set()
+    records = [result_records([], [], [], [])]
+    for chunk in load_candidate_task(task, chunk_size):
+        y_true_chunk, y_pred_chunk, evaluated_chunk, chunk_records = process_chunk(chunk, match_threshold)
+        y_true_task.extend(y_true_chunk)
+        y_pred_task.extend(y_pred_chunk)
+        evaluated_task.update(evaluated_chunk)
+        records.append(chunk_records)
+    return y_true_task, y_pred_task, evaluated_task, np.concatenate(records)
 
 
 # ------------------------------
 # Funzione principale Windows-safe + Ctrl+C
 # ------------------------------
-def evaluate_B1_parallel(blocking_file, test_file, chunk_size=500_000, match_threshold=0.70, max_workers=8, backup_file=None):
+def evaluate_B1_parallel(blocking_file, test_file, chunk_size=500_000, match_threshold=0.70, max_workers=8, backup_file=None,
+                         range_bytes=CANDIDATE_RANGE_BYTES, checkpoint_file=None, resume=False, file_a=None, file_b=None):
+    # backup_file: log binario dei risultati (RESULT_DTYPE, leggibile con read_result_log),
+    # scritto solo dal processo principale
+    # range_bytes: i worker leggono da sé intervalli di byte del CSV di questa dimensione;
+    # il processo principale raccoglie solo i risultati
+    # checkpoint_file: dopo ogni chunk completato salva (in modo atomico) i conteggi parziali;
+    # con resume=True i chunk già completati vengono saltati e i loro conteggi riusati
+    # file_a / file_b: dataset di origine, le tabelle delle regole sono costruite una volta
+    # (fit_rule_tables) e i vocabolari passati ai worker dall'initializer
+    if resume and not checkpoint_file:
+        raise ValueError("resume=True richiede checkpoint_file")
+    if file_a is not None and file_b is not None:
+        fit_rule_tables(file_a, file_b)
+
     # Carico test set
     df_test = pd.read_csv(test_file, dtype=str)
-    test_dict = {
-        tuple(safe_str(df_test.loc[i, col]) for col in [
-            'a_manufacturer','a_model','a_year','a_mileage','a_fuel_type','a_transmission','a_body_type',
-            'a_cylinders','a_drive','a_color',
-            'b_manufacturer','b_model','b_year','b_mileage','b_fuel_type','b_transmission','b_body_type',
-            'b_cylinders','b_drive','b_color'
-        ]): int(df_test.loc[i, 'match'])
-        for i in df_test.index
-    }
+    test_dict = build_test_dict(df_test)
 
     y_true = []
     y_pred = []
     evaluated_test_set = set()
 
+    checkpoint = None
+    if checkpoint_file:
+        params = checkpoint_params(blocking_file, test_file, chunk_size=chunk_size,
+                                   range_bytes=range_bytes, match_threshold=match_threshold,
+                                   backup_file=os.path.abspath(backup_file) if backup_file else None)
+        checkpoint = load_checkpoint(checkpoint_file, params, resume)
+        for tally in checkpoint['done'].values():
+            y_true_chunk, y_pred_chunk = tally_labels(tally)
+            y_true.extend(y_true_chunk)
+            y_pred.extend(y_pred_chunk)
+            evaluated_test_set.update(tally['evaluated'])
+
+    # Tabelle di lookup in memoria condivisa: i worker le collegano una volta sola
+    tables = build_test_tables(test_dict)
+    shared_blocks, table_specs = create_shared_tables(tables)
+
+    sink = None
+    if backup_file:
+        # In ripresa il log viene troncato all'ultimo checkpoint: i record dei chunk
+        # interrotti vengono riscritti quando i chunk sono rielaborati
+        keep_rows = checkpoint.get('log_rows', 0) if checkpoint and checkpoint['done'] else None
+        sink = ResultSink(backup_file, keep_rows=keep_rows)
+
+    def collect(task_id, result):
+        y_true_chunk, y_pred_chunk, evaluated_chunk, records = result
+        y_true.extend(y_true_chunk)
+        y_pred.extend(y_pred_chunk)
+        evaluated_test_set.update(evaluated_chunk)
+        if sink:
+            sink.put(records)
+        if checkpoint is not None:
+            tally = confusion_tally(y_true_chunk, y_pred_chunk)
+            tally['evaluated'] = sorted(int(i) for i in evaluated_chunk)
+            checkpoint['done'][str(task_id)] = tally
+            if sink:
+                checkpoint['log_rows'] = sink.sync()
+            save_checkpoint(checkpoint_file, checkpoint)
+
     start_time = time.time()
 
     try:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = set()
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=attach_shared_tables,
+                                 initargs=(table_specs, rule_vocabularies())) as executor:
+            futures = {}
             chunk_number = 0
-            chunk_iter = pd.read_csv(blocking_file, chunksize=chunk_size, dtype=str)
+            task_iter = candidate_tasks(blocking_file, chunk_size, range_bytes)
 
-            for chunk in chunk_iter:
+            for task in task_iter:
                 chunk_number += 1
+                if checkpoint is not None and str(chunk_number) in checkpoint['done']:
+                    print(f"Chunk {chunk_number} già completato: saltato")
+                    continue
                 print(f"\nInvio chunk {chunk_number} ai worker...")
-                future = executor.submit(process_chunk, chunk, test_dict, match_threshold, backup_file)
-                futures.add(future)
+                future = executor.submit(process_task, task, match_threshold, chunk_size)
+                futures[future] = chunk_number
 
                 # Limita chunk in RAM a max_workers
                 while len(futures) >= max_workers:
-                    done, futures = wait_one_done(futures)
-                    for y_true_chunk, y_pred_chunk, evaluated_chunk in done:
-                        y_true.extend(y_true_chunk)
-                        y_pred.extend(y_pred_chunk)
-                        evaluated_test_set.update(evaluated_chunk)
-                        print(f"Test set valutato finora: {len(evaluated_test_set)} / {len(test_dict)}")
+                    future = next(as_completed(futures))
+                    collect(futures.pop(future), future.result())
+                    print(f"Test set valutato finora: {len(evaluated_test_set)} / {len(test_dict)}")
 
             # Elabora i chunk rimanenti
-            for future in as_completed(futures):
-                y_true_chunk, y_pred_chunk, evaluated_chunk = future.result()
-                y_true.extend(y_true_chunk)
-                y_pred.extend(y_pred_chunk)
-                evaluated_test_set.update(evaluated_chunk)
+            for future in as_completed(list(futures)):
+                collect(futures.pop(future), future.result())
 
     except KeyboardInterrupt:
         print("\nInterruzione ricevuta! Terminazione immediata dei worker...")
+        if checkpoint_file:
+            print(f"Chunk completati salvati in {checkpoint_file}: rilanciare con resume=True")
         executor.shutdown(wait=False)
+        if sink:
+            sink.close()
         return
+    finally:
+        release_shared_tables(shared_blocks)
 
     # ------------------------------
     # Gestione delle righe del test set non trovate nel blocking
     # ------------------------------
-    missing_pairs = set(test_dict.keys()) - evaluated_test_set
-    for pair in missing_pairs:
-        y_true.append(test_dict[pair])
-        y_pred.append(0)
-
-        # Scrittura backup
-        if backup_file:
-            with write_lock:
-                with open(backup_file, 'a', newline='', encoding='utf-8') as f:
-                    writer = csv.writer(f)
-                    writer.writerow([pair, 0, test_dict[pair]])
+    missing_pairs = np.array(sorted(set(range(len(tables['labels']))) - evaluated_test_set), dtype=int)
+    missing_labels = tables['labels'][missing_pairs].astype(int)
+    y_true.extend(missing_labels.tolist())
+    y_pred.extend([0] * len(missing_pairs))
+
+    # Log dei risultati: coppie non trovate con punteggio NaN e predizione 0
+    if sink:
+        sink.put(result_records(tables['hashes'][missing_pairs], np.nan, 0, missing_labels))
+        sink.close()
 
     end_time = time.time()
 
@@ -378,6 +1232,8 @@ def evaluate_B1_parallel(blocking_file, test_file, chunk_size=500_000, match_thr
     print("\n--- Elaborazione completata ---")
     print(f"Righe del test set valutate: {len(evaluated_test_set)} / {len(test_dict)}")
     print(f"Totale coppie (incluse quelle non trovate nel blocking): {len(y_true)}")
+    if sink:
+        print(f"Log dei risultati: {backup_file} ({sink.rows_written} record)")
     print(f"Precision: {precision:.4f}, Recall: {recall:.4f}, F1: {f1:.4f}")
     print(f"Tempo totale: {end_time - start_time:.2f}s")
 
@@ -389,13 +1245,197 @@ def evaluate_B1_parallel(blocking_file, test_file, chunk_size=500_000, match_thr
     }
 
 
+
+
 # ------------------------------
-# Funzione helper per wait dei futures
+# Blocking e scoring fusi: nessun file di candidate pairs
 # ------------------------------
-def wait_one_done(futures_set):
-    done = []
-    for future in as_completed(futures_set):
-        done.append(future.result())
-        futures_set.remove(future)
-        break
-    return done, futures_set
\ No newline at end of file
+def _record_tuples(df, prefix=''):
+    cols = [prefix + f for f in TEST_FIELDS]
+    return list(df[cols].fillna('').astype(str).itertuples(index=False, name=None))
+
+
+# Nei worker del linking fuso: test set ricevuto una volta sola dall'initializer del pool
+_link_state = {}
+
+
+def init_link_worker(test_dict, vocabularies=None):
+    """
+    Initializer del pool: test_dict e lati A / B delle sue coppie, per tutte le partizioni del worker,
+    e i vocabolari delle rule_tables del processo principale (rule_vocabularies()).
+    """
+    load_rule_vocabularies(vocabularies)
+    _link_state['test_dict'] = test_dict
+    _link_state['sides_a'] = {pair[:len(TEST_FIELDS)] for pair in test_dict} if test_dict else set()
+    _link_state['sides_b'] = {pair[len(TEST_FIELDS):] for pair in test_dict} if test_dict else set()
+
+
+def link_partition(part_a, part_b, scheme_name, match_threshold=0.70, emit='matches', test_dict=None, batch_pairs=500_000):
+    """
+    Worker: riceve i record di A e B di una partizione (blocchi interi), genera in memoria
+    le coppie blocco per blocco, le valuta con score_pairs e restituisce solo
+    id delle coppie e punteggi (tutte con emit='scores', solo i match con emit='matches')
+    più y_true / y_pred delle coppie del test set.
+    test_dict: default quello ricevuto da init_link_worker.
+    """
+    if test_dict is not None:
+        init_link_worker(test_dict)
+    test_dict = _link_state.get('test_dict')
+    scheme = BLOCKING_SCHEMES[scheme_name]
+    keys = scheme['keys']
+
+    # stessa lettura delle partizioni del blocking parallelo ('nan' di B2 resta una chiave valida)
+    df_a = pd.read_csv(part_a, dtype=str, keep_default_na=False, na_values=[''])
+    df_b = pd.read_csv(part_b, dtype=str, keep_default_na=False, na_values=[''])
+    df_a['id'] = df_a['id'].astype(np.int64)
+    df_b['id'] = df_b['id'].astype(np.int64)
+    if not scheme['dropna']:
+        # B1: chiavi mancanti combaciano tra loro, come nel merge di generate_candidate_pairs_B1
+        df_a[keys] = df_a[keys].fillna('')
+        df_b[keys] = df_b[keys].fillna('')
+
+    # record che compaiono nel test set: solo le loro coppie vengono confrontate con test_dict
+    if test_dict:
+        sides_a = _link_state['sides_a']
+        sides_b = _link_state['sides_b']
+        test_ids_a = df_a['id'][[t in sides_a for t in _record_tuples(df_a)]].to_numpy()
+        test_ids_b = df_b['id'][[t in sides_b for t in _record_tuples(df_b)]].to_numpy()
+
+    ids_a, ids_b, kept_scores = [], [], []
+    y_true_part, y_pred_part = [], []
+    evaluated = set()
+    total_pairs = 0
+    # con emit='matches' il model è saltato per le coppie che non possono raggiungere la soglia;
+    # i match emessi conservano il punteggio completo (prune_matches=False)
+    pruning = new_pruning_stats()
+    threshold = match_threshold if emit == 'matches' else None
+
+    for batch in iter_block_products(df_a, df_b, keys, batch_pairs):
+        scores = score_pairs(batch, AB_PAIR_COLUMNS, match_threshold=threshold, prune_matches=False, stats=pruning)
+        total_pairs += len(batch)
+
+        if test_dict:
+            in_test = (batch['a_id'].isin(test_ids_a) & batch['b_id'].isin(test_ids_b)).to_numpy()
+            if in_test.any():
+                hits = batch[in_test]
+                for side_a, side_b, total_score in zip(_record_tuples(hits, 'a_'), _record_tuples(hits, 'b_'), scores[in_test]):
+                    pair_tuple = side_a + side_b
+                    if pair_tuple in test_dict:
+                        y_true_part.append(test_dict[pair_tuple])
+                        y_pred_part.append(1 if total_score >= match_threshold else 0)
+                        evaluated.add(pair_tuple)
+
+        keep = np.ones(len(batch), dtype=bool) if emit == 'scores' else scores >= match_threshold
+        ids_a.append(batch['a_id'].to_numpy(dtype=np.int64)[keep])
+        ids_b.append(batch['b_id'].to_numpy(dtype=np.int64)[keep])
+        kept_scores.append(scores[keep].astype(np.float64))
+
+    return {
+        'a_id': np.concatenate(ids_a) if ids_a else np.empty(0, dtype=np.int64),
+        'b_id': np.concatenate(ids_b) if ids_b else np.empty(0, dtype=np.int64),
+        'score': np.concatenate(kept_scores) if kept_scores else np.empty(0, dtype=np.float64),
+        'pairs': total_pairs,
+        'y_true': y_true_part,
+        'y_pred': y_pred_part,
+        'evaluated': evaluated,
+        'pruning': pruning,
+    }
+
+
+def link_blocks_fused(file_a, file_b, output_prefix, scheme='B1', emit='matches', match_threshold=0.70,
+                      test_file=None, num_partitions=32, max_workers=8, batch_pairs=500_000, chunk_size=200_000):
+    """
+    Blocking e record linkage in un solo passaggio, senza scrivere né rileggere il file
+    delle candidate pairs: A e B sono partizionati per hash della chiave di blocking (B1 o B2),
+    ogni worker genera e valuta in memoria le coppie dei propri blocchi e restituisce solo i risultati.
+    Output nel formato compatto (<prefix>_pairs.bin + tabelle dei record) con i punteggi float64
+    in <prefix>_scores.bin: tutte le coppie con emit='scores', solo i match con emit='matches'.
+    Con test_file calcola anche precision / recall / F1 come evaluate_B1_parallel.
+    """
+    start_time = time.time()
+    paths = compact_pair_paths(output_prefix)
+    scores_path = f"{output_prefix}_scores.bin"
+
+    test_dict = None
+    if test_file:
+        test_dict = build_test_dict(pd.read_csv(test_file, dtype=str))
+
+    y_true = []
+    y_pred = []
+    evaluated_test_set = set()
+    total_pairs = 0
+    emitted = 0
+    pruning = new_pruning_stats()
+
+    executor = None
+    part_dir = tempfile.mkdtemp(prefix='fused_', dir=os.path.dirname(os.path.abspath(paths['pairs'])))
+    try:
+        # tabelle delle regole costruite una volta su A e B, vocabolari passati ai worker
+        fit_rule_tables(file_a, file_b, chunk_size=chunk_size)
+        print(f"Partizionamento su {num_partitions} partizioni...")
+        parts_a = partition_file(file_a, BLOCKING_SCHEMES[scheme], num_partitions, part_dir, 'a', chunk_size, with_ids=True)
+        parts_b = partition_file(file_b, BLOCKING_SCHEMES[scheme], num_partitions, part_dir, 'b', chunk_size, with_ids=True)
+
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_link_worker,
+                                       initargs=(test_dict, rule_vocabularies()))
+        # executor fuori dal with: il suo __exit__ attenderebbe tutte le partizioni anche dopo Ctrl+C
+        with open(paths['pairs'], 'wb') as f_pairs, open(scores_path, 'wb') as f_scores:
+            futures = [
+                executor.submit(link_partition, part_a, part_b, scheme, match_threshold, emit, None, batch_pairs)
+                for part_a, part_b in zip(parts_a, parts_b)
+                if part_a is not None and part_b is not None
+            ]
+            for done, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                write_pair_ids(f_pairs, result['a_id'], result['b_id'])
+                result['score'].tofile(f_scores)
+                total_pairs += result['pairs']
+                emitted += len(result['score'])
+                y_true.extend(result['y_true'])
+                y_pred.extend(result['y_pred'])
+                evaluated_test_set.update(result['evaluated'])
+                for counter, value in result['pruning'].items():
+                    pruning[counter] += value
+                print(f"Partizione {done}/{len(futures)}: coppie valutate finora {total_pairs:,}, emesse {emitted:,}")
+
+    except KeyboardInterrupt:
+        print("\nInterruzione ricevuta! Terminazione immediata dei worker...")
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = None
+        return
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+    assign_record_ids(file_a, paths['records_a'], chunk_size)
+    assign_record_ids(file_b, paths['records_b'], chunk_size)
+    # chiavi del formato B1 non fissate dallo schema (es. manufacturer per B2): il lato B le conserva
+    write_compact_meta(output_prefix, b_key_columns=[k for k in PAIR_KEY_COLUMNS if k not in BLOCKING_SCHEMES[scheme]['keys']])
+
+    end_time = time.time()
+    print("\n--- Elaborazione completata ---")
+    print(f"Coppie generate e valutate: {total_pairs:,} | emesse ({emit}): {emitted:,}")
+    print(f"Output: {paths['pairs']}, {scores_path}")
+    if pruning['pairs']:
+        print(f"Model saltato per {pruning['skipped_below']:,} coppie sotto soglia "
+              f"(valutato su {pruning['model_evaluated']:,} / {pruning['pairs']:,})")
+
+    results = {'pairs': total_pairs, 'emitted': emitted, 'total_time': end_time - start_time,
+               'model_evaluated': pruning['model_evaluated'], 'model_skipped': pruning['skipped_below']}
+    if test_dict:
+        # coppie del test set non generate dal blocking -> non match
+        for pair in set(test_dict.keys()) - evaluated_test_set:
+            y_true.append(test_dict[pair])
+            y_pred.append(0)
+        results.update({
+            'precision': precision_score(y_true, y_pred),
+            'recall': recall_score(y_true, y_pred),
+            'f1': f1_score(y_true, y_pred),
+        })
+        print(f"Righe del test set valutate: {len(evaluated_test_set)} / {len(test_dict)}")
+        print(f"Precision: {results['precision']:.4f}, Recall: {results['recall']:.4f}, F1: {results['f1']:.4f}")
+    print(f"Tempo totale: {end_time - start_time:.2f}s")
+
+    return results
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# moduli del progetto al livello principale del repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RECORD_FIELDS = ['manufacturer', 'model', 'year', 'mileage', 'fuel_type', 'transmission',
+                 'body_type', 'cylinders', 'drive', 'color']
+
+# Valori di prova: mancanti, 'other', equivalenze delle regole, maiuscole e spazi
+FIELD_VALUES = {
+    'manufacturer': ['ford', 'toyota', 'bmw', ''],
+    'model': ['f-150 xlt', 'f-150', 'camry le', 'camry', '3 series 328i', '328i', 'corolla', ''],
+    'year': ['2010', '2011', '2012', ''],
+    'fuel_type': ['gasoline', 'flex fuel vehicle', 'diesel', 'biodiesel', 'other', 'Gasoline', ''],
+    'transmission': ['automatic', 'manual', ''],
+    'body_type': ['truck', 'pickup', 'offroad', 'suv', 'sedan', 'other', ''],
+    'cylinders': ['4 cylinders', '6 cylinders', 'other', ''],
+    'drive': ['4wd', 'awd', 'fwd', 'rwd', '4x2', ''],
+    'color': ['red', 'Red', 'white', 'black', ''],
+}
+
+
+def random_records(n, seed):
+    """Record sintetici con lo schema dei dataset; mileage distinto rende ogni record unico."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({field: rng.choice(values, n) for field, values in FIELD_VALUES.items()})
+    df['mileage'] = (rng.permutation(n) * 997 + 1000).astype(str)
+    df.loc[rng.random(n) < 0.05, 'mileage'] = ''
+    return df[RECORD_FIELDS]
+
+
+@pytest.fixture
+def ab_files(tmp_path):
+    """Due dataset A e B su disco (CSV come vehicles_final / used_cars_final)."""
+    file_a = tmp_path / 'A.csv'
+    file_b = tmp_path / 'B.csv'
+    random_records(80, seed=1).to_csv(file_a, index=False)
+    random_records(90, seed=2).to_csv(file_b, index=False)
+    return str(file_a), str(file_b)
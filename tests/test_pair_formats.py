@@ -0,0 +1,155 @@
+import os
+
+import pandas as pd
+import pytest
+
+import blocking as b
+from conftest import RECORD_FIELDS
+
+KEYS = list(b.PAIR_KEY_COLUMNS)
+
+
+def read_pairs(path, chunk_size=50):
+    """Tutte le coppie di un file di candidate pairs (CSV, compatto o manifest) nel formato B1."""
+    chunks = list(b.read_candidate_pairs(path, chunk_size))
+    return pd.concat(chunks, ignore_index=True).fillna('') if chunks else pd.DataFrame()
+
+
+def side_tuples(frame, side):
+    """Record del lato 'a' o 'b' di ogni riga: chiavi condivise, o <chiave>_b se presente per il lato B."""
+    columns = []
+    for field in RECORD_FIELDS:
+        if field in KEYS:
+            columns.append(f'{field}_b' if side == 'b' and f'{field}_b' in frame.columns else field)
+        else:
+            columns.append(f'{field}_{side}')
+    return list(frame[columns].itertuples(index=False, name=None))
+
+
+def record_set(path):
+    return set(pd.read_csv(path, dtype=str).fillna('')[RECORD_FIELDS].itertuples(index=False, name=None))
+
+
+def assert_rows_are_records(frame, ab_files):
+    """Ogni riga letta riporta per A e per B i valori di un record dei dataset di origine."""
+    assert set(side_tuples(frame, 'a')) <= record_set(ab_files[0])
+    assert set(side_tuples(frame, 'b')) <= record_set(ab_files[1])
+
+
+def pair_set(frame):
+    return set(zip(side_tuples(frame, 'a'), side_tuples(frame, 'b')))
+
+
+@pytest.fixture
+def b1_csv(ab_files, tmp_path):
+    path = str(tmp_path / 'b1.csv')
+    b.generate_candidate_pairs_B1(*ab_files, path)
+    return path
+
+
+# ------------------------------
+# Formato B1: CSV, compatto, manifest
+# ------------------------------
+def test_b1_compact_matches_csv(ab_files, b1_csv, tmp_path):
+    prefix = str(tmp_path / 'b1c')
+    b.generate_candidate_pairs_B1_compact(*ab_files, prefix)
+    frame = read_pairs(b.compact_pair_paths(prefix)['pairs'])
+
+    assert b.load_compact_meta(prefix)['b_key_columns'] == []
+    assert not {'manufacturer_b', 'year_b'} & set(frame.columns)
+    assert_rows_are_records(frame, ab_files)
+    assert pair_set(frame) == pair_set(read_pairs(b1_csv))
+
+
+def test_compact_without_meta_reads_as_b1(ab_files, b1_csv, tmp_path):
+    prefix = str(tmp_path / 'b1c')
+    b.generate_candidate_pairs_B1_compact(*ab_files, prefix)
+    os.remove(b.compact_pair_paths(prefix)['meta'])
+    assert pair_set(read_pairs(b.compact_pair_paths(prefix)['pairs'])) == pair_set(read_pairs(b1_csv))
+
+
+def test_manifest_matches_csv(ab_files, b1_csv, tmp_path):
+    manifest = b.generate_candidate_pairs_parallel(*ab_files, str(tmp_path / 'shards'), scheme='B1',
+                                                   num_partitions=4, max_workers=2)
+    frame = read_pairs(manifest)
+    assert len(frame) == len(read_pairs(b1_csv))
+    assert pair_set(frame) == pair_set(read_pairs(b1_csv))
+
+
+def test_candidate_tasks_cover_csv(b1_csv):
+    tasks = list(b.candidate_tasks(b1_csv, chunk_size=30, range_bytes=2_000))
+    assert len(tasks) > 1
+    frame = pd.concat([chunk for task in tasks for chunk in b.load_candidate_task(task, 30)], ignore_index=True)
+    pd.testing.assert_frame_equal(frame, pd.read_csv(b1_csv, dtype=str))
+
+
+def test_compact_tasks_are_id_ranges(ab_files, tmp_path):
+    prefix = str(tmp_path / 'token')
+    b.generate_candidate_pairs_token(*ab_files, prefix, ground_truth=())
+    pairs_file = b.compact_pair_paths(prefix)['pairs']
+    tasks = list(b.candidate_tasks(pairs_file, chunk_size=40))
+
+    # il processo principale invia solo (percorso, inizio, fine) sulle coppie, senza record
+    assert len(tasks) > 1
+    assert all(task[0] == pairs_file and isinstance(task[1], int) for task in tasks)
+    assert tasks[-1][2] == len(b.load_pair_ids(pairs_file))
+    frame = pd.concat([chunk for task in tasks for chunk in b.load_candidate_task(task, 15)], ignore_index=True)
+    pd.testing.assert_frame_equal(frame.fillna(''), read_pairs(pairs_file))
+
+
+def test_byte_ranges_reject_quoted_newlines(tmp_path):
+    path = tmp_path / 'quoted.csv'
+    path.write_text('manufacturer,model_a\nford,"f-150\nxlt"\ntoyota,camry\n', encoding='utf-8')
+    with pytest.raises(ValueError):
+        for task in b.candidate_tasks(str(path), range_bytes=10):
+            list(b.load_candidate_task(task))
+
+
+# ------------------------------
+# Schemi in cui A e B di una coppia possono avere chiavi diverse
+# ------------------------------
+COMPACT_SCHEMES = {
+    'token': (lambda files, out: b.generate_candidate_pairs_token(*files, out, ground_truth=()),
+              ['year']),
+    'sorted_neighborhood': (lambda files, out: b.generate_candidate_pairs_sorted_neighborhood(
+        *files, out, window=4, ground_truth=()), KEYS),
+    'meta_blocking': (lambda files, out: b.meta_blocking(*files, out, collections=('B1', 'token'),
+                                                         ground_truth=()), KEYS),
+    'meta_blocking_B1': (lambda files, out: b.meta_blocking(*files, out, collections=('B1',),
+                                                            ground_truth=()), []),
+    'knn': (lambda files, out: b.generate_candidate_pairs_knn(*files, out, k=3, max_workers=1,
+                                                              ground_truth=()), ['year']),
+}
+
+
+@pytest.mark.parametrize('scheme', sorted(COMPACT_SCHEMES))
+def test_compact_keeps_b_side_keys(ab_files, tmp_path, scheme):
+    generate, b_key_columns = COMPACT_SCHEMES[scheme]
+    prefix = str(tmp_path / scheme)
+    generate(ab_files, prefix)
+    frame = read_pairs(b.compact_pair_paths(prefix)['pairs'])
+
+    assert len(frame)
+    assert b.load_compact_meta(prefix)['b_key_columns'] == b_key_columns
+    assert [k for k in KEYS if f'{k}_b' in frame.columns] == b_key_columns
+    assert_rows_are_records(frame, ab_files)
+
+
+def test_lsh_csv_keeps_b_side_keys(ab_files, tmp_path):
+    path = str(tmp_path / 'lsh.csv')
+    b.generate_candidate_pairs_lsh(*ab_files, path, bands=8, rows=2, scope=('manufacturer',), ground_truth=())
+    frame = read_pairs(path)
+    assert len(frame)
+    assert 'year_b' in frame.columns and 'manufacturer_b' not in frame.columns
+    assert_rows_are_records(frame, ab_files)
+
+
+def test_year_tolerant_keeps_b_side_year(ab_files, b1_csv, tmp_path):
+    path = str(tmp_path / 'year_tolerant.csv')
+    b.generate_candidate_pairs_year_tolerant(*ab_files, path, k=1, ground_truth=())
+    frame = read_pairs(path)
+    assert 'year_b' in frame.columns
+    assert (frame['year'] != frame['year_b']).any()
+    assert_rows_are_records(frame, ab_files)
+    # con k >= 0 include tutte le coppie di B1
+    assert pair_set(read_pairs(b1_csv)) <= pair_set(frame)
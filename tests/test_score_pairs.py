@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import record_linkage as rl
+from conftest import random_records, FIELD_VALUES
+
+RULE_FIELDS = ['fuel_type', 'body_type', 'cylinders', 'drive', 'color']
+
+
+def scalar_total(row, columns):
+    """Punteggio riga per riga come nel ciclo originale di evaluate_B1 (stesso ordine di somma)."""
+    def pair(field):
+        col_a, col_b = columns[field]
+        return row[col_a], row[col_b]
+
+    total_score = 0
+    total_score += rl.score_model(*pair('model'))
+    total_score += rl.score_exact(*pair('manufacturer'), 0.2)
+    total_score += rl.score_exact(*pair('year'), 0.1)
+    total_score += rl.score_mileage(*pair('mileage'))
+    total_score += rl.score_fuel(*pair('fuel_type'))
+    total_score += rl.score_exact(*pair('transmission'), 0.05)
+    total_score += rl.score_body(*pair('body_type'))
+    total_score += rl.score_cylinders(*pair('cylinders'))
+    total_score += rl.score_drive(*pair('drive'))
+    total_score += rl.score_color(*pair('color'))
+    return total_score
+
+
+def scalar_scores(chunk, columns):
+    return np.array([scalar_total(row, columns) for _, row in chunk.iterrows()], dtype=float)
+
+
+def b1_chunk(tmp_path, n=400, seed=0):
+    """Chunk nel formato del blocking B1 (chiavi condivise, resto _a / _b), riletto da CSV come in produzione."""
+    side_a = random_records(n, seed)
+    side_b = random_records(n, seed + 100)
+    # parte delle coppie con lo stesso record (o quasi) sui due lati: punteggi sopra soglia
+    same = np.random.default_rng(seed).random(n) < 0.3
+    side_b[same] = side_a[same]
+    others = [f for f in side_a.columns if f not in ('manufacturer', 'year')]
+    chunk = pd.concat([side_a[['manufacturer', 'year']], side_a[others].add_suffix('_a'),
+                       side_b[others].add_suffix('_b')], axis=1)
+    path = tmp_path / 'chunk.csv'
+    chunk.to_csv(path, index=False)
+    return pd.read_csv(path, dtype=str)
+
+
+def ab_chunk(tmp_path, n=400, seed=0):
+    """Coppie nel formato a_ / b_ (test set, blocking B2): anche manufacturer e year possono differire."""
+    side_a = random_records(n, seed)
+    side_b = random_records(n, seed + 100)
+    same = np.random.default_rng(seed).random(n) < 0.3
+    side_b[same] = side_a[same]
+    chunk = pd.concat([side_a.add_prefix('a_'), side_b.add_prefix('b_')], axis=1)
+    path = tmp_path / 'pairs.csv'
+    chunk.to_csv(path, index=False)
+    return pd.read_csv(path, dtype=str)
+
+
+# ------------------------------
+# score_pairs contro le regole scalari
+# ------------------------------
+def test_b1_chunk_matches_scalar_rules(tmp_path):
+    chunk = b1_chunk(tmp_path)
+    columns = dict(rl.B1_PAIR_COLUMNS, manufacturer=('manufacturer', 'manufacturer'), year=('year', 'year'))
+    np.testing.assert_allclose(rl.score_pairs(chunk), scalar_scores(chunk, columns), rtol=0, atol=1e-12)
+
+
+def test_b1_chunk_reads_b_side_keys(tmp_path):
+    chunk = b1_chunk(tmp_path)
+    chunk['year_b'] = np.where(np.arange(len(chunk)) % 2, chunk['year'], '1999')
+    columns = dict(rl.B1_PAIR_COLUMNS, manufacturer=('manufacturer', 'manufacturer'))
+    np.testing.assert_allclose(rl.score_pairs(chunk), scalar_scores(chunk, columns), rtol=0, atol=1e-12)
+
+
+def test_ab_chunk_matches_scalar_rules(tmp_path):
+    chunk = ab_chunk(tmp_path)
+    np.testing.assert_allclose(rl.score_pairs(chunk, rl.AB_PAIR_COLUMNS),
+                               scalar_scores(chunk, rl.AB_PAIR_COLUMNS), rtol=0, atol=1e-12)
+
+
+def test_edge_values_match_scalar_rules():
+    # spazi, testo 'nan', chilometraggi non interi o non numerici, maiuscole
+    side_a = ['ford', ' ford', 'nan', 'Ford', None, 'bmw']
+    side_b = ['ford ', 'ford', 'nan', 'ford', 'ford', None]
+    mileage_a = ['12000.7', 'abc', '1e4', ' 5000', None, '60000']
+    mileage_b = ['12000', '100', '10000', '5000', '1', '0']
+    chunk = pd.DataFrame({f'a_{f}': side_a for f in rl.TEST_FIELDS})
+    for f in rl.TEST_FIELDS:
+        chunk[f'b_{f}'] = side_b
+    chunk['a_mileage'] = mileage_a
+    chunk['b_mileage'] = mileage_b
+    np.testing.assert_allclose(rl.score_pairs(chunk, rl.AB_PAIR_COLUMNS),
+                               scalar_scores(chunk, rl.AB_PAIR_COLUMNS), rtol=0, atol=1e-12)
+
+
+def test_empty_chunk(tmp_path):
+    chunk = b1_chunk(tmp_path).iloc[:0]
+    assert len(rl.score_pairs(chunk)) == 0
+    assert len(rl.score_pairs(chunk, match_threshold=0.7)) == 0
+
+
+# ------------------------------
+# Decisioni anticipate rispetto alla soglia
+# ------------------------------
+@pytest.mark.parametrize('prune_matches', [True, False])
+@pytest.mark.parametrize('threshold', [0.3, 0.5, 0.7, 0.9])
+def test_pruned_decisions_match_full_scoring(tmp_path, threshold, prune_matches):
+    chunk = b1_chunk(tmp_path)
+    full = rl.score_pairs(chunk)
+    stats = rl.new_pruning_stats()
+    pruned = rl.score_pairs(chunk, match_threshold=threshold, prune_matches=prune_matches, stats=stats)
+
+    np.testing.assert_array_equal(pruned >= threshold, full >= threshold)
+    assert stats['pairs'] == len(chunk)
+    assert stats['model_evaluated'] + stats['skipped_below'] + stats['skipped_above'] == len(chunk)
+    if not prune_matches:
+        # i match conservano il punteggio completo
+        assert stats['skipped_above'] == 0
+        np.testing.assert_array_equal(pruned[full >= threshold], full[full >= threshold])
+
+
+def test_pruning_skips_model_for_hopeless_pairs(tmp_path):
+    chunk = b1_chunk(tmp_path)
+    stats = rl.new_pruning_stats()
+    rl.score_pairs(chunk, match_threshold=0.9, prune_matches=False, stats=stats)
+    assert stats['skipped_below'] > 0
+    assert stats['model_evaluated'] < len(chunk)
+
+
+# ------------------------------
+# Tabelle precalcolate delle regole categoriche
+# ------------------------------
+def random_value_pairs(field, n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    values = np.array(FIELD_VALUES[field] + ['Other', ' truck ', 'nan', 'AWD'], dtype=object)
+    return values[rng.integers(0, len(values), n)], values[rng.integers(0, len(values), n)]
+
+
+@pytest.mark.parametrize('field', RULE_FIELDS)
+def test_rule_table_matches_rule(field):
+    rule = rl.RULE_FIELDS[field]
+    table = rl.RuleTable(rule, field)
+    for seed in range(3):
+        values_a, values_b = random_value_pairs(field, seed=seed)
+        expected = np.array([rule(a, b) for a, b in zip(values_a, values_b)], dtype=float)
+        np.testing.assert_array_equal(table.scores(values_a, values_b), expected)
+
+
+@pytest.mark.parametrize('field', RULE_FIELDS)
+def test_rule_table_growth_keeps_scores(field):
+    rule = rl.RULE_FIELDS[field]
+    table = rl.RuleTable(rule, field)
+    values = FIELD_VALUES[field] + [f'value {i}' for i in range(40)]
+    # il vocabolario cresce un valore alla volta oltre la capacità iniziale
+    for value in values:
+        table.fit([value])
+    grid_a, grid_b = np.meshgrid(np.array(values, dtype=object), np.array(values, dtype=object))
+    expected = np.array([rule(a, b) for a, b in zip(grid_a.ravel(), grid_b.ravel())], dtype=float)
+    np.testing.assert_array_equal(table.scores(grid_a.ravel(), grid_b.ravel()), expected)
+    assert table.matrix.shape == (len(values), len(values))
+
+
+def test_rule_table_fallback_past_max_vocab(capsys):
+    table = rl.RuleTable(rl.score_fuel, 'fuel_type', max_vocab=3)
+    values_a, values_b = random_value_pairs('fuel_type')
+    expected = np.array([rl.score_fuel(a, b) for a, b in zip(values_a, values_b)], dtype=float)
+    np.testing.assert_array_equal(table.scores(values_a, values_b), expected)
+    reverse = np.array([rl.score_fuel(b, a) for a, b in zip(values_a, values_b)], dtype=float)
+    np.testing.assert_array_equal(table.scores(values_b, values_a), reverse)
+    # segnalato una volta sola
+    assert capsys.readouterr().out.count('RuleTable fuel_type') == 1
+
+
+def test_fit_rule_tables_from_files(ab_files, tmp_path):
+    rl.fit_rule_tables(*ab_files)
+    for field in RULE_FIELDS:
+        values = set(pd.concat([pd.read_csv(f, dtype=str)[field] for f in ab_files]).fillna(''))
+        assert values <= set(rl.rule_tables[field].values)
+
+    # stessi codici in un worker che riceve i vocabolari
+    vocabularies = rl.rule_vocabularies()
+    worker_table = rl.RuleTable(rl.RULE_FIELDS['drive'], 'drive')
+    worker_table.fit(vocabularies['drive'])
+    assert worker_table.codes == {v: i for i, v in enumerate(vocabularies['drive'])}
+
+    chunk = b1_chunk(tmp_path)
+    columns = dict(rl.B1_PAIR_COLUMNS, manufacturer=('manufacturer', 'manufacturer'), year=('year', 'year'))
+    np.testing.assert_allclose(rl.score_pairs(chunk), scalar_scores(chunk, columns), rtol=0, atol=1e-12)
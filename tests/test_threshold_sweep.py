@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import blocking as b
+import record_linkage as rl
+from threshold_sweep import evaluate_thresholds
+from conftest import RECORD_FIELDS
+
+THRESHOLD = 0.5
+
+
+@pytest.fixture
+def linkage_files(ab_files, tmp_path):
+    """File di blocking B1 e test set con coppie nei blocchi e coppie che il blocking non genera."""
+    blocking_file = str(tmp_path / 'b1.csv')
+    b.generate_candidate_pairs_B1(*ab_files, blocking_file)
+    candidates = pd.read_csv(blocking_file, dtype=str)
+    rng = np.random.default_rng(0)
+
+    in_block = candidates.iloc[rng.choice(len(candidates), 60, replace=False)].reset_index(drop=True)
+    side_a = pd.DataFrame({f: in_block[f if f in ('manufacturer', 'year') else f'{f}_a'] for f in RECORD_FIELDS})
+    side_b = pd.DataFrame({f: in_block[f if f in ('manufacturer', 'year') else f'{f}_b'] for f in RECORD_FIELDS})
+    labels = (rl.score_pairs(in_block) >= 0.45).astype(int)
+    labels[::7] ^= 1
+
+    # coppie con anni diversi: fuori dai blocchi B1, metà match
+    df_a = pd.read_csv(ab_files[0], dtype=str).dropna(subset=['year'])
+    df_b = pd.read_csv(ab_files[1], dtype=str).dropna(subset=['year'])
+    out_a = df_a.iloc[rng.choice(len(df_a), 40)].reset_index(drop=True)
+    out_b = df_b.iloc[rng.choice(len(df_b), 40)].reset_index(drop=True)
+    out = out_a['year'] != out_b['year']
+    out_a, out_b = out_a[out], out_b[out]
+
+    test = pd.concat([
+        pd.concat([side_a.add_prefix('a_'), side_b.add_prefix('b_')], axis=1).assign(match=labels),
+        pd.concat([out_a[RECORD_FIELDS].add_prefix('a_'), out_b[RECORD_FIELDS].add_prefix('b_')], axis=1)
+        .assign(match=np.arange(out.sum()) % 2),
+    ], ignore_index=True)
+    test_file = str(tmp_path / 'test.csv')
+    test.to_csv(test_file, index=False)
+    return blocking_file, test_file
+
+
+def assert_same_metrics(metrics, sweep):
+    at = sweep['at_threshold'][0]
+    for name in ('precision', 'recall', 'f1'):
+        assert at[name] == pytest.approx(metrics[name])
+
+
+def test_evaluate_B1_log_matches_sweep(linkage_files, tmp_path):
+    scores_file = str(tmp_path / 'scores.bin')
+    metrics = rl.evaluate_B1(*linkage_files, match_threshold=THRESHOLD, scores_file=scores_file)
+    sweep = evaluate_thresholds(scores_file, (THRESHOLD,))
+
+    assert sweep['unscored'] > 0
+    assert 0 < metrics['recall'] < 1
+    assert_same_metrics(metrics, sweep)
+
+
+def test_parallel_log_matches_sweep_and_serial(linkage_files, tmp_path):
+    backup_file = str(tmp_path / 'results.bin')
+    metrics = rl.evaluate_B1_parallel(*linkage_files, match_threshold=THRESHOLD, max_workers=2,
+                                      backup_file=backup_file)
+    assert_same_metrics(metrics, evaluate_thresholds(backup_file, (THRESHOLD,)))
+
+    serial = rl.evaluate_B1(*linkage_files, match_threshold=THRESHOLD)
+    for name in ('precision', 'recall', 'f1'):
+        assert serial[name] == pytest.approx(metrics[name])
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+from record_linkage import read_result_log
+
+
+# ------------------------------
+# Punteggi salvati una volta sola, soglie valutate tutte insieme
+# ------------------------------
+def load_scores(path):
+    """
+    Punteggi ed etichette salvati da una delle pipeline:
+    - log binario dei risultati del record linkage (RESULT_DTYPE, es. evaluate_B1_parallel(backup_file=...))
+    - CSV con colonne score,label (dedupe_scores, ditto_scores)
+    Le coppie del ground truth mai valutate (non generate dal blocking) hanno punteggio NaN:
+    non sono mai predette come match e contano come falsi negativi, come nelle metriche
+    restituite da evaluate_B1, evaluate_B1_parallel e link_blocks_fused.
+    """
+    if str(path).lower().endswith(".csv"):
+        df = pd.read_csv(path)
+    else:
+        df = read_result_log(path)
+    # il log salva i punteggi in float64 come il run: le soglie danno le stesse predizioni
+    scores = pd.to_numeric(df["score"], errors="coerce").to_numpy()
+    if not np.issubdtype(scores.dtype, np.floating):
+        scores = scores.astype(np.float64)
+    labels = df["label"].to_numpy(dtype=np.int64)
+    return scores, labels
+
+
+def precision_recall_curve(scores, labels):
+    """
+    Curva precision/recall/F1 su tutte le soglie distinte in un unico passaggio vettoriale:
+    ordinamento decrescente dei punteggi e somme cumulative di veri e falsi positivi.
+    A ogni soglia t la predizione è score >= t (come match_threshold nel record linkage).
+    """
+    scores = np.asarray(scores)
+    if not np.issubdtype(scores.dtype, np.floating):
+        scores = scores.astype(np.float64)
+    labels = np.asarray(labels, dtype=np.int64)
+    total_pos = int(labels.sum())
+
+    scored = ~np.isnan(scores)
+    order = np.argsort(-scores[scored], kind="mergesort")
+    sorted_scores = scores[scored][order]
+    sorted_labels = labels[scored][order]
+
+    # ultima posizione di ogni soglia distinta: lì tutte le coppie con score >= soglia sono incluse
+    last = np.r_[np.flatnonzero(sorted_scores[1:] != sorted_scores[:-1]), len(sorted_scores) - 1]
+    last = last[last >= 0]
+    tp = np.cumsum(sorted_labels)[last]
+    fp = (last + 1) - tp
+    fn = total_pos - tp
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(total_pos > 0, tp / max(total_pos, 1), 0.0)
+        f1 = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+
+    return {
+        "thresholds": sorted_scores[last],
+        "tp": tp,
+        "fp": fp,
+        "fn": fn,
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "total_pos": total_pos,
+    }
+
+
+def pr_auc(curve):
+    """Area sotto la curva precision-recall (average precision: somma a gradini sui salti di recall)."""
+    recall = np.r_[0.0, curve["recall"]]
+    return float(np.sum(np.diff(recall) * curve["precision"]))
+
+
+def metrics_at_threshold(curve, threshold):
+    """Precision/recall/F1 a una soglia qualsiasi, letti dalla curva senza ripassare i punteggi."""
+    # soglie in ordine decrescente: k = quante soglie distinte sono >= threshold
+    # (soglia convertita alla precisione dei punteggi)
+    thresholds = curve["thresholds"]
+    k = int(np.searchsorted(-thresholds, -thresholds.dtype.type(threshold), side="right"))
+    if k == 0:
+        return {"threshold": threshold, "precision": 0.0, "recall": 0.0, "f1": 0.0}
+    i = k - 1
+    return {
+        "threshold": threshold,
+        "precision": float(curve["precision"][i]),
+        "recall": float(curve["recall"][i]),
+        "f1": float(curve["f1"][i]),
+    }
+
+
+def evaluate_thresholds(scores_file, match_thresholds=(0.70,), curve_csv=None):
+    """
+    Valuta tutte le soglie sui punteggi salvati (nessun nuovo scan del file di candidate pairs):
+    soglia con F1 migliore, PR-AUC e metriche alle soglie richieste.
+    curve_csv: se indicato salva la curva completa (threshold, precision, recall, f1).
+    """
+    scores, labels = load_scores(scores_file)
+    curve = precision_recall_curve(scores, labels)
+
+    best = int(np.argmax(curve["f1"])) if len(curve["f1"]) else None
+    result = {
+        "pairs": len(scores),
+        "unscored": int(np.isnan(scores).sum()),
+        "positives": curve["total_pos"],
+        "pr_auc": pr_auc(curve),
+        "best_threshold": float(curve["thresholds"][best]) if best is not None else None,
+        "best_precision": float(curve["precision"][best]) if best is not None else 0.0,
+        "best_recall": float(curve["recall"][best]) if best is not None else 0.0,
+        "best_f1": float(curve["f1"][best]) if best is not None else 0.0,
+        "at_threshold": [metrics_at_threshold(curve, t) for t in match_thresholds],
+    }
+
+    if curve_csv:
+        pd.DataFrame({
+            "threshold": curve["thresholds"],
+            "precision": curve["precision"],
+            "recall": curve["recall"],
+            "f1": curve["f1"],
+        }).to_csv(curve_csv, index=False)
+
+    print(f"\n--- Valutazione soglie: {scores_file} ---")
+    print(f"Coppie: {result['pairs']} (senza punteggio: {result['unscored']}), match: {result['positives']}")
+    print(f"Soglie distinte: {len(curve['thresholds'])}, PR-AUC: {result['pr_auc']:.4f}")
+    if best is not None:
+        print(f"Soglia migliore: {result['best_threshold']:.4f} -> Precision: {result['best_precision']:.4f}, "
+              f"Recall: {result['best_recall']:.4f}, F1: {result['best_f1']:.4f}")
+    for m in result["at_threshold"]:
+        print(f"Soglia {m['threshold']:.2f} -> Precision: {m['precision']:.4f}, "
+              f"Recall: {m['recall']:.4f}, F1: {m['f1']:.4f}")
+    if curve_csv:
+        print(f"Curva salvata in {curve_csv}")
+
+    return result